@@ -1,14 +1,202 @@
 import sys
 import os
+import tempfile
+import time
+import argparse
+import logging
+import multiprocessing
+from functools import lru_cache
+import numpy as np
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QGridLayout,
                              QPushButton, QColorDialog, QFileDialog, QSlider, QLabel, 
-                             QSizePolicy, QButtonGroup, QToolButton, QMessageBox, QMenuBar)
+                             QSizePolicy, QButtonGroup, QToolButton, QMessageBox, QMenuBar,
+                             QDialog, QFormLayout, QSpinBox, QComboBox, QDialogButtonBox, QCheckBox,
+                             QProgressBar, QDoubleSpinBox, QTabWidget, QInputDialog, QListWidget,
+                             QListWidgetItem, QMenu)
 from PyQt6.QtGui import (QPainter, QPen, QPixmap, QImage, QPainterPath, QAction, 
-                         QIcon, QCursor, QBrush, QPainterPath, QColor)
-from PyQt6.QtCore import Qt, QPoint, QRect, QSize, pyqtSignal, QEvent, QTimer
+                         QIcon, QCursor, QBrush, QPainterPath, QColor, QRegion, QTransform,
+                         QLinearGradient)
+from PyQt6.QtCore import Qt, QPoint, QRect, QRectF, QSize, pyqtSignal, QEvent, QTimer
 from PyQt6.QtWidgets import QScrollArea
 from collections import deque
 from resource_path import resource_path
+from diagnostics import StallWatchdog, SessionProfiler
+from jobs import Job, JobCancelled
+from idle import IdleScheduler
+from input_trace import InputRecorder
+from filmstrip import Filmstrip, ThumbnailLoader, Prefetcher
+from image_io import (open_tiled_source, write_tiled_tiff, open_mapped_array,
+                      mapped_qimage_format, write_back_rows, file_key, RAW_LAYOUTS)
+from project import is_project, open_project, save_project, project_tiles, history_record, history_state
+from image_ops import (qimage_view, wrap_array, array_to_qimage, editable_image, pixel_value, DabStroke,
+                       RegionStats, rgb_index, compact_image, rotate90, flip,
+                       flood_fill, make_transparent, content_bbox, corner_color, tone_lut, apply_lut,
+                       named_filter, despeckle, resize_image, with_alpha, ALPHA_FORMATS, PackedImage,
+                       DIFF_TILE, tile_hashes, ImageDiff, diff_heatmap, fill_region, gradient_fill)
+from frames import FRAME_EXTENSIONS, FrameStack, frame_count, save_frames, apply_to_frames
+
+# TIFFs that are tiled, pyramidal or larger than this are opened lazily
+LAZY_OPEN_PIXELS = 64 * 1024 * 1024
+# Edge of the full-resolution tiles that hold edits to a lazily opened image
+OVERLAY_TILE = 512
+# Formats the canvas draws from directly; other documents are converted per exposed rect
+DISPLAY_FORMATS = (QImage.Format.Format_ARGB32, QImage.Format.Format_ARGB32_Premultiplied,
+                   QImage.Format.Format_RGB32)
+# Newest undo snapshots left uncompressed when idle time packs the older ones
+UNPACKED_SNAPSHOTS = 2
+# Longest edge of the History panel's thumbnails
+HISTORY_THUMBNAIL = 64
+# Image > Filter entries
+FILTER_NAMES = {"gaussian": "Gaussian Blur", "unsharp": "Unsharp Mask", "box": "Box Blur", "median": "Median"}
+# Operations Apply to All Frames repeats, as Canvas.last_operation records them
+OPERATION_NAMES = {"crop": "Crop", "rotate": "Rotate", "flip": "Flip", "tones": "Adjust Tones",
+                   "removebg": "Remove BG", "filter": "Filter"}
+
+def opens_lazily(source):
+    # Whether open_image reads this TIFF tile by tile instead of decoding it
+    return source.tiled or len(source.levels) > 1 or source.width * source.height > LAZY_OPEN_PIXELS
+
+def decode_image(file_name, source=None):
+    # Decode a whole image file, in the format it is edited in; `source` is
+    # its TiledSource, if any
+    image = QImage()
+    if not image.load(file_name) and source is not None:
+        # Small TIFF that the Qt image plugins can't decode
+        image = array_to_qimage(source.read_region(0, 0, 0, source.width, source.height))
+    if image.isNull():
+        raise ValueError(f"can't read {os.path.basename(file_name)}")
+    return editable_image(image)
+
+def prefetch_decode(file_name):
+    # Decode for the folder prefetcher: (image, undo snapshot), or None for
+    # files that open lazily or frame by frame anyway
+    if frame_count(file_name):
+        return None
+    source = open_tiled_source(file_name)
+    try:
+        if source is not None and opens_lazily(source):
+            return None
+        image = decode_image(file_name, source)
+        return image, image.copy()
+    finally:
+        if source is not None:
+            source.close()
+
+def history_label(state):
+    # What an undo history entry holds, for lists of undo steps
+    if isinstance(state, tuple):
+        return {"crop": "Crop", "rotate": "Rotate", "flip": "Flip", "patch": "Filter, despeckle or gradient",
+                "frames": "Apply to all frames"}.get(state[0], state[0])
+    if isinstance(state, dict):
+        return "Tiles"
+    if isinstance(state, PackedImage):
+        return "Image (compressed)"
+    return "Image"
+
+def state_thumbnail(state, previous):
+    # (thumbnail, (width, height), format) of an undo history entry, or None.
+    # Stored images are sampled, never decoded or copied whole; records are
+    # drawn onto `previous`, the thumbnail of the entry before them, at
+    # thumbnail scale. Tile overlays have no thumbnail of their own
+    size = HISTORY_THUMBNAIL
+    if isinstance(state, dict):
+        return None
+    if isinstance(state, PackedImage):
+        step = max(1, max(state.width, state.height) // (size * 2))
+        image = wrap_array(np.ascontiguousarray(state.sample(step)), state.format)
+        full, fmt = (state.width, state.height), state.format
+    elif isinstance(state, QImage):
+        image = state
+        full, fmt = (state.width(), state.height()), state.format()
+        if max(full) > size * 4:
+            image = state.scaled(size * 4, size * 4, Qt.AspectRatioMode.KeepAspectRatio,
+                                 Qt.TransformationMode.FastTransformation)
+    else:
+        if previous is None:
+            return None
+        thumb, (w, h), fmt = previous
+        kind, arg = state
+        if kind == "frames":
+            # Changes the other frames, not this one
+            return previous
+        if kind == "flip":
+            return thumb.mirrored(arg, not arg), (w, h), fmt
+        if kind == "rotate":
+            return thumb.transformed(QTransform().rotate(90 * arg)), (h, w) if arg % 2 else (w, h), fmt
+        sx, sy = thumb.width() / w, thumb.height() / h
+        if kind == "patch":
+            x, y, before, after = arg
+            ph, pw = after.shape[:2]
+            piece = wrap_array(np.ascontiguousarray(after), fmt).convertToFormat(QImage.Format.Format_ARGB32)
+            target = QRect(int(x * sx), int(y * sy), max(1, round(pw * sx)), max(1, round(ph * sy)))
+            thumb = thumb.copy()
+            painter = QPainter(thumb)
+            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
+            painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+            painter.drawImage(target, piece)
+            painter.end()
+            return thumb, (w, h), fmt
+        # Crop: the part of the previous thumbnail it keeps, scaled back up
+        x, y, cw, ch = arg
+        image = thumb.copy(QRect(int(x * sx), int(y * sy), max(1, round(cw * sx)), max(1, round(ch * sy))))
+        full = (cw, ch)
+    thumb = image.convertToFormat(QImage.Format.Format_ARGB32).scaled(
+        size, size, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+    return thumb, full, fmt
+
+def history_thumbnails(entries, known):
+    # Idle task steps for a worker: make the thumbnails of `entries` (undo
+    # history order) that `known` (id -> thumbnail) lacks, one per step,
+    # yielding (entry, thumbnail) for each
+    previous = None
+    for state in entries:
+        thumb = known.get(id(state), False)
+        if thumb is False:
+            thumb = state_thumbnail(state, previous)
+            yield state, thumb
+        previous = thumb
+
+def format_bytes(n):
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "bytes" else f"{n:.1f} {unit}"
+        n /= 1024.0
+
+def region_rects(region):
+    # The rectangles making up a QRegion (PyQt6 doesn't expose them): cut the
+    # bounding rect along the edges of the part the region leaves out until
+    # each piece is a single rectangle
+    pieces = []
+    pending = [region.boundingRect()]
+    while pending:
+        part = region.intersected(pending.pop())
+        if part.isEmpty():
+            continue
+        rect = part.boundingRect()
+        if part.rectCount() == 1:
+            pieces.append(rect)
+            continue
+        hole = QRegion(rect).subtracted(part).boundingRect()
+        if hole.top() > rect.top():
+            cut = (hole.top(), None)
+        elif hole.bottom() < rect.bottom():
+            cut = (hole.bottom() + 1, None)
+        elif hole.left() > rect.left():
+            cut = (None, hole.left())
+        elif hole.right() < rect.right():
+            cut = (None, hole.right() + 1)
+        elif rect.width() >= rect.height():
+            cut = (None, rect.left() + rect.width() // 2)
+        else:
+            cut = (rect.top() + rect.height() // 2, None)
+        y, x = cut
+        if y is not None:
+            pending.append(QRect(rect.left(), rect.top(), rect.width(), y - rect.top()))
+            pending.append(QRect(rect.left(), y, rect.width(), rect.bottom() + 1 - y))
+        else:
+            pending.append(QRect(rect.left(), rect.top(), x - rect.left(), rect.height()))
+            pending.append(QRect(x, rect.top(), rect.right() + 1 - x, rect.height()))
+    return pieces
 
 class RulerWidget(QWidget):
     def __init__(self, canvas: 'Canvas', orientation: Qt.Orientation):
@@ -122,14 +310,35 @@ class RulerWidget(QWidget):
 
 class Canvas(QWidget):
     zoomChanged = pyqtSignal(float)
+    statusMessage = pyqtSignal(str)
+    colorPicked = pyqtSignal(QColor)
+    jobStarted = pyqtSignal(object)
+    jobEnded = pyqtSignal()
+    documentOpened = pyqtSignal(str)
+    documentSaved = pyqtSignal(str)
+    frameChanged = pyqtSignal()
     def __init__(self):
         super().__init__()
         self.setAttribute(Qt.WidgetAttribute.WA_StaticContents)
+        # The canvas paints every pixel it is asked for, so when the scroll area
+        # moves it Qt blits what is already on screen and only asks for the
+        # newly exposed strips
+        self.setAttribute(Qt.WidgetAttribute.WA_OpaquePaintEvent)
         self.image = QImage(1600, 1200, QImage.Format.Format_ARGB32)
         self.image.fill(Qt.GlobalColor.white)
         self.drawing = False
         self.brush_size = 5
         self.brush_color = QColor(Qt.GlobalColor.black.value)
+        # Dab brush settings (0..1) and the stroke in progress
+        self.brush_hardness = 1.0
+        self.brush_opacity = 1.0
+        self.brush_flow = 1.0
+        self._stroke = None
+        # Gradient tool settings: "linear" or "radial", (position 0-1, color)
+        # stops, and whether it paints only the area Fill would fill
+        self.gradient_kind = "linear"
+        self.gradient_stops = [(0.0, QColor(Qt.GlobalColor.black)), (1.0, QColor(Qt.GlobalColor.white))]
+        self.gradient_region = False
         self.last_point = QPoint()
         self.zoom_factor = 1.0
         self.current_tool = "pointer"
@@ -142,7 +351,72 @@ class Canvas(QWidget):
         self._line_preview = None  # for line tool temporary preview end point
         self._square_start = None  # for square tool start position
         self._circle_start = None  # for circle tool start position
+        self._crop_start = None  # for crop tool start position
+        self._select_start = None  # for select tool start position
+        self._gradient_start = None  # for gradient tool start position
+        self._gradient_area = None  # ((x, y, w, h), mask) it is restricted to, None, or False while found
+        self._gradient_pending = None  # end point of a gradient released before its area was found
+        # Rectangle (image coordinates) that filters are restricted to, or None
+        self.selection = None
         self.modified = False
+        # File the document was opened from or last saved to (kept by the window)
+        self.file_path = None
+        # Lazily read image (tiled/pyramidal TIFF or project) and the edited tiles on top of it
+        self.source = None
+        self._overlay = {}
+        # The project file last opened or saved, as (path, state), the image
+        # it then held and the project tiles edited since (None = unknown);
+        # for lazily read images, the cache keys of the overlay tiles saved
+        self._project_sync = None
+        self._synced_image = None
+        self._dirty_tiles = None
+        self._saved_tiles = {}
+        # Undo entries already stored in that project: id -> (entry, record)
+        self._project_records = {}
+        # History panel thumbnails of undo entries: id -> (entry, thumbnail, icon)
+        self._history_thumbnails = {}
+        # Whether projects are saved with the undo history
+        self.save_history = False
+        # Multi-page TIFF or animated GIF (a FrameStack) the document shows one
+        # frame of, that frame, and the one stepped to while it is decoded (or None)
+        self.stack = None
+        self.frame = 0
+        self.wanted_frame = None
+        # The last edit Apply to All Frames can repeat, as apply_operation() takes it
+        self.last_operation = None
+        # Memory-mapped .npy/raw array that self.image views, and the rows edited since mapping
+        self.mapped = None
+        self._mapped_file = None
+        self._dirty_rows = None
+        # Color statistics of self.image, built on first use, and where the
+        # pointer last asked how many pixels a Fill or Remove BG would touch
+        self._stats = None
+        self._stats_image = None
+        self._affected_pos = None
+        # Background operation in progress; the document is locked until it ends
+        self.job = None
+        # Tone adjustment previewed on screen only, while its dialog is open,
+        # and the screen-sized samples of the image it is applied to
+        self._preview_lut = None
+        self._proxies = {}
+        # Tile hashes of self.image and the tiles edited since they were taken,
+        # so comparisons only read what may have changed
+        self._hashes = None
+        self._hashes_image = None
+        self._stale_hashes = set()
+        # Comparison shown over the image (an ImageDiff), the image it was
+        # made against and its heatmap tiles; blinking alternates the two
+        self.compare = None
+        self._compare_image = None
+        self._compare_other = None
+        self._heat = {}
+        self._file_hashes = {}  # file_key -> hashes of the file last compared with
+        self._next_difference = 0
+        self.compare_blink = False
+        self._blink_other = False
+        self._blink_timer = QTimer(self)
+        self._blink_timer.setInterval(500)
+        self._blink_timer.timeout.connect(self._blink)
         self.save_state()
         # Start with default arrow cursor (pointer)
         # Ensure size reflects current zoom for scrollbars
@@ -158,113 +432,1466 @@ class Canvas(QWidget):
         else:
             self.brush_color = QColor(color)
     
+    def doc_size(self):
+        # Size of the document in image pixels (the file size for lazily read images)
+        if self.source is not None:
+            return QSize(self.source.width, self.source.height)
+        return self.image.size()
+
     def get_pixel_color(self, pos):
-        if 0 <= pos.x() < self.image.width() and 0 <= pos.y() < self.image.height():
+        size = self.doc_size()
+        if 0 <= pos.x() < size.width() and 0 <= pos.y() < size.height():
+            if self.source is not None:
+                b, g, r, a = self.read_document_region(pos.x(), pos.y(), 1, 1)[0, 0]
+                return QColor(int(r), int(g), int(b), int(a))
             return self.image.pixelColor(pos)
         return None
     
+    def _snapshot(self):
+        if self.source is not None:
+            # Shallow QImage copies share pixels until a tile is painted on again
+            return {key: QImage(tile) for key, tile in self._overlay.items()}
+        return self.image.copy()
+
+    def _restore(self, state):
+        if isinstance(state, PackedImage):
+            # Decompressed into a new image, so it needs no copy of its own
+            unpacked = state.unpack()
+            if self.mapped is None:
+                self.image = unpacked
+                return
+            state = unpacked
+        if isinstance(state, dict):
+            self._overlay = {key: QImage(tile) for key, tile in state.items()}
+        elif (self.mapped is not None and state.size() == self.image.size()
+              and state.format() == self.image.format()):
+            # Copy into the mapped buffer so the canvas keeps viewing the file
+            qimage_view(self.image)[...] = qimage_view(state, readonly=True)
+            self._mark_dirty()
+        else:
+            self.image = state.copy()
+
+    def idle_work(self, scheduler, active=True):
+        # While the user pauses: compress the older undo snapshots on a worker,
+        # oldest first and one at a time; the newest stay ready for a quick undo.
+        # A document in a background tab has all of them compressed, after
+        # the active document's
+        if active:
+            self._count_colors(scheduler)
+        key = ("pack-history", id(self))
+        if self.job is not None or scheduler.pending(key):
+            return
+        # Mapped-file states (wrapped arrays) cost no memory to keep, and
+        # noise-like images that didn't compress aren't tried again
+        snapshots = [state for state in self.history if isinstance(state, QImage)
+                     and not hasattr(state, '_array_ref') and not hasattr(state, '_incompressible')]
+        if len(snapshots) <= (UNPACKED_SNAPSHOTS if active else 0):
+            return
+        image = snapshots[0]
+
+        def packed(result):
+            if result is None:
+                image._incompressible = True
+                self.idle_work(scheduler, active)
+                return
+            for i, state in enumerate(self.history):
+                if state is image:
+                    if hasattr(image, '_tile_hashes'):
+                        result._tile_hashes = image._tile_hashes
+                    self.history[i] = result
+                    # The same pixels, so a project that stores them needn't again
+                    record = self._project_records.pop(id(image), None)
+                    if record is not None:
+                        self._project_records[id(result)] = (result, record[1])
+                    thumb = self._history_thumbnails.pop(id(image), None)
+                    if thumb is not None:
+                        self._history_thumbnails[id(result)] = (result,) + thumb[1:]
+                    self.idle_work(scheduler, active)
+                    return
+        scheduler.submit(key, PackedImage.pack_steps(image), priority=1 if active else 0,
+                         worker=True, done=packed)
+
+    def _count_colors(self, scheduler):
+        # Build the color histogram for the pixel count _report_affected() shows
+        key = ("color-histogram", id(self))
+        if (self._affected_pos is None or self.current_tool not in ("bucket", "removebg")
+                or self.job is not None or scheduler.pending(key)):
+            return
+        stats = self.region_stats()
+        if stats is None or stats.histogram_ready:
+            return
+
+        def counted(result):
+            pos = self._affected_pos
+            if (stats is self._stats and stats.adopt_histogram(result) and pos is not None
+                    and self.current_tool in ("bucket", "removebg") and self.image.rect().contains(pos)):
+                self._report_affected(pos)
+        # Counting only reads the pixels, and an edit meanwhile discards the count
+        scheduler.submit(key, stats.histogram_steps(), priority=2, worker=True, done=counted)
+
+    def release_caches(self):
+        # Drop what only speeds up drawing and color queries; kept documents
+        # in background tabs hold just their pixels and undo history
+        self._proxies.clear()
+        self._stats = None
+        self._stats_image = None
+        self._heat = {}
+        if self.source is not None:
+            self.source.release_cache()
+        if self.stack is not None:
+            self.stack.release_cache()
+
+    def memory_usage(self):
+        # Bytes held by this document: {"image", "history", "caches"}. Pixels
+        # shared by several states (shallow copies, crop views) count once,
+        # and mapped files, which the OS pages in and out, not at all
+        seen = set()
+
+        def image_bytes(image):
+            if hasattr(image, '_parent'):
+                # A crop view into its parent's pixels
+                return image_bytes(image._parent)
+            if isinstance(getattr(image, '_array_ref', None), np.memmap) or image.cacheKey() in seen:
+                return 0
+            seen.add(image.cacheKey())
+            return image.sizeInBytes()
+
+        def state_bytes(state):
+            if isinstance(state, PackedImage):
+                return state.nbytes
+            if isinstance(state, QImage):
+                return image_bytes(state)
+            if isinstance(state, dict):
+                return sum(image_bytes(tile) for tile in state.values())
+            if state[0] == "patch":
+                _, _, before, after = state[1]
+                return before.nbytes + after.nbytes
+            return 0
+        usage = {"image": 0 if self.mapped is not None else image_bytes(self.image)}
+        usage["image"] += sum(image_bytes(tile) for tile in self._overlay.values())
+        usage["history"] = sum(state_bytes(state) for state in list(self.history) + list(self.redo_stack))
+        usage["caches"] = sum(block.nbytes for block in self._proxies.values())
+        usage["caches"] += sum(heat.sizeInBytes() for heat in self._heat.values())
+        usage["caches"] += sum(thumb[1][0].sizeInBytes() for thumb in self._history_thumbnails.values() if thumb[1])
+        if self._compare_other is not None:
+            usage["caches"] += image_bytes(self._compare_other)
+        if self.source is not None:
+            usage["caches"] += self.source.cache_bytes
+        if self.stack is not None:
+            usage["caches"] += self.stack.cache_bytes
+        return usage
+
+    def _mark_dirty(self, rect=None):
+        # Called when pixels in rect are about to change (None = anything changed):
+        # keeps the color statistics current and remembers which rows of a
+        # mapped array and which project tiles need writing back
+        if self._dirty_tiles is not None:
+            if rect is None:
+                self._dirty_tiles = None
+            else:
+                inside = rect.intersected(self.image.rect())
+                if not inside.isEmpty():
+                    self._dirty_tiles.update(project_tiles(inside.x(), inside.y(), inside.width(), inside.height()))
+        if self._stats is not None and self._stats_image is self.image:
+            self._stats.before_edit(None if rect is None else
+                                    (rect.left(), rect.top(), rect.right() + 1, rect.bottom() + 1))
+        if self._hashes is not None and self._hashes_image is self.image:
+            inside = QRect() if rect is None else rect.intersected(self.image.rect())
+            if rect is None:
+                self._hashes = None
+            elif not inside.isEmpty():
+                self._stale_hashes.update(
+                    (tx, ty) for ty in range(inside.top() // DIFF_TILE, inside.bottom() // DIFF_TILE + 1)
+                    for tx in range(inside.left() // DIFF_TILE, inside.right() // DIFF_TILE + 1))
+        if self.compare is not None:
+            # A comparison describes the image as it was
+            self.end_compare()
+        if self.mapped is None:
+            return
+        height = self.image.height()
+        if rect is None:
+            y0, y1 = 0, height
+        else:
+            y0, y1 = max(0, rect.top()), min(height, rect.bottom() + 1)
+        if self._dirty_rows is not None:
+            y0, y1 = min(y0, self._dirty_rows[0]), max(y1, self._dirty_rows[1])
+        self._dirty_rows = (y0, y1)
+
+    def region_stats(self):
+        # Statistics index over the current image (None for lazily read images)
+        if self.source is not None:
+            return None
+        if self._stats is None or self._stats_image is not self.image:
+            image = self.image
+            self._stats = RegionStats(lambda: qimage_view(image, readonly=True), rgb_index(image.format()))
+            self._stats_image = image
+        return self._stats
+
+    def average_color(self, pos, size):
+        # Mean color of the size x size area centered on pos
+        half = size // 2
+        x0, y0 = pos.x() - half, pos.y() - half
+        stats = self.region_stats()
+        if stats is None:
+            x0, y0 = max(0, x0), max(0, y0)
+            block = self.read_document_region(x0, y0, size, size)
+            b, g, r, a = block.reshape(-1, 4).mean(axis=0)
+            return QColor(int(round(r)), int(round(g)), int(round(b)), int(round(a)))
+        mean = stats.mean(x0, y0, x0 + size, y0 + size)
+        if mean is None:
+            return None
+        fmt = self.image.format()
+        scale = 257.0 if fmt in (QImage.Format.Format_Grayscale16, QImage.Format.Format_RGBA64) else 1.0
+        mean = np.rint(mean / scale).astype(int)
+        index = rgb_index(fmt)
+        if index is None:
+            return QColor(mean[0], mean[0], mean[0])
+        alpha = mean[3] if len(mean) == 4 and fmt != QImage.Format.Format_RGB32 else 255
+        return QColor(mean[index[0]], mean[index[1]], mean[index[2]], alpha)
+
+    def _report_affected(self, canvas_pos):
+        # Live feedback on how many pixels a Fill or Remove BG click would touch.
+        # Counting needs the color histogram, which idle_work() builds once the
+        # pointer rests; until then nothing is shown
+        stats = self.region_stats()
+        self._affected_pos = canvas_pos
+        if stats is None or not stats.histogram_ready:
+            return
+        color = self.image.pixelColor(canvas_pos)
+        if rgb_index(self.image.format()) is None:
+            key = pixel_value(color.getRgb(), self.image.format())
+        else:
+            scale = 257 if self.image.format() == QImage.Format.Format_RGBA64 else 1
+            key = (color.red() * scale, color.green() * scale, color.blue() * scale)
+        count = stats.count_within(key)
+        if self.current_tool == "removebg":
+            self.statusMessage.emit(f"Remove BG: {count:,} pixels of {color.name()} would become transparent")
+        else:
+            self.statusMessage.emit(f"Fill: up to {count:,} pixels of {color.name()} (connected area only)")
+
     def save_state(self):
-        self.history.append(self.image.copy())
+        snapshot = self._snapshot()
+        if self._hashes is not None and self._hashes_image is self.image and isinstance(snapshot, QImage):
+            # A copy has the same tiles, so it starts out with the same hashes
+            snapshot._tile_hashes = (self._hashes.copy(), set(self._stale_hashes))
+        self.history.append(snapshot)
         self.redo_stack.clear()
     
     def undo(self):
-        if len(self.history) > 1:
-            self.redo_stack.append(self.history.pop())
-            self.image = self.history[-1].copy()
+        if len(self.history) > 1 and not self._busy():
+            state = self.history.pop()
+            if isinstance(state, tuple) and state[0] != "crop":
+                # Rotations and flips are undone by their inverse
+                self._apply_geometry(state, inverse=True)
+            elif getattr(self.image, '_crop', None) is state:
+                # Still the view this crop made, so its parent is the uncropped image
+                self.image = self.image._parent
+            elif not self._rebuild_state():
+                self.history.append(state)
+                return
+            self.redo_stack.append(state)
+            self.setFixedSize(self.sizeHint())
             self.update()
+            self.zoomChanged.emit(self.zoom_factor)
     
     def redo(self):
-        if self.redo_stack:
-            self.image = self.redo_stack.pop()
-            self.history.append(self.image.copy())
+        if self.redo_stack and not self._busy():
+            state = self.redo_stack.pop()
+            if isinstance(state, tuple):
+                self._apply_geometry(state)
+            else:
+                self._restore(state)
+            self.history.append(state)
+            self.setFixedSize(self.sizeHint())
             self.update()
+            self.zoomChanged.emit(self.zoom_factor)
+
+    def jump_to(self, index):
+        # Make entry `index` of the timeline (the history, oldest first, then
+        # the redo stack) the current state: the entries in between move from
+        # one stack to the other and the state is restored once, instead of
+        # undoing or redoing them one at a time
+        current = len(self.history) - 1
+        if index == current or not 0 <= index < len(self.history) + len(self.redo_stack) or self._busy():
+            return False
+
+        def move_to(target):
+            # Records of other frames' changes aren't part of the image that is
+            # rebuilt, so they are undone and redone as they move
+            while len(self.history) - 1 > target:
+                state = self.history.pop()
+                self.redo_stack.append(state)
+                if isinstance(state, tuple) and state[0] == "frames":
+                    self._apply_geometry(state, inverse=True)
+            while len(self.history) - 1 < target:
+                state = self.redo_stack.pop()
+                self.history.append(state)
+                if isinstance(state, tuple) and state[0] == "frames":
+                    self._apply_geometry(state)
+        move_to(index)
+        if not self._rebuild_state():
+            # No stored image left below it to rebuild from
+            move_to(current)
+            self.statusMessage.emit("That undo step can no longer be restored")
+            return False
+        self.setFixedSize(self.sizeHint())
+        self.update()
+        self.zoomChanged.emit(self.zoom_factor)
+        return True
+
+    def _rebuild_state(self):
+        # Restore the state at the top of the history: the newest stored image
+        # with the geometric records above it replayed
+        index = len(self.history) - 1
+        while index >= 0 and isinstance(self.history[index], tuple):
+            index -= 1
+        if index < 0:
+            return False
+        self._restore(self.history[index])
+        for i in range(index + 1, len(self.history)):
+            if self.history[i][0] != "frames":
+                self._apply_geometry(self.history[i])
+        return True
+
+    def _apply_geometry(self, record, inverse=False):
+        # History records ("crop", (x, y, w, h)), ("rotate", quarter turns),
+        # ("flip", horizontal) and ("patch", (x, y, before, after)) stand in
+        # for full image copies; a patch holds the pixels of the one rectangle
+        # an edit changed. ("frames", (before, after)) points the other frames
+        # of a multi-frame document at the files holding their pixels
+        kind, arg = record
+        if kind == "frames":
+            before, after = arg
+            self.stack.set_sources(before if inverse else after)
+            return
+        if kind == "patch":
+            x, y, before, after = arg
+            pixels = before if inverse else after
+            h, w = pixels.shape[:2]
+            self._mark_dirty(QRect(x, y, w, h))
+            qimage_view(self.image)[y:y + h, x:x + w] = pixels
+        elif kind == "flip":
+            # In place, so a mapped array stays mapped
+            self._mark_dirty()
+            flip(qimage_view(self.image), arg)
+        elif kind == "rotate":
+            pixels = rotate90(qimage_view(self.image, readonly=True), -arg if inverse else arg)
+            fmt = self.image.format()
+            self._close_source()
+            self.image = wrap_array(pixels, fmt)
+        elif kind == "crop":
+            # A view into the current buffer: no pixels are copied
+            x, y, w, h = arg
+            parent = self.image
+            view = qimage_view(parent)[y:y + h, x:x + w]
+            self._close_source()
+            self.image = wrap_array(view, parent.format())
+            self.image._parent = parent
+            self.image._crop = record
+
+    def _geometry_edit(self, record):
+        if self._busy():
+            return False
+        if self.source is not None:
+            self.statusMessage.emit("Crop, rotate and flip are not available on tiled images")
+            return False
+        if self.mapped is not None and record[0] != "flip":
+            # A new shape can't be written back into the mapped file, so the
+            # document becomes an ordinary image from here on, undo included
+            name = os.path.basename(self._mapped_file[0])
+            self._close_source()
+            self.image = self.image.copy()
+            self.statusMessage.emit(f"{name} is now edited as a copy in memory; save it to keep the changes")
+        self._apply_geometry(record)
+        self.history.append(record)
+        self.redo_stack.clear()
+        self.last_operation = record
+        self.selection = None
+        self.setFixedSize(self.sizeHint())
+        self.update()
+        self.modified = True
+        self.zoomChanged.emit(self.zoom_factor)
+        return True
+
+    def crop_image(self, rect):
+        rect = rect.normalized().intersected(QRect(QPoint(0, 0), self.doc_size()))
+        if rect.isEmpty() or rect.size() == self.doc_size():
+            return False
+        return self._geometry_edit(("crop", (rect.x(), rect.y(), rect.width(), rect.height())))
+
+    def rotate_image(self, turns):
+        return self._geometry_edit(("rotate", turns % 4))
+
+    def flip_image(self, horizontal):
+        return self._geometry_edit(("flip", horizontal))
     
+    def _close_source(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        self._overlay = {}
+        self.mapped = None
+        self._mapped_file = None
+        self._dirty_rows = None
+
     def clear_canvas(self):
+        if self._busy():
+            return
+        if self.source is not None:
+            # Start a blank canvas rather than materializing the whole file
+            self._close_source()
+            self.image = QImage(1600, 1200, QImage.Format.Format_ARGB32)
+            self.history.clear()
         self.image.fill(Qt.GlobalColor.white)
+        self._mark_dirty()
         self.save_state()
         self.setFixedSize(self.sizeHint())
         self.update()
         self.modified = True
     
-    def open_image(self, file_name):
-        if file_name:
-            tmp = QImage()
-            if tmp.load(file_name):
-                self.image = tmp.convertToFormat(QImage.Format.Format_ARGB32)
+    def open_image(self, file_name, background=True, decoded=None):
+        # `decoded` is the file already decoded (prefetched) as an (image,
+        # undo snapshot) pair, to show at once
+        if not file_name or self._busy():
+            return
+        if decoded is not None:
+            self._adopt(file_name, decoded)
+            return
+        if is_project(file_name):
+            self._open_project(file_name, background)
+            return
+        source = open_tiled_source(file_name)
+        if source is not None and opens_lazily(source):
+            # Read tiles on demand instead of decoding the whole file
+            self._close_source()
+            self.source = source
+            self.image = QImage(1, 1, QImage.Format.Format_ARGB32)
+            self.history.clear()
+            self._opened(file_name)
+            return
+        count = frame_count(file_name)
+        if count:
+            if source is not None:
+                source.close()
+            self._open_frames(file_name, count, background)
+            return
+
+        def load(job):
+            try:
+                image = decode_image(file_name, source)
+            finally:
+                if source is not None:
+                    source.close()
+            job.check()
+            # The undo snapshot is copied here too, off the GUI thread
+            return image, image.copy()
+        self.run_job("Open", load, lambda decoded: self._adopt(file_name, decoded), background)
+
+    def _adopt(self, file_name, decoded):
+        image, snapshot = decoded
+        if self.source is not None:
+            # Overlay-tile undo states don't apply to a regular image
+            self.history.clear()
+        self._close_source()
+        self.image = image
+        self._opened(file_name, snapshot)
+
+    def _opened(self, file_name, snapshot=None, history=None, stack=None):
+        # `history` replaces the undo history (a project's), else `snapshot`
+        # or a new one is the undo state of the opened image; `stack` holds
+        # the frames of a multi-frame file
+        self._set_stack(stack)
+        self.selection = None
+        self.end_compare()
+        self._project_sync = None
+        self._dirty_tiles = None
+        self._project_records = {}
+        if history:
+            self.history.clear()
+            self.history.extend(history)
+            self.redo_stack.clear()
+        elif snapshot is not None:
+            self.history.append(snapshot)
+            self.redo_stack.clear()
+        else:
             self.save_state()
+        self.setFixedSize(self.sizeHint())
+        self.update()
+        self.modified = False
+        self.zoomChanged.emit(self.zoom_factor)
+        self.documentOpened.emit(file_name)
+
+    def _open_project(self, file_name, background):
+        project = open_project(file_name)
+        if project is None:
+            self.statusMessage.emit(f"Can't open {os.path.basename(file_name)}: not a readable project")
+            return
+        state = project.state
+        if project.format == QImage.Format.Format_ARGB32 and project.width * project.height > LAZY_OPEN_PIXELS:
+            # Like a large TIFF: tiles are decoded as they come into view. The
+            # undo history stays in the file, as it holds whole images
+            self._close_source()
+            self.source = project
+            self.image = QImage(1, 1, QImage.Format.Format_ARGB32)
+            self.history.clear()
+            self._opened(file_name)
+            self._synced(file_name, state)
+            return
+
+        def load(job):
+            try:
+                image = project.decode(job.check)
+                # The stored undo entries; the current state is the image itself
+                history = [(None if meta["kind"] == "current" else history_state(project, meta), meta)
+                           for meta in project.history]
+            finally:
+                project.close()
+            job.check()
+            return image, image.copy(), history
+
+        def loaded(result):
+            image, snapshot, history = result
+            if self.source is not None:
+                self.history.clear()
+            self._close_source()
+            self.image = image
+            entries = [snapshot if entry is None else entry for entry, _ in history]
+            self._opened(file_name, snapshot, entries)
+            self._synced(file_name, state)
+            self._project_records = {id(entry): (entry, meta) for entry, (_, meta) in zip(entries, history)
+                                     if meta["kind"] != "current"}
+        self.run_job("Open", load, loaded, background)
+
+    def _open_frames(self, file_name, count, background):
+        # Show the first frame of a multi-page TIFF or animated GIF; the
+        # others are decoded as they are stepped to
+        stack = FrameStack(file_name, count)
+
+        def loaded(image):
+            # Undo works frame by frame, from the frame as it was opened
+            self.history.clear()
+            self._close_source()
+            self.image = image
+            # A shallow copy: the first edit detaches the document's pixels from it
+            self._opened(file_name, QImage(image), stack=stack)
+            stack.request(0)
+        self.run_job("Open", lambda job: stack.frame(0), loaded, background)
+
+    def _set_stack(self, stack):
+        if self.stack is not None:
+            self.stack.close()
+        self.stack = stack
+        self.frame = 0
+        self.wanted_frame = None
+        self.last_operation = None
+        if stack is not None:
+            stack.ready.connect(self._frame_ready)
+            stack.failed.connect(self._frame_failed)
+        self.frameChanged.emit()
+
+    def show_frame(self, index):
+        # Step a multi-frame document to frame `index`: at once if it is
+        # decoded already, else as soon as the stack's worker has decoded it.
+        # The frame left keeps its edits; undo starts over on each frame
+        if self.stack is None:
+            return
+        if self._busy():
+            # Puts the slider back
+            self.frameChanged.emit()
+            return
+        index = max(0, min(index, self.stack.count - 1))
+        self.wanted_frame = None
+        if index != self.frame:
+            image = self.stack.cached(index)
+            if image is None:
+                self.wanted_frame = index
+            else:
+                self._enter_frame(index, image)
+        # Decode the frames around it ahead, for the next step
+        self.stack.request(index)
+        self.frameChanged.emit()
+
+    def step_frame(self, step):
+        # From the frame stepped to last, which may still be decoding
+        if self.stack is not None:
+            self.show_frame((self.frame if self.wanted_frame is None else self.wanted_frame) + step)
+
+    def _frame_ready(self, index):
+        if index != self.wanted_frame:
+            return
+        image = self.stack.cached(index)
+        if self.job is not None or image is None:
+            # Something started on the frame in view meanwhile, or it was
+            # already dropped from the cache again
+            self.wanted_frame = None
+            self.frameChanged.emit()
+            return
+        self._enter_frame(index, image)
+        self.frameChanged.emit()
+
+    def _frame_failed(self, index, message):
+        if index == self.wanted_frame:
+            self.wanted_frame = None
+            self.statusMessage.emit(f"Can't show frame {index + 1}: {message}")
+            self.frameChanged.emit()
+
+    def _enter_frame(self, index, image):
+        self._keep_frame()
+        size = self.image.size()
+        self.image = image
+        self.frame = index
+        self.history.clear()
+        self.redo_stack.clear()
+        self.history.append(QImage(image))
+        self._history_thumbnails = {}
+        self._proxies.clear()
+        self.end_compare()
+        if image.size() != size:
             self.setFixedSize(self.sizeHint())
-            self.update()
-            self.modified = False
-    
-    def save_image(self, file_name):
-        if file_name:
-            self.image.save(file_name)
-    
-    def flood_fill(self, pos, target_color, fill_color):
-        if target_color == fill_color:
+            self.zoomChanged.emit(self.zoom_factor)
+        self.update()
+
+    def _keep_frame(self):
+        # Hand the frame in view to the stack if it was edited, which shows
+        # as undo steps other than changes to the other frames
+        if any(not (isinstance(state, tuple) and state[0] == "frames") for state in list(self.history)[1:]):
+            self.stack.replace(self.frame, self.image)
+
+    def apply_to_all_frames(self):
+        # Repeat the last edit of the frame in view on all the other frames,
+        # on a pool of processes, as one undo step
+        if self.stack is None or self._busy():
             return
-            
+        operation = self.last_operation
+        if operation is None:
+            self.statusMessage.emit("Crop, rotate, flip, adjust tones, remove a background or filter "
+                                    "this frame first; Apply to All Frames repeats that on the others")
+            return
+        stack = self.stack
+        frames = [(i,) + stack.sources[i] for i in range(stack.count) if i != self.frame]
+        before = {i: stack.sources[i] for i, _, _ in frames}
+        name = FILTER_NAMES[operation[1][0]] if operation[0] == "filter" else OPERATION_NAMES[operation[0]]
+
+        def run(job):
+            start = time.perf_counter()
+            # Edited frames still being written out must be on disk for the workers
+            stack.flush()
+            folder = tempfile.mkdtemp(dir=stack.work_folder())
+            after = apply_to_frames(frames, operation, folder, check=job.check)
+            return after, f"{name} applied to {len(after)} more frames in {time.perf_counter() - start:.1f} s"
+
+        def done(result):
+            after, message = result
+            record = ("frames", (before, after))
+            self._apply_geometry(record)
+            self.history.append(record)
+            self.redo_stack.clear()
+            self.modified = True
+            self.statusMessage.emit(message)
+        self.run_job("Apply to All Frames", run, done)
+
+    def _synced(self, file_name, state):
+        # The document now matches the project file in `state`
+        self._project_sync = (os.path.abspath(file_name), state)
+        self._synced_image = self.image
+        self._dirty_tiles = set()
+        self._saved_tiles = {key: tile.cacheKey() for key, tile in self._overlay.items()}
+
+    def open_mapped(self, file_name, shape=None, dtype=None, offset=0):
+        # View a .npy (or raw, given its geometry) file through a copy-on-write
+        # memory map: nothing is read up front and the OS pages pixels in on demand
+        if self._busy():
+            return
+        arr = open_mapped_array(file_name, shape, dtype, offset)
+        fmt = mapped_qimage_format(arr)
+        if fmt is None:
+            raise ValueError(f"Can't edit {arr.dtype} arrays of shape {arr.shape} in place")
+        self._close_source()
+        self._set_stack(None)
+        self.mapped = arr
+        self._mapped_file = (os.path.abspath(file_name), shape, offset)
+        self.image = wrap_array(arr, fmt)
+        self.history.clear()
+        self.history.append(self._mapped_base())
+        self.redo_stack.clear()
+        self.setFixedSize(self.sizeHint())
+        self.update()
+        self.modified = False
+        self.zoomChanged.emit(self.zoom_factor)
+        self.documentOpened.emit(file_name)
+
+    def _mapped_base(self):
+        # The file as it is on disk as an undo state: a read-only second
+        # mapping instead of a copy of the whole array
+        path, shape, offset = self._mapped_file
+        base = open_mapped_array(path, shape, self.mapped.dtype, offset, mode='r')
+        return wrap_array(base, self.image.format())
+
+    def save_image(self, file_name, background=True):
+        if not file_name or self._busy():
+            return
+        if is_project(file_name):
+            self._save_project(file_name, background)
+            return
+        if self.stack is not None and file_name.lower().endswith(FRAME_EXTENSIONS):
+            self._save_frames(file_name, background)
+            return
+        if self.source is not None:
+            self.run_job("Save", lambda job: self._save_tiled(file_name, job),
+                         lambda _: self.documentSaved.emit(file_name), background, readonly=True)
+            return
+        if self.mapped is not None:
+            path, shape, offset = self._mapped_file
+            if os.path.abspath(file_name) == path:
+                # Write the edited rows back into the mapped file in place
+                if self._dirty_rows is not None:
+                    write_back_rows(self.mapped, path, *self._dirty_rows, shape=shape, offset=offset)
+                    self._dirty_rows = None
+                    # The read-only base mapping now shows the saved pixels, so
+                    # undo restarts from the saved state
+                    self.history.clear()
+                    self.history.append(self._mapped_base())
+                    self.redo_stack.clear()
+                self.documentSaved.emit(file_name)
+                return
+        # Shallow copy: shares the pixels, which stay unchanged while the job runs
+        image = QImage(self.image)
+        mapped = self.mapped
+
+        def write(job):
+            start = time.perf_counter()
+            tmp_name = file_name + ".tmp"
+            description = None
+            ext = os.path.splitext(file_name)[1].lower()
+            if ext == '.npy':
+                with open(tmp_name, 'wb') as f:
+                    np.save(f, mapped if mapped is not None else qimage_view(image, readonly=True))
+            else:
+                if ext == '.png':
+                    # Store gray or few-color images as 8-bit PNGs when that loses nothing
+                    out, description = compact_image(image)
+                else:
+                    out = image
+                job.check(0.5)
+                if not out.save(tmp_name, ext.lstrip('.').upper() or "PNG"):
+                    raise OSError(f"can't write {os.path.basename(file_name)}")
+            try:
+                job.check()
+            except JobCancelled:
+                os.remove(tmp_name)
+                raise
+            os.replace(tmp_name, file_name)
+            return description, time.perf_counter() - start
+
+        def written(result):
+            self._report_saved(file_name, *result)
+            self.documentSaved.emit(file_name)
+        self.run_job("Save", write, written, background, readonly=True)
+
+    def resize_image(self, width, height, method):
+        # Resample the whole document to width x height in the background
+        if self._busy():
+            return False
+        if self.source is not None:
+            self.statusMessage.emit("Resize is not available on tiled images")
+            return False
+        source = QImage(self.image)
+
+        def run(job):
+            start = time.perf_counter()
+            resized = resize_image(source, width, height, method, job.check)
+            return resized, resized.copy(), (f"Resized {source.width()} x {source.height()} to {width} x {height} "
+                                             f"({method}) in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        def done(result):
+            # A new size no longer fits a mapped file, so it becomes a regular image
+            self._commit_work(result)
+            self.setFixedSize(self.sizeHint())
+            self.zoomChanged.emit(self.zoom_factor)
+        self.run_job("Resize", run, done)
+        return True
+
+    def trim_borders(self, background=None, tolerance=0):
+        # Crop to the content that differs from the background color by more
+        # than tolerance (0-255) in some channel; by default the background is
+        # the color of the corners
+        if self._busy():
+            return False
+        if self.source is not None:
+            self.statusMessage.emit("Trim is not available on tiled images")
+            return False
+        start = time.perf_counter()
+        view = qimage_view(self.image, readonly=True)
+        if background is None:
+            value = corner_color(view)
+        else:
+            value = pixel_value(background.getRgb(), self.image.format())
+        scale = 257 if view.dtype == np.uint16 else 1
+        box = content_bbox(view, value, tolerance * scale)
+        elapsed = (time.perf_counter() - start) * 1000
+        size = self.doc_size()
+        if box is None:
+            self.statusMessage.emit("Nothing to trim: the whole image is background")
+            return False
+        if box == (0, 0, size.width(), size.height()):
+            self.statusMessage.emit(f"No border to trim (checked in {elapsed:.1f} ms)")
+            return False
+        self.crop_image(QRect(*box))
+        self.statusMessage.emit(f"Trimmed {size.width()} x {size.height()} to {box[2]} x {box[3]} "
+                                f"(found in {elapsed:.1f} ms)")
+        return True
+
+    def tone_depth(self):
+        # Bits per channel of the document, which sets the tone LUT size
+        return 16 if self.image.format() in (QImage.Format.Format_Grayscale16,
+                                             QImage.Format.Format_RGBA64) else 8
+
+    def tone_channels(self):
+        # Buffer channels tone adjustments change: the color ones, not alpha
+        return rgb_index(self.image.format())
+
+    def set_tone_preview(self, lut):
+        # Show `lut` applied on screen without touching the document (None ends it)
+        self._preview_lut = lut
+        if lut is None:
+            self._proxies.clear()
+        self.update()
+
+    def adjust_tones(self, lut):
+        # Apply a tone LUT to the whole image in the background, as one undo step
+        if self._busy():
+            return
+        if self.source is not None:
+            self.statusMessage.emit("Tone adjustments are not available on tiled images")
+            return
+        source = QImage(self.image)
+        channels = self.tone_channels()
+
+        def adjust(job):
+            start = time.perf_counter()
+            work = QImage(source.size(), source.format())
+            apply_lut(qimage_view(source, readonly=True), lut, channels, out=qimage_view(work), check=job.check)
+            return work, work.copy(), f"Adjusted tones in {(time.perf_counter() - start) * 1000:.0f} ms"
+        self.run_job("Adjust", adjust, lambda result: self._commit_work(result, ("tones", lut)))
+
+    def filter_region(self):
+        # The selection clipped to the image, or the whole image without one
+        bounds = QRect(QPoint(0, 0), self.image.size())
+        if self.selection is not None:
+            rect = self.selection.intersected(bounds)
+            if not rect.isEmpty():
+                return rect
+        return bounds
+
+    def apply_filter(self, kind, radius, amount=1.0, threshold=0):
+        # Run a neighborhood filter over filter_region() in the background; the
+        # undo record keeps only that rectangle, before and after
+        if self._busy():
+            return
+        if self.source is not None:
+            self.statusMessage.emit("Filters are not available on tiled images")
+            return
+        rect = self.filter_region()
+        box = (rect.x(), rect.y(), rect.width(), rect.height())
+        fmt = self.image.format()
+        alpha = 3 if fmt in ALPHA_FORMATS else None
+        # Read straight from the document buffer: it is locked while the job runs
         image = self.image
-        width, height = image.width(), image.height()
-        x, y = pos.x(), pos.y()
-        
-        if not (0 <= x < width and 0 <= y < height):
+        view = qimage_view(image, readonly=True)
+        scale = 257 if view.dtype == np.uint16 else 1
+        label = FILTER_NAMES[kind]
+
+        def run(job):
+            start = time.perf_counter()
+            after = named_filter(view, kind, radius, amount, threshold * scale, box, alpha, job.check)
+            x, y, w, h = box
+            before = view[y:y + h, x:x + w].copy()
+            return (("patch", (x, y, before, after)),
+                    f"{label}: {w} x {h} in {(time.perf_counter() - start) * 1000:.0f} ms")
+        operation = ("filter", (kind, radius, amount, threshold, box))
+        self.run_job(label, run, lambda result: self._commit_patch(result, operation))
+
+    def despeckle(self, background=None, tolerance=0, max_size=20):
+        # Fill the blobs of fewer than max_size pixels that stand out from the
+        # background (None: the corner color) within filter_region(), in the
+        # background; one undo patch like the filters
+        if self._busy():
             return
-            
-        if image.pixelColor(x, y) != target_color:
+        if self.source is not None:
+            self.statusMessage.emit("Despeckle is not available on tiled images")
             return
-        
-        # Use a queue for BFS flood fill and limit the maximum fill area
-        from collections import deque
-        queue = deque([(x, y)])
-        image.setPixelColor(x, y, fill_color)
-        
-        # Maximum pixels to fill (to prevent hanging on large areas)
-        max_fill = width * height  # Never exceed image size
-        filled = 1
-        
-        while queue and filled < max_fill:
-            x, y = queue.popleft()
-            
-            # Check 4 neighbors
-            for dx, dy in [(1, 0), (-1, 0), (0, 1), (0, -1)]:
-                nx, ny = x + dx, y + dy
-                
-                # Check bounds
-                if 0 <= nx < width and 0 <= ny < height:
-                    # Check if pixel matches target color
-                    if image.pixelColor(nx, ny) == target_color:
-                        image.setPixelColor(nx, ny, fill_color)
-                        queue.append((nx, ny))
-                        filled += 1
-                        
-                        # Safety check - if we're filling too much, stop
-                        if filled >= max_fill:
-                            break
+        rect = self.filter_region()
+        box = (rect.x(), rect.y(), rect.width(), rect.height())
+        image = self.image
+        view = qimage_view(image, readonly=True)
+        scale = 257 if view.dtype == np.uint16 else 1
+        value = corner_color(view) if background is None else pixel_value(background.getRgb(), image.format())
+
+        def run(job):
+            start = time.perf_counter()
+            x, y, w, h = box
+            before = view[y:y + h, x:x + w]
+            after = before.copy()
+            removed, pixels = despeckle(after, value, max_size, tolerance * scale, check=job.check)
+            elapsed = (time.perf_counter() - start) * 1000
+            if not removed:
+                return None, f"No specks under {max_size} pixels (checked in {elapsed:.0f} ms)"
+            return (("patch", (x, y, before.copy(), after)),
+                    f"Removed {removed:,} specks ({pixels:,} pixels) in {elapsed:.0f} ms")
+        self.run_job("Despeckle", run, self._commit_patch)
+
+    def _commit_patch(self, result, operation=None):
+        # `operation` is the edit as Apply to All Frames repeats it, if it can
+        record, message = result
+        if record is None:
+            # Nothing changed
+            self.statusMessage.emit(message)
+            return
+        self._apply_geometry(record)
+        self.history.append(record)
+        self.redo_stack.clear()
+        if operation is not None:
+            self.last_operation = operation
+        self.update()
         self.modified = True
+        self.statusMessage.emit(message)
+
+    def history_image(self, index):
+        # (The image as of undo step `index`, its tile hashes or None, the
+        # stored state that can keep them), rebuilt without touching the
+        # document: the nearest stored image at or before it with the records
+        # after that replayed. None for tile states
+        states = list(self.history)
+        base = index
+        while base >= 0 and isinstance(states[base], tuple):
+            base -= 1
+        if base < 0 or isinstance(states[base], dict):
+            return None
+        state = states[base]
+        image = state.unpack() if isinstance(state, PackedImage) else state
+        records = states[base + 1:index + 1]
+        if not records:
+            hashes = getattr(state, '_tile_hashes', None)
+            if hashes is None:
+                return image, None, state
+            grid, stale = hashes
+            if stale:
+                tile_hashes(qimage_view(image, readonly=True), tiles=stale, out=grid)
+                state._tile_hashes = (grid, set())
+            return image, grid, state
+        if isinstance(state, QImage):
+            image = image.copy()
+        for kind, arg in records:
+            view = qimage_view(image)
+            if kind == "patch":
+                x, y, _, after = arg
+                view[y:y + after.shape[0], x:x + after.shape[1]] = after
+            elif kind == "flip":
+                flip(view, arg)
+            elif kind == "rotate":
+                image = wrap_array(rotate90(view, arg), image.format())
+            elif kind == "crop":
+                image = image.copy(QRect(*arg))
+        return image, None, None
+
+    def compare_with_file(self, file_name):
+        # Show where the document differs from another image of the same size
+        fmt = self.image.format()
+
+        def load(job):
+            key = file_key(file_name)
+            other = decode_image(file_name)
+            if other.format() != fmt:
+                other = other.convertToFormat(fmt)
+            hashes = self._file_hashes.get(key)
+            # The file's hashes are kept for comparing with it again
+            return other, hashes, None if hashes is not None else key
+        self._compare(os.path.basename(file_name), load)
+
+    def compare_with_history(self, index):
+        # Show where the document differs from undo step `index`
+        def load(job):
+            result = self.history_image(index)
+            if result is None:
+                raise ValueError("that step can't be compared")
+            return result
+        self._compare(f"step {index}", load)
+
+    def _compare(self, label, load):
+        if self._busy():
+            return
+        if self.source is not None:
+            self.statusMessage.emit("Compare is not available on tiled images")
+            return
+        self.end_compare()
+        image = self.image
+        hashes = self._hashes if self._hashes_image is image else None
+        stale = set(self._stale_hashes)
+
+        def run(job):
+            # `keep` is the history state or file key to remember the other
+            # image's hashes under, if they are worked out here
+            start = time.perf_counter()
+            other, other_hashes, keep = load(job)
+            job.check(0.1)
+            if other.size() != image.size() or other.format() != image.format():
+                raise ValueError(f"{label} is {other.width()} x {other.height()}, "
+                                 f"the image {image.width()} x {image.height()}")
+            view, other_view = qimage_view(image, readonly=True), qimage_view(other, readonly=True)
+            current = hashes
+            if current is None:
+                current = tile_hashes(view)
+            elif stale:
+                tile_hashes(view, tiles=stale, out=current)
+            if other_hashes is None:
+                other_hashes = tile_hashes(other_view, check=lambda f: job.check(0.1 + 0.6 * f))
+                if isinstance(keep, tuple):
+                    self._file_hashes = {keep: other_hashes}
+                elif keep is not None:
+                    keep._tile_hashes = (other_hashes, set())
+            diff = ImageDiff.compare(view, other_view, current, other_hashes,
+                                     check=lambda f: job.check(0.7 + 0.3 * f))
+            return other, current, diff, time.perf_counter() - start
+
+        def done(result):
+            other, current, diff, seconds = result
+            self._hashes, self._hashes_image, self._stale_hashes = current, image, set()
+            self.compare = diff
+            self._compare_image = image
+            self._compare_other = other
+            self._next_difference = 0
+            self.set_compare_blink(self.compare_blink)
+            self.update()
+            if not diff.boxes:
+                self.statusMessage.emit(f"Identical to {label} ({seconds * 1000:.0f} ms)")
+            else:
+                self.statusMessage.emit(f"{diff.pixels:,} pixels differ from {label} in {len(diff.boxes):,} "
+                                        f"regions ({seconds * 1000:.0f} ms); F3 goes to each")
+        self.run_job("Compare", run, done)
+
+    def end_compare(self):
+        if self.compare is None:
+            return
+        self.compare = None
+        self._compare_image = None
+        self._compare_other = None
+        self._heat = {}
+        self._blink_timer.stop()
+        self._blink_other = False
+        self.update()
+
+    def _comparing(self):
+        # Whether the comparison still describes the image on screen
+        return self.compare is not None and self._compare_image is self.image
+
+    def set_compare_blink(self, on):
+        # Alternate between the image and the one compared with, instead of the heatmap
+        self.compare_blink = on
+        self._blink_other = False
+        if on and self._comparing():
+            self._blink_timer.start()
+        else:
+            self._blink_timer.stop()
+        self.update()
+
+    def _blink(self):
+        if not self._comparing():
+            self.end_compare()
+            return
+        self._blink_other = not self._blink_other
+        self.update()
+
+    def show_next_difference(self):
+        # Scroll to the next changed region, largest first
+        if not self._comparing() or not self.compare.boxes:
+            self.statusMessage.emit("No comparison with differences is shown")
+            return
+        boxes = self.compare.boxes
+        i = self._next_difference % len(boxes)
+        self._next_difference = i + 1
+        x, y, w, h = boxes[i]
+        if self._scroll_area is not None:
+            zoom = self.zoom_factor
+            self._scroll_area.ensureVisible(int((x + w / 2) * zoom), int((y + h / 2) * zoom),
+                                            int(w * zoom / 2) + 20, int(h * zoom / 2) + 20)
+        self.statusMessage.emit(f"Region {i + 1} of {len(boxes):,}: {w} x {h} at ({x}, {y})")
+
+    def _paint_heatmap(self, painter, rect):
+        # The changed tiles under the exposed rect, tinted by how much they changed
+        zoom = self.zoom_factor
+        diff = self.compare
+        t = diff.tile
+        x0, y0 = max(0, int(rect.left() / zoom)), max(0, int(rect.top() / zoom))
+        x1 = min(diff.width, int((rect.right() + 1) / zoom) + 1)
+        y1 = min(diff.height, int((rect.bottom() + 1) / zoom) + 1)
+        for ty in range(y0 // t, (y1 - 1) // t + 1):
+            for tx in range(x0 // t, (x1 - 1) // t + 1):
+                d = diff.tiles.get((tx, ty))
+                if d is None:
+                    continue
+                heat = self._heat.get((tx, ty))
+                if heat is None:
+                    heat = self._heat[tx, ty] = wrap_array(diff_heatmap(d))
+                painter.drawImage(QRectF(tx * t * zoom, ty * t * zoom, d.shape[1] * zoom, d.shape[0] * zoom), heat)
+
+    def _paint_difference_boxes(self, painter, rect):
+        # Outlines of the changed regions, at least a few screen pixels across
+        # so single pixels show when zoomed out
+        zoom = self.zoom_factor
+        painter.setBrush(Qt.BrushStyle.NoBrush)
+        painter.setPen(QPen(QColor(255, 0, 255), 1))
+        view = QRectF(rect).adjusted(-3, -3, 3, 3)
+        for x, y, w, h in self.compare.boxes[:2000]:
+            box = QRectF(x * zoom, y * zoom, max(3.0, w * zoom), max(3.0, h * zoom)).adjusted(-1, -1, 1, 1)
+            if box.intersects(view):
+                painter.drawRect(box)
+
+    def export_palette_png(self, file_name, n_colors, dither):
+        # Quantize to an 8-bit palette PNG without changing the document
+        if self.source is not None:
+            self.statusMessage.emit("Palette export is not available on tiled images")
+            return False
+        start = time.perf_counter()
+        image = self.image
+        if image.format() != QImage.Format.Format_ARGB32:
+            image = image.convertToFormat(QImage.Format.Format_ARGB32)
+        palette_image, description = compact_image(image, n_colors, dither)
+        if not palette_image.save(file_name):
+            return False
+        self._report_saved(file_name, description, time.perf_counter() - start)
+        return True
+
+    def _save_project(self, file_name, background):
+        # Write only the tiles edited since the project was opened or last
+        # saved; any other target gets every tile compared with what it holds
+        path = os.path.abspath(file_name)
+        since = self._project_sync[1] if self._project_sync and self._project_sync[0] == path else None
+        size = self.doc_size()
+        history = []
+        if self.source is not None:
+            fmt = QImage.Format.Format_ARGB32
+            read = self.read_document_region
+            # Overlay tiles painted on since they were saved, and saved ones
+            # undone back to the file's pixels
+            changed = {key for key, tile in self._overlay.items() if self._saved_tiles.get(key) != tile.cacheKey()}
+            changed |= self._saved_tiles.keys() - self._overlay.keys()
+            dirty = []
+            for tx, ty in changed:
+                x, y = tx * OVERLAY_TILE, ty * OVERLAY_TILE
+                dirty += project_tiles(x, y, min(OVERLAY_TILE, size.width() - x), min(OVERLAY_TILE, size.height() - y))
+        else:
+            # Shallow copy: shares the pixels, which stay unchanged while the job runs
+            image = QImage(self.image)
+            fmt = image.format()
+            view = qimage_view(image, readonly=True)
+
+            def read(x, y, w, h):
+                return view[y:y + h, x:x + w]
+            trusted = self._dirty_tiles is not None and self.image is self._synced_image
+            dirty = list(self._dirty_tiles) if trusted else None
+            if self.save_history:
+                history = list(self.history)
+        records = dict(self._project_records) if since is not None else {}
+
+        def write(job):
+            start = time.perf_counter()
+            stored = []
+            for i, entry in enumerate(history):
+                carried = records.get(id(entry))
+                if carried is not None and carried[0] is entry:
+                    stored.append((carried[1], None))
+                elif i == len(history) - 1 and not isinstance(entry, tuple):
+                    # The newest snapshot is the document itself
+                    stored.append(({"kind": "current"}, []))
+                else:
+                    record = history_record(entry)
+                    if record is None:
+                        stored = []
+                        break
+                    stored.append(record)
+                job.check()
+            result = save_project(file_name, size.width(), size.height(), fmt, read, dirty, since,
+                                  stored, job.check)
+            return result, time.perf_counter() - start
+
+        def written(result):
+            (state, index, chunks, written, compacted), seconds = result
+            self._synced(file_name, state)
+            self._project_records = {id(entry): (entry, meta) for entry, meta in zip(history, index["history"])
+                                     if meta["kind"] != "current"}
+            text = (f"Saved {os.path.basename(file_name)}: {chunks} tiles changed, {format_bytes(written)} "
+                    f"written in {seconds * 1000:.0f} ms")
+            if compacted:
+                text += f", compacted to {format_bytes(os.path.getsize(file_name))}"
+            self.statusMessage.emit(text)
+            self.documentSaved.emit(file_name)
+        self.run_job("Save", write, written, background, readonly=True)
+
+    def _save_frames(self, file_name, background):
+        # Write every frame to a multi-page TIFF or animated GIF: the one in
+        # view as it is, the others from the stack one at a time
+        stack = self.stack
+        image = QImage(self.image)
+        index = self.frame
+        fmt = "GIF" if file_name.lower().endswith(".gif") else "TIFF"
+
+        def write(job):
+            start = time.perf_counter()
+            tmp_name = file_name + ".tmp"
+            # Frame durations carry over from a GIF
+            delays = stack.gif_delays() if fmt == "GIF" and stack.path.lower().endswith(".gif") else None
+            try:
+                save_frames(tmp_name, stack.count, lambda i: image if i == index else stack.frame(i),
+                            fmt, delays, job.check)
+                job.check()
+            except BaseException:
+                if os.path.exists(tmp_name):
+                    os.remove(tmp_name)
+                raise
+            os.replace(tmp_name, file_name)
+            return time.perf_counter() - start
+
+        def written(result):
+            if os.path.abspath(file_name) == os.path.abspath(stack.path):
+                # The frames are read from the saved file now, so the edits
+                # before it can't be undone: undo restarts from the saved state
+                self._keep_frame()
+                stack.rebase(file_name)
+                self.history.clear()
+                self.history.append(QImage(self.image))
+                self.redo_stack.clear()
+            self.statusMessage.emit(f"Saved {os.path.basename(file_name)}: {format_bytes(os.path.getsize(file_name))}, "
+                                    f"{stack.count} frames in {result:.1f} s")
+            self.documentSaved.emit(file_name)
+        self.run_job("Save", write, written, background, readonly=True)
+
+    def _report_saved(self, file_name, description, seconds):
+        size = os.path.getsize(file_name)
+        depth = self.image.depth()
+        raw = self.image.width() * self.image.height() * depth // 8
+        text = f"Saved {os.path.basename(file_name)}: {format_bytes(size)}"
+        if description:
+            text += f" as {description}"
+        text += f" in {seconds * 1000:.0f} ms ({format_bytes(raw)} as raw {depth}-bit pixels)"
+        self.statusMessage.emit(text)
+
+    def _save_tiled(self, file_name, job):
+        size = self.doc_size()
+        # Write next to the target first: the target may be the file we are reading from
+        tmp_name = file_name + ".tmp"
+        try:
+            if os.path.splitext(file_name)[1].lower() in ('.tif', '.tiff'):
+                total = size.width() * size.height()
+
+                def read_tile(x, y, w, h):
+                    job.check((y * size.width() + x * h) / total)
+                    return self.read_document_region(x, y, w, h)
+                write_tiled_tiff(tmp_name, size.width(), size.height(), read_tile, tile_size=OVERLAY_TILE)
+            else:
+                # Other formats need the whole image decoded at once
+                full = self.read_document_region(0, 0, size.width(), size.height())
+                ext = os.path.splitext(file_name)[1].lstrip('.').upper() or "PNG"
+                job.check()
+                if not wrap_array(full).save(tmp_name, ext):
+                    raise OSError(f"can't write {os.path.basename(file_name)}")
+            job.check()
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        os.replace(tmp_name, file_name)
+
+    def read_document_region(self, x, y, w, h):
+        # Level-0 pixels of a lazily read image with the edited tiles applied (BGRA
+        # array). Save jobs call this off the GUI thread, and undo snapshots share
+        # the tiles, so they are only ever read here
+        region = self.source.read_region(0, x, y, w, h)
+        for ty in range(y // OVERLAY_TILE, (y + h - 1) // OVERLAY_TILE + 1):
+            for tx in range(x // OVERLAY_TILE, (x + w - 1) // OVERLAY_TILE + 1):
+                tile = self._overlay.get((tx, ty))
+                if tile is None:
+                    continue
+                ox, oy = tx * OVERLAY_TILE, ty * OVERLAY_TILE
+                ix0, iy0 = max(x, ox), max(y, oy)
+                ix1 = min(x + w, ox + tile.width())
+                iy1 = min(y + h, oy + tile.height())
+                if ix1 > ix0 and iy1 > iy0:
+                    region[iy0 - y:iy1 - y, ix0 - x:ix1 - x] = \
+                        qimage_view(tile, readonly=True)[iy0 - oy:iy1 - oy, ix0 - ox:ix1 - ox]
+        return region
+
+    def _overlay_tile(self, tx, ty):
+        # Full-resolution editable copy of one tile of a lazily read image
+        tile = self._overlay.get((tx, ty))
+        if tile is None:
+            x, y = tx * OVERLAY_TILE, ty * OVERLAY_TILE
+            w = min(OVERLAY_TILE, self.source.width - x)
+            h = min(OVERLAY_TILE, self.source.height - y)
+            tile = array_to_qimage(self.source.read_region(0, x, y, w, h))
+            self._overlay[(tx, ty)] = tile
+        return tile
+
+    def _paint_image(self, draw, rect):
+        # Run draw(painter) on the document in image coordinates; lazily read
+        # images get the strokes in the overlay tiles that `rect` touches
+        if self.source is None:
+            self._mark_dirty(rect)
+            painter = QPainter(self.image)
+            painter.setRenderHint(QPainter.RenderHint.Antialiasing, True)
+            draw(painter)
+            painter.end()
+            return
+        rect = rect.intersected(QRect(QPoint(0, 0), self.doc_size()))
+        if rect.isEmpty():
+            return
+        for ty in range(rect.top() // OVERLAY_TILE, rect.bottom() // OVERLAY_TILE + 1):
+            for tx in range(rect.left() // OVERLAY_TILE, rect.right() // OVERLAY_TILE + 1):
+                painter = QPainter(self._overlay_tile(tx, ty))
+                painter.setRenderHint(QPainter.RenderHint.Antialiasing, True)
+                painter.translate(-tx * OVERLAY_TILE, -ty * OVERLAY_TILE)
+                draw(painter)
+                painter.end()
+
+    def _stroke_rect(self, p1, p2):
+        # Image-space bounds of a pen stroke between two points
+        pad = self.brush_size // 2 + 2
+        return QRect(p1, p2).normalized().adjusted(-pad, -pad, pad, pad)
+    
+    def flood_fill(self, pos, fill_color):
+        # Fill a copy in the background; the result replaces the image as one step
+        source = QImage(self.image)
+        value = pixel_value(fill_color.getRgb(), source.format())
+        x, y = pos.x(), pos.y()
+
+        def fill(job):
+            work = source.copy()
+            count = flood_fill(qimage_view(work), x, y, value, job.check)
+            # The undo snapshot is copied here too, off the GUI thread
+            return work, work.copy(), f"Filled {count:,} pixels"
+        self.run_job("Fill", fill, self._commit_work)
 
     def make_color_transparent(self, target_color: QColor):
-        # Remove background by setting alpha to 0 where RGB matches target
-        r_t, g_t, b_t = target_color.red(), target_color.green(), target_color.blue()
-        width, height = self.image.width(), self.image.height()
-        transparent = QColor(0, 0, 0, 0)
-        for y in range(height):
-            for x in range(width):
-                c = self.image.pixelColor(x, y)
-                if c.red() == r_t and c.green() == g_t and c.blue() == b_t:
-                    self.image.setPixelColor(x, y, transparent)
+        # Remove background by clearing every pixel whose RGB matches target
+        source = QImage(self.image)
+
+        def clear(job):
+            work = with_alpha(source)
+            scale = 257 if work.format() == QImage.Format.Format_RGBA64 else 1
+            rgb = (target_color.red() * scale, target_color.green() * scale, target_color.blue() * scale)
+            count = make_transparent(qimage_view(work), rgb, rgb_index(work.format()), job.check)
+            return work, work.copy(), f"Made {count:,} pixels transparent"
+        operation = ("removebg", (target_color.red(), target_color.green(), target_color.blue()))
+        self.run_job("Remove BG", clear, lambda result: self._commit_work(result, operation))
+
+    def _commit_work(self, result, operation=None):
+        # Swap in the finished copy of a background edit, and its undo
+        # snapshot, as a single step; `operation` as for _commit_patch()
+        work, snapshot, message = result
+        self._mark_dirty()
+        if (self.mapped is not None and work.size() == self.image.size()
+                and work.format() == self.image.format()):
+            qimage_view(self.image)[...] = qimage_view(work, readonly=True)
+        else:
+            self._close_source()
+            self.image = work
+        self.history.append(snapshot)
+        self.redo_stack.clear()
+        if operation is not None:
+            self.last_operation = operation
+        self.update()
         self.modified = True
-    
+        self.statusMessage.emit(message)
+
+    def run_job(self, label, func, on_done, background=True, readonly=False):
+        # Run func(job) on a worker thread against data the caller has set aside;
+        # on_done(result) then commits it on the GUI thread unless cancelled
+        job = Job(label, func, readonly)
+        if not background:
+            try:
+                result = job.run_here()
+            except Exception as e:
+                self.statusMessage.emit(f"{label} failed: {e}")
+                return None
+            on_done(result)
+            return None
+        job.done.connect(lambda result: self._job_done(job, on_done, result))
+        job.failed.connect(lambda text: self._job_ended(job, f"{label} failed: {text}"))
+        self.job = job
+        self.jobStarted.emit(job)
+        job.start()
+        return job
+
+    def cancel_job(self):
+        job = self.job
+        if job is not None:
+            job.cancel()
+            self._job_ended(job, f"{job.label} cancelled")
+
+    def finish_job(self):
+        # Wait for the running job and deliver its result (or failure) now
+        job = self.job
+        if job is not None:
+            job.wait()
+            QApplication.sendPostedEvents(None, QEvent.Type.MetaCall)
+
+    def end_job(self):
+        # Before the document goes away: a save is left to finish, anything
+        # else is cancelled
+        job = self.job
+        if job is None:
+            return
+        if job.readonly:
+            self.finish_job()
+        else:
+            self.cancel_job()
+            job.wait()
+
+    def _job_ended(self, job, message=None):
+        if job is not self.job:
+            return
+        self.job = None
+        self.jobEnded.emit()
+        if message:
+            self.statusMessage.emit(message)
+
+    def _job_done(self, job, on_done, result):
+        if job is not self.job or job.cancelled:
+            return
+        self._job_ended(job)
+        on_done(result)
+
+    def _busy(self):
+        # While a background job owns the document, refuse other edits
+        if self.job is None:
+            return False
+        self.statusMessage.emit(f"{self.job.label} is still running (Esc cancels)")
+        return True
+
     def paintEvent(self, event):
         painter = QPainter(self)
-        # Draw the scaled image
-        scaled_image = self.image.scaled(
-            int(self.image.width() * self.zoom_factor),
-            int(self.image.height() * self.zoom_factor),
-            Qt.AspectRatioMode.IgnoreAspectRatio,
-            Qt.TransformationMode.SmoothTransformation
-        )
-        painter.drawImage(QPoint(0, 0), scaled_image)
+        # A diagonal scroll exposes an L-shaped region; paint its strips one by
+        # one instead of their bounding rect
+        for rect in region_rects(event.region()):
+            # Opaque widget: fill in the backdrop behind transparent pixels ourselves
+            painter.fillRect(rect, self.palette().window())
+            if self.source is not None:
+                self._paint_tiled(painter, rect)
+            elif self._preview_lut is not None:
+                self._paint_preview(painter, rect)
+            elif (self._gradient_start is not None and self._line_preview is not None
+                  and self._gradient_area is not False):
+                self._paint_gradient_preview(painter, rect)
+            elif self._comparing():
+                if self._blink_other:
+                    self._paint_exposed(painter, rect, self._compare_other)
+                else:
+                    self._paint_exposed(painter, rect)
+                    if not self.compare_blink:
+                        self._paint_heatmap(painter, rect)
+            else:
+                self._paint_exposed(painter, rect)
+        if self._comparing():
+            self._paint_difference_boxes(painter, event.rect())
         
         # Draw line preview if in line mode and drawing
         if (self.current_tool == "line" and hasattr(self, '_line_preview') and 
@@ -318,6 +1945,38 @@ class Canvas(QWidget):
             
             rect = QRect(QPoint(start_x, start_y), QPoint(end_x, end_y)).normalized()
             painter.drawEllipse(rect)
+
+        # Crop preview
+        elif self.current_tool == "crop" and self._crop_start is not None and self._line_preview is not None and self.drawing:
+            painter.setPen(QPen(Qt.GlobalColor.black, 1, Qt.PenStyle.DashLine))
+            painter.setBrush(Qt.BrushStyle.NoBrush)
+            start = self._crop_start * self.zoom_factor
+            end = self._line_preview * self.zoom_factor
+            painter.drawRect(QRect(start, end).normalized())
+        elif self._gradient_start is not None and self._line_preview is not None:
+            # The gradient vector, over its preview
+            zoom = self.zoom_factor
+            start = QPoint(int(self._gradient_start[0] * zoom), int(self._gradient_start[1] * zoom))
+            end = QPoint(int((self._line_preview.x() + 0.5) * zoom), int((self._line_preview.y() + 0.5) * zoom))
+            painter.setBrush(Qt.BrushStyle.NoBrush)
+            for color, width in ((Qt.GlobalColor.white, 3), (Qt.GlobalColor.black, 1)):
+                painter.setPen(QPen(color, width))
+                painter.drawLine(start, end)
+                painter.drawEllipse(start, 3, 3)
+
+        # Selection outline, or the rectangle being dragged out
+        if self.current_tool == "select" and self._select_start is not None and self._line_preview is not None:
+            selection = QRect(self._select_start, self._line_preview).normalized()
+        else:
+            selection = self.selection
+        if selection is not None:
+            painter.setBrush(Qt.BrushStyle.NoBrush)
+            outline = QRectF(selection.x() * self.zoom_factor, selection.y() * self.zoom_factor,
+                             selection.width() * self.zoom_factor, selection.height() * self.zoom_factor)
+            painter.setPen(QPen(Qt.GlobalColor.white, 1))
+            painter.drawRect(outline)
+            painter.setPen(QPen(Qt.GlobalColor.black, 1, Qt.PenStyle.DashLine))
+            painter.drawRect(outline)
         
         # Draw cursor/overlay preview
         if self.underMouse() and hasattr(self, 'current_tool'):
@@ -332,6 +1991,207 @@ class Canvas(QWidget):
                     y = int(pos.y() - brush_size / 2)
                     painter.drawEllipse(x, y, brush_size, brush_size)
     
+    def _paint_tiled(self, painter, rect):
+        # Draw only the exposed part of a lazily read image, from the pyramid
+        # level that best matches the zoom, with edited tiles on top
+        zoom = self.zoom_factor
+        size = self.doc_size()
+        x0 = max(0, int(rect.left() / zoom))
+        y0 = max(0, int(rect.top() / zoom))
+        x1 = min(size.width(), int((rect.right() + 1) / zoom) + 1)
+        y1 = min(size.height(), int((rect.bottom() + 1) / zoom) + 1)
+        if x1 <= x0 or y1 <= y0:
+            return
+        level_index = self.source.level_for_scale(zoom)
+        level = self.source.levels[level_index]
+        ds = level.downsample
+        lx0, ly0 = int(x0 / ds), int(y0 / ds)
+        lx1 = min(level.width, int(x1 / ds) + 1)
+        ly1 = min(level.height, int(y1 / ds) + 1)
+        # Skip pixels when even the best level has far more detail than the screen
+        step = max(1, int(1.0 / (zoom * ds)))
+        region = self.source.read_region(level_index, lx0, ly0, lx1 - lx0, ly1 - ly0, step)
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform, True)
+        scale = ds * zoom
+        painter.drawImage(QRectF(lx0 * scale, ly0 * scale, (lx1 - lx0) * scale, (ly1 - ly0) * scale),
+                          wrap_array(region))
+
+        for ty in range(y0 // OVERLAY_TILE, (y1 - 1) // OVERLAY_TILE + 1):
+            for tx in range(x0 // OVERLAY_TILE, (x1 - 1) // OVERLAY_TILE + 1):
+                tile = self._overlay.get((tx, ty))
+                if tile is not None:
+                    painter.drawImage(QRectF(tx * OVERLAY_TILE * zoom, ty * OVERLAY_TILE * zoom,
+                                             tile.width() * zoom, tile.height() * zoom), tile)
+
+    def _paint_exposed(self, painter, rect, image=None):
+        # Scale only the part of the image (or `image`) under the exposed rect.
+        # A small margin keeps the smooth scaling seamless across partial
+        # repaints, and mapped arrays only get the on-screen pages touched.
+        image = self.image if image is None else image
+        zoom = self.zoom_factor
+        x0 = max(0, int(rect.left() / zoom) - 2)
+        y0 = max(0, int(rect.top() / zoom) - 2)
+        x1 = min(image.width(), int((rect.right() + 1) / zoom) + 3)
+        y1 = min(image.height(), int((rect.bottom() + 1) / zoom) + 3)
+        if x1 <= x0 or y1 <= y0:
+            return
+        tx0, ty0 = int(x0 * zoom), int(y0 * zoom)
+        piece = image.copy(x0, y0, x1 - x0, y1 - y0)
+        if piece.format() not in DISPLAY_FORMATS:
+            # Gray, 24-bit and 16-bit documents are converted for display only,
+            # and only the part on screen
+            piece = piece.convertToFormat(QImage.Format.Format_ARGB32_Premultiplied)
+        scaled = piece.scaled(
+            int(x1 * zoom) - tx0, int(y1 * zoom) - ty0,
+            Qt.AspectRatioMode.IgnoreAspectRatio,
+            Qt.TransformationMode.SmoothTransformation
+        )
+        painter.save()
+        painter.setClipRect(rect)
+        painter.drawImage(QPoint(tx0, ty0), scaled)
+        painter.restore()
+
+    def _proxy(self, rect):
+        # (block, x0, y0, x1, y1, step): the image under the exposed rect
+        # sampled at about screen resolution, or None. Previews work on this
+        # small copy, so their cost follows the window size rather than the
+        # image size
+        zoom = self.zoom_factor
+        step = max(1, int(1 / zoom))
+        x0 = max(0, int(rect.left() / zoom) - 2) // step * step
+        y0 = max(0, int(rect.top() / zoom) - 2) // step * step
+        x1 = min(self.image.width(), int((rect.right() + 1) / zoom) + 3)
+        y1 = min(self.image.height(), int((rect.bottom() + 1) / zoom) + 3)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        key = (x0, y0, x1, y1, step, self.image.cacheKey())
+        block = self._proxies.get(key)
+        if block is None:
+            # Sampled once; moving a slider or dragging then only redoes this
+            block = np.ascontiguousarray(qimage_view(self.image, readonly=True)[y0:y1:step, x0:x1:step])
+            if len(self._proxies) > 8:
+                self._proxies.clear()
+            self._proxies[key] = block
+        return block, x0, y0, x1, y1, step
+
+    def _paint_proxy(self, painter, rect, pixels, x0, y0, x1, y1, step):
+        # Draw a processed proxy from _proxy() over the exposed rect
+        zoom = self.zoom_factor
+        piece = wrap_array(pixels, self.image.format())
+        if piece.format() not in DISPLAY_FORMATS:
+            piece = piece.convertToFormat(QImage.Format.Format_ARGB32_Premultiplied)
+        tx0, ty0 = int(x0 * zoom), int(y0 * zoom)
+        size = QSize(int(x1 * zoom) - tx0, int(y1 * zoom) - ty0)
+        # A sampled proxy is already about screen size; only magnified views
+        # need the smooth filter the regular paint uses
+        mode = Qt.TransformationMode.FastTransformation if step > 1 else Qt.TransformationMode.SmoothTransformation
+        scaled = piece if piece.size() == size else piece.scaled(size, Qt.AspectRatioMode.IgnoreAspectRatio, mode)
+        painter.save()
+        painter.setClipRect(rect)
+        painter.drawImage(QPoint(tx0, ty0), scaled)
+        painter.restore()
+
+    def _paint_preview(self, painter, rect):
+        # The exposed part of the image with the previewed tone LUT applied to a proxy
+        proxy = self._proxy(rect)
+        if proxy is None:
+            return
+        block = proxy[0]
+        pixels = apply_lut(block, self._preview_lut, self.tone_channels(), out=np.empty_like(block))
+        self._paint_proxy(painter, rect, pixels, *proxy[1:])
+
+    def _paint_gradient_preview(self, painter, rect):
+        # The gradient being dragged out, painted on a proxy of the exposed part
+        proxy = self._proxy(rect)
+        if proxy is None:
+            return
+        block, x0, y0, x1, y1, step = proxy
+        pixels = block.copy()
+        stops, alpha = self._gradient_stops()
+        mask = None
+        if self._gradient_area is not None:
+            # The area's mask at the proxy's sample points
+            (bx, by, bw, bh), area = self._gradient_area
+            cols = np.arange(x0, x1, step) - bx
+            rows = np.arange(y0, y1, step) - by
+            in_cols = (cols >= 0) & (cols < bw)
+            in_rows = (rows >= 0) & (rows < bh)
+            mask = np.zeros(block.shape[:2], bool)
+            mask[np.ix_(in_rows, in_cols)] = area[np.ix_(rows[in_rows], cols[in_cols])]
+        gradient_fill(pixels, self.gradient_kind, self._gradient_start, self._gradient_end(self._line_preview),
+                      stops, alpha, mask, origin=(x0, y0), step=step)
+        self._paint_proxy(painter, rect, pixels, x0, y0, x1, y1, step)
+
+    def _gradient_stops(self):
+        # The gradient tool's stops for gradient_fill(), in the document's
+        # buffer layout, and the alpha channel they composite over
+        fmt = self.image.format()
+        stops = [(pos, pixel_value(color.getRgb()[:3] + (255,), fmt), color.alphaF())
+                 for pos, color in sorted(self.gradient_stops, key=lambda stop: stop[0])]
+        alpha = 3 if fmt in ALPHA_FORMATS else None
+        return stops, alpha
+
+    @staticmethod
+    def _gradient_end(point):
+        # Gradients run between pixel centers
+        return (point.x() + 0.5, point.y() + 0.5)
+
+    def begin_gradient(self, pos):
+        # Start dragging out a gradient at `pos`. With gradient_region set only
+        # the area Fill would fill from there gets it; that is found in the
+        # background meanwhile, and the preview waits for it
+        start = self._gradient_start = self._gradient_end(pos)
+        self._gradient_area = None
+        self._gradient_pending = None
+        if not self.gradient_region:
+            return
+        self._gradient_area = False
+        view = qimage_view(self.image, readonly=True)
+        x, y = pos.x(), pos.y()
+
+        def found(area):
+            if self._gradient_start is not start:
+                return
+            self._gradient_area = area
+            if self._gradient_pending is not None:
+                self.fill_gradient(self._gradient_pending)
+            else:
+                self.update()
+        self.run_job("Find area", lambda job: fill_region(view, x, y, job.check), found)
+
+    def fill_gradient(self, end):
+        # Paint the dragged-out gradient at full resolution in the background,
+        # over the whole image or its area; undo keeps only the painted rectangle
+        start, area = self._gradient_start, self._gradient_area
+        if area is False and self.job is not None:
+            # Painted once the area has been found
+            self._gradient_pending = end
+            return
+        self._gradient_start = None
+        self._gradient_area = None
+        self._gradient_pending = None
+        if start is None or area is False or self._busy():
+            return
+        if area is None:
+            box, mask = (0, 0, self.image.width(), self.image.height()), None
+        else:
+            box, mask = area
+        kind = self.gradient_kind
+        stops, alpha = self._gradient_stops()
+        end = self._gradient_end(end)
+        # Read straight from the document buffer: it is locked while the job runs
+        view = qimage_view(self.image, readonly=True)
+
+        def run(job):
+            t0 = time.perf_counter()
+            x, y, w, h = box
+            after = view[y:y + h, x:x + w].copy()
+            gradient_fill(after, kind, start, end, stops, alpha, mask, origin=(x, y), check=job.check)
+            before = view[y:y + h, x:x + w].copy()
+            return (("patch", (x, y, before, after)),
+                    f"Gradient: {w} x {h} in {(time.perf_counter() - t0) * 1000:.0f} ms")
+        self.run_job("Gradient", run, self._commit_patch)
+
     def mousePressEvent(self, event):
         if event.button() in (Qt.MouseButton.MiddleButton, Qt.MouseButton.RightButton):
             # Start panning with middle or right mouse button
@@ -345,19 +2205,27 @@ class Canvas(QWidget):
             pos = event.position().toPoint()
             canvas_pos = self.mapToCanvas(pos)
             
+            if self.current_tool in ("bucket", "removebg", "gradient") and self.source is not None:
+                self.statusMessage.emit("Fill, Gradient and Remove BG are not available on tiled images")
+                return
+
+            if self.current_tool == "eyedrop":
+                # Average over the brush size rather than a single pixel
+                color = self.average_color(canvas_pos, max(1, self.brush_size))
+                if color is not None:
+                    self.set_brush_color(color)
+                    self.colorPicked.emit(color)
+                return
+
+            if self._busy():
+                return
+
             if self.current_tool == "bucket":
-                self.save_state()
-                target_color = self.image.pixelColor(canvas_pos.x(), canvas_pos.y())
-                self.flood_fill(canvas_pos, target_color, self.brush_color)
-                self.update()
-                self.modified = True
+                self.flood_fill(canvas_pos, self.brush_color)
             elif self.current_tool == "removebg":
-                self.save_state()
                 target_color = self.image.pixelColor(canvas_pos.x(), canvas_pos.y())
                 self.make_color_transparent(target_color)
                 self.drawing = False
-                self.update()
-                self.modified = True
             elif self.current_tool == "line":
                 # Store the starting point in image coordinates
                 self._line_start = canvas_pos
@@ -376,10 +2244,24 @@ class Canvas(QWidget):
                 self._line_preview = canvas_pos  # Reuse for preview
                 self.drawing = True
                 self.update()
+            elif self.current_tool == "crop":
+                self._crop_start = canvas_pos
+                self._line_preview = canvas_pos
+                self.drawing = True
+            elif self.current_tool == "gradient":
+                self.begin_gradient(canvas_pos)
+                self._line_preview = canvas_pos
+                self.drawing = True
+                self.update()
+            elif self.current_tool == "select":
+                self._select_start = canvas_pos
+                self._line_preview = canvas_pos
+                self.drawing = True
+                self.update()
             elif self.current_tool in ["brush", "eraser"]:
                 self.drawing = True
                 self.last_point = canvas_pos
-                self.save_state()
+                self._begin_stroke(event.position(), 1.0)
     
     def mouseMoveEvent(self, event):
         if self._panning and self._scroll_area is not None and event.buttons() & (Qt.MouseButton.MiddleButton | Qt.MouseButton.RightButton):
@@ -400,24 +2282,17 @@ class Canvas(QWidget):
             return
             
         current_point = self.mapToCanvas(event.position().toPoint())
+
+        if self.current_tool in ("bucket", "removebg") and not event.buttons():
+            self._report_affected(current_point)
+            return
         
         if not (event.buttons() & Qt.MouseButton.LeftButton) or not self.drawing:
             return
             
-        if self.current_tool == "brush":
-            painter = QPainter(self.image)
-            painter.setRenderHint(QPainter.RenderHint.Antialiasing, True)
-            width = self.brush_size
-            pen = QPen(self.brush_color, width,
-                      Qt.PenStyle.SolidLine,
-                      Qt.PenCapStyle.RoundCap,
-                      Qt.PenJoinStyle.RoundJoin)
-            painter.setPen(pen)
-            painter.drawLine(self.last_point, current_point)
-            painter.end()
+        if self.current_tool in ["brush", "eraser"]:
+            self._continue_stroke(event.position(), 1.0)
             self.last_point = current_point
-            self.update()
-            self.modified = True
             
         elif self.current_tool == "line":
             # Update preview endpoint and repaint overlay
@@ -435,19 +2310,10 @@ class Canvas(QWidget):
             self.update()
             return
 
-        elif self.current_tool == "eraser":
-            painter = QPainter(self.image)
-            painter.setRenderHint(QPainter.RenderHint.Antialiasing, True)
-            pen = QPen(Qt.GlobalColor.white, self.brush_size, 
-                      Qt.PenStyle.SolidLine, 
-                      Qt.PenCapStyle.RoundCap, 
-                      Qt.PenJoinStyle.RoundJoin)
-            painter.setPen(pen)
-            painter.drawLine(self.last_point, current_point)
-            painter.end()
-            self.last_point = current_point
+        elif self.current_tool in ("crop", "select", "gradient"):
+            self._line_preview = current_point
             self.update()
-            self.modified = True
+            return
     
     def mouseReleaseEvent(self, event):
         if self._panning and event.button() in (Qt.MouseButton.MiddleButton, Qt.MouseButton.RightButton):
@@ -461,61 +2327,157 @@ class Canvas(QWidget):
             if self.current_tool == "line" and hasattr(self, '_line_start'):
                 # Commit the line to the image
                 end_point = self.mapToCanvas(event.position().toPoint())
-                painter = QPainter(self.image)
-                painter.setRenderHint(QPainter.RenderHint.Antialiasing, True)
                 pen = QPen(self.brush_color, self.brush_size,
                           Qt.PenStyle.SolidLine,
                           Qt.PenCapStyle.RoundCap)
-                painter.setPen(pen)
-                painter.drawLine(self._line_start, end_point)
-                painter.end()
+                start = self._line_start
+
+                def draw(painter):
+                    painter.setPen(pen)
+                    painter.drawLine(start, end_point)
+                self._paint_image(draw, self._stroke_rect(start, end_point))
                 self.modified = True
                 self.save_state()
             elif self.current_tool == "square" and hasattr(self, '_square_start'):
                 # Commit the square to the image
                 end_point = self.mapToCanvas(event.position().toPoint())
-                painter = QPainter(self.image)
-                painter.setRenderHint(QPainter.RenderHint.Antialiasing, True)
                 pen = QPen(self.brush_color, self.brush_size,
                           Qt.PenStyle.SolidLine,
                           Qt.PenCapStyle.SquareCap)
-                painter.setPen(pen)
                 # Calculate rectangle from start and end points
                 rect = QRect(self._square_start, end_point).normalized()
-                painter.drawRect(rect)
-                painter.end()
+
+                def draw(painter):
+                    painter.setPen(pen)
+                    painter.drawRect(rect)
+                self._paint_image(draw, self._stroke_rect(self._square_start, end_point))
                 self.modified = True
                 self.save_state()
             elif self.current_tool == "circle" and hasattr(self, '_circle_start'):
                 # Commit the circle to the image
                 end_point = self.mapToCanvas(event.position().toPoint())
-                painter = QPainter(self.image)
-                painter.setRenderHint(QPainter.RenderHint.Antialiasing, True)
                 pen = QPen(self.brush_color, self.brush_size,
                           Qt.PenStyle.SolidLine,
                           Qt.PenCapStyle.RoundCap)
-                painter.setPen(pen)
                 # Calculate rectangle that bounds the circle
                 rect = QRect(self._circle_start, end_point).normalized()
-                painter.drawEllipse(rect)
-                painter.end()
+
+                def draw(painter):
+                    painter.setPen(pen)
+                    painter.drawEllipse(rect)
+                self._paint_image(draw, self._stroke_rect(self._circle_start, end_point))
                 self.modified = True
                 self.save_state()
+            elif self.current_tool == "crop" and self._crop_start is not None:
+                end_point = self.mapToCanvas(event.position().toPoint())
+                # Pixels under both the start and end point are kept
+                self.crop_image(QRect(self._crop_start, end_point))
+                self._crop_start = None
+            elif self.current_tool == "gradient" and self._gradient_start is not None:
+                self.fill_gradient(self.mapToCanvas(event.position().toPoint()))
+            elif self.current_tool == "select" and self._select_start is not None:
+                end_point = self.mapToCanvas(event.position().toPoint())
+                rect = QRect(self._select_start, end_point).normalized().intersected(
+                    QRect(QPoint(0, 0), self.doc_size()))
+                # A click without a drag clears the selection
+                self.selection = rect if rect.width() > 1 and rect.height() > 1 else None
+                self._select_start = None
+                self.update()
             
             # Clean up
             if hasattr(self, '_line_preview'):
                 self._line_preview = None
+            self._end_stroke()
             self.drawing = False
             self.update()
     
+    def _edit_regions(self, rect):
+        # Writable pixel blocks (array view, x, y) that cover an image rect:
+        # the image itself, or the overlay tiles of a lazily read image
+        rect = rect.intersected(QRect(QPoint(0, 0), self.doc_size()))
+        if rect.isEmpty():
+            return []
+        if self.source is None:
+            self._mark_dirty(rect)
+            view = qimage_view(self.image)
+            return [(view[rect.top():rect.bottom() + 1, rect.left():rect.right() + 1],
+                     rect.left(), rect.top())]
+        pieces = []
+        for ty in range(rect.top() // OVERLAY_TILE, rect.bottom() // OVERLAY_TILE + 1):
+            for tx in range(rect.left() // OVERLAY_TILE, rect.right() // OVERLAY_TILE + 1):
+                pieces.append((qimage_view(self._overlay_tile(tx, ty)),
+                               tx * OVERLAY_TILE, ty * OVERLAY_TILE))
+        return pieces
+
+    def _update_image_rect(self, rect):
+        # Schedule a repaint of just the widget area showing an image rect
+        zoom = self.zoom_factor
+        self.update(QRect(int(rect.left() * zoom) - 2, int(rect.top() * zoom) - 2,
+                          int(rect.width() * zoom) + 5, int(rect.height() * zoom) + 5))
+
+    def _begin_stroke(self, widget_pos, pressure):
+        color = self.brush_color if self.current_tool == "brush" else QColor(Qt.GlobalColor.white)
+        fmt = self.image.format() if self.source is None else QImage.Format.Format_ARGB32
+        self._stroke = DabStroke(pixel_value(color.getRgb(), fmt), self.brush_size,
+                                 self.brush_hardness, self.brush_opacity, self.brush_flow)
+        self._continue_stroke(widget_pos, pressure)
+
+    def _continue_stroke(self, widget_pos, pressure):
+        # Stamp the dabs between the previous and current sample
+        if self._stroke is None:
+            return
+        x = widget_pos.x() / self.zoom_factor
+        y = widget_pos.y() / self.zoom_factor
+        dabs = self._stroke.dabs_to(x, y, pressure)
+        if not dabs:
+            return
+        x0, y0, x1, y1 = DabStroke.bounds(dabs)
+        rect = QRect(x0, y0, x1 - x0, y1 - y0)
+        self._stroke.apply(self._edit_regions(rect), dabs)
+        # Also cover the brush outline drawn at the previous cursor position
+        self._update_image_rect(rect.united(self._stroke_rect(self.last_point, self.last_point)))
+        self.modified = True
+
+    def _end_stroke(self):
+        # A finished brush or eraser stroke is saved like any other edit, so
+        # the newest history entry is always the current image
+        if self._stroke is not None:
+            self._stroke = None
+            self.save_state()
+
+    def tabletEvent(self, event):
+        # Pen pressure scales dab size and opacity of brush and eraser strokes
+        if self.current_tool not in ["brush", "eraser"]:
+            event.ignore()
+            return
+        pos = event.position()
+        pressure = max(0.05, event.pressure())
+        etype = event.type()
+        if etype == QEvent.Type.TabletPress and event.button() == Qt.MouseButton.LeftButton:
+            if self._busy():
+                event.accept()
+                return
+            self.drawing = True
+            self.last_point = self.mapToCanvas(pos.toPoint())
+            self._begin_stroke(pos, pressure)
+        elif etype == QEvent.Type.TabletMove and self.drawing and self._stroke is not None:
+            self._continue_stroke(pos, pressure)
+            self.last_point = self.mapToCanvas(pos.toPoint())
+        elif etype == QEvent.Type.TabletRelease and self.drawing:
+            self._end_stroke()
+            self.drawing = False
+            self.update()
+        event.accept()
+
     def mapToCanvas(self, point):
         # Map widget coords to image pixel coords considering zoom
-        x = max(0, min(int(point.x() / self.zoom_factor), self.image.width() - 1))
-        y = max(0, min(int(point.y() / self.zoom_factor), self.image.height() - 1))
+        size = self.doc_size()
+        x = max(0, min(int(point.x() / self.zoom_factor), size.width() - 1))
+        y = max(0, min(int(point.y() / self.zoom_factor), size.height() - 1))
         return QPoint(x, y)
     
     def wheelEvent(self, event):
-        modifiers = QApplication.keyboardModifiers()
+        modifiers = event.modifiers()
         if modifiers == Qt.KeyboardModifier.ControlModifier:
             # Get the cursor position relative to the canvas
             cursor_pos = event.position().toPoint()
@@ -535,9 +2497,7 @@ class Canvas(QWidget):
                 self.zoom_factor = max(0.1, self.zoom_factor / 1.1)
             
             # Calculate new size and set it
-            new_size = QSize(int(self.image.width() * self.zoom_factor), 
-                            int(self.image.height() * self.zoom_factor))
-            self.setFixedSize(new_size)
+            self.setFixedSize(self.sizeHint())
             
             # Calculate new scrollbar positions to keep the same point under cursor
             new_x = old_x * self.zoom_factor - cursor_pos.x()
@@ -580,76 +2540,604 @@ class Canvas(QWidget):
                 
                 # Check if we need to scroll horizontally or vertically
                 # If both deltas are non-zero, prefer the larger one
+                outline = self._cursor_outline_rect()
                 if abs(dx) > abs(dy):
                     hbar.setValue(hbar.value() - dx)
                 else:
                     vbar.setValue(vbar.value() - dy)
+                if outline is not None:
+                    # The blit carried the brush outline along; the cursor stayed put
+                    self.update(outline)
+                    self.update(self._cursor_outline_rect())
                 
                 event.accept()
             else:
-                event.ignore()
+                event.ignore()
+
+    def _cursor_outline_rect(self):
+        # Widget area of the brush outline drawn under the cursor, if any
+        if self.current_tool not in ["brush", "line", "square", "circle", "eraser"] or not self.underMouse():
+            return None
+        d = max(1, int(self.brush_size * self.zoom_factor)) + 4
+        pos = self.mapFromGlobal(QCursor.pos())
+        return QRect(pos.x() - d // 2 - 1, pos.y() - d // 2 - 1, d + 2, d + 2)
+
+    def sizeHint(self):
+        size = self.doc_size()
+        return QSize(int(size.width() * self.zoom_factor), int(size.height() * self.zoom_factor))
+
+    def set_scroll_area(self, sa: QScrollArea):
+        self._scroll_area = sa
+
+    def set_tool_cursor(self, tool: str):
+        # Pointer uses default arrow
+        if tool == "pointer":
+            self.unsetCursor()
+            return
+        if tool in ("crop", "select"):
+            self.setCursor(Qt.CursorShape.CrossCursor)
+            return
+
+        # Determine cursor visual based on tool and brush size
+        self.setCursor(tool_cursor(tool, max(1, int(self.brush_size * self.zoom_factor))))
+
+
+@lru_cache(maxsize=64)
+def tool_cursor(tool, d):
+    # Cursor of a drawing tool for a brush d screen pixels across, shared by
+    # every document's canvas
+    size = max(24, d + 8)
+    pix = QPixmap(size, size)
+    pix.fill(Qt.GlobalColor.transparent)
+    p = QPainter(pix)
+    p.setRenderHint(QPainter.RenderHint.Antialiasing, True)
+    pen = QPen(Qt.GlobalColor.black, 2)
+    p.setPen(pen)
+
+    hotspot = QPoint(size // 2, size // 2)
+
+    if tool in ["brush", "line", "eraser"]:
+        # Circle matching current size
+        x = (size - d) // 2
+        y = (size - d) // 2
+        p.drawEllipse(x, y, d, d)
+    elif tool == "bucket":
+        p.drawRect(6, 6, size - 12, (size // 2) - 6)
+        p.drawLine(6, 6, 4, 10)
+        p.drawEllipse(size - 7, size - 8, 4, 6)
+    elif tool == "gradient":
+        # Crosshair: the drag sets the gradient's start and end points
+        mid = size // 2
+        p.drawLine(mid, 4, mid, size - 4)
+        p.drawLine(4, mid, size - 4, mid)
+    elif tool == "removebg":
+        margin = 5
+        p.drawLine(margin, margin, size - margin, size - margin)
+        p.drawLine(size - margin, margin, margin, size - margin)
+    else:
+        p.drawRect(5, 5, size - 10, size - 10)
+
+    p.end()
+    return QCursor(pix, hotspot.x(), hotspot.y())
+
+
+class RawGeometryDialog(QDialog):
+    # Asks for the geometry of a headerless raw pixel file
+    def __init__(self, parent, file_size):
+        super().__init__(parent)
+        self.setWindowTitle("Raw Image Geometry")
+        self.file_size = file_size
+        form = QFormLayout(self)
+        self.width_spin = QSpinBox()
+        self.height_spin = QSpinBox()
+        self.offset_spin = QSpinBox()
+        for spin in (self.width_spin, self.height_spin, self.offset_spin):
+            spin.setRange(0, 2_000_000_000)
+        self.width_spin.setValue(1024)
+        self.height_spin.setValue(1024)
+        self.layout_combo = QComboBox()
+        for label, _, _ in RAW_LAYOUTS:
+            self.layout_combo.addItem(label)
+        form.addRow("Width", self.width_spin)
+        form.addRow("Height", self.height_spin)
+        form.addRow("Pixels", self.layout_combo)
+        form.addRow("Header bytes", self.offset_spin)
+        self.size_label = QLabel()
+        form.addRow(self.size_label)
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        form.addRow(buttons)
+        self.layout_combo.currentIndexChanged.connect(self._guess_height)
+        self.width_spin.valueChanged.connect(self._guess_height)
+        self.offset_spin.valueChanged.connect(self._guess_height)
+        self._guess_height()
+
+    def _guess_height(self):
+        # Fill in the height implied by the file size for the chosen width and layout
+        _, dtype, channels = RAW_LAYOUTS[self.layout_combo.currentIndex()]
+        row_bytes = self.width_spin.value() * channels * np.dtype(dtype).itemsize
+        if row_bytes:
+            self.height_spin.setValue((self.file_size - self.offset_spin.value()) // row_bytes)
+        self.size_label.setText(f"File size: {self.file_size:,} bytes")
+
+    def geometry_spec(self):
+        _, dtype, channels = RAW_LAYOUTS[self.layout_combo.currentIndex()]
+        shape = (self.height_spin.value(), self.width_spin.value(), channels)
+        return shape, dtype, self.offset_spin.value()
+
+class GradientDialog(QDialog):
+    # Shape, color stops and area of the Gradient tool
+    def __init__(self, parent, kind, stops, region):
+        super().__init__(parent)
+        self.setWindowTitle("Gradient Settings")
+        form = QFormLayout(self)
+        self.kind_combo = QComboBox()
+        for label, value in (("Linear", "linear"), ("Radial", "radial")):
+            self.kind_combo.addItem(label, value)
+        self.kind_combo.setCurrentIndex(max(0, self.kind_combo.findData(kind)))
+        form.addRow("Shape", self.kind_combo)
+        # One row per stop: color swatch, position, remove button
+        self.stops_grid = QGridLayout()
+        self._rows = []
+        self._next_row = 0
+        for pos, color in stops:
+            self._add_stop(pos, color)
+        form.addRow("Stops", self.stops_grid)
+        add_button = QPushButton("Add Stop")
+        add_button.clicked.connect(lambda: self._add_stop(0.5, QColor(Qt.GlobalColor.gray)))
+        form.addRow("", add_button)
+        self.region_check = QCheckBox("Only the area Fill would fill from the start point")
+        self.region_check.setChecked(region)
+        form.addRow(self.region_check)
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        form.addRow(buttons)
+
+    def _add_stop(self, pos, color):
+        swatch = QPushButton()
+        swatch.setFixedWidth(48)
+        swatch.color = QColor(color)
+        swatch.clicked.connect(lambda: self._pick_color(swatch))
+        self._show_color(swatch)
+        spin = QSpinBox()
+        spin.setRange(0, 100)
+        spin.setSuffix(" %")
+        spin.setValue(round(pos * 100))
+        remove = QPushButton("Remove")
+        row = (swatch, spin, remove)
+        remove.clicked.connect(lambda: self._remove_stop(row))
+        for column, widget in enumerate(row):
+            self.stops_grid.addWidget(widget, self._next_row, column)
+        self._next_row += 1
+        self._rows.append(row)
+        self._update_remove_buttons()
+
+    def _remove_stop(self, row):
+        # A gradient needs two stops
+        if len(self._rows) <= 2:
+            return
+        self._rows.remove(row)
+        for widget in row:
+            self.stops_grid.removeWidget(widget)
+            widget.deleteLater()
+        self._update_remove_buttons()
+
+    def _update_remove_buttons(self):
+        for _, _, remove in self._rows:
+            remove.setEnabled(len(self._rows) > 2)
+
+    def _pick_color(self, swatch):
+        color = QColorDialog.getColor(swatch.color, self, "Stop Color",
+                                      QColorDialog.ColorDialogOption.ShowAlphaChannel)
+        if color.isValid():
+            swatch.color = color
+            self._show_color(swatch)
+
+    @staticmethod
+    def _show_color(swatch):
+        c = swatch.color
+        swatch.setStyleSheet(f"background-color: rgba({c.red()}, {c.green()}, {c.blue()}, {c.alpha()});")
+        swatch.setToolTip(f"{c.name()}, opacity {round(c.alphaF() * 100)} %")
+
+    def kind(self):
+        return self.kind_combo.currentData()
+
+    def stops(self):
+        return sorted(((spin.value() / 100, swatch.color) for swatch, spin, _ in self._rows), key=lambda stop: stop[0])
+
+class PaletteExportDialog(QDialog):
+    # Options for exporting a quantized 8-bit palette PNG
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setWindowTitle("Export Palette PNG")
+        form = QFormLayout(self)
+        self.colors_spin = QSpinBox()
+        self.colors_spin.setRange(2, 256)
+        self.colors_spin.setValue(256)
+        self.dither_check = QCheckBox("Ordered dithering")
+        form.addRow("Colors", self.colors_spin)
+        form.addRow(self.dither_check)
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        form.addRow(buttons)
+
+class ResizeDialog(QDialog):
+    # New document size and resampling filter for Image > Resize
+    def __init__(self, parent, size):
+        super().__init__(parent)
+        self.setWindowTitle("Resize Image")
+        self.aspect = size.width() / max(1, size.height())
+        form = QFormLayout(self)
+        self.width_spin = QSpinBox()
+        self.height_spin = QSpinBox()
+        for spin in (self.width_spin, self.height_spin):
+            spin.setRange(1, 100_000)
+        self.width_spin.setValue(size.width())
+        self.height_spin.setValue(size.height())
+        self.keep_aspect = QCheckBox("Keep aspect ratio")
+        self.keep_aspect.setChecked(True)
+        self.filter_combo = QComboBox()
+        for label, method in (("Lanczos", "lanczos"), ("Bicubic", "bicubic"), ("Area (box)", "area")):
+            self.filter_combo.addItem(label, method)
+        form.addRow("Width", self.width_spin)
+        form.addRow("Height", self.height_spin)
+        form.addRow(self.keep_aspect)
+        form.addRow("Filter", self.filter_combo)
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        form.addRow(buttons)
+        self.width_spin.valueChanged.connect(self._width_changed)
+        self.height_spin.valueChanged.connect(self._height_changed)
+
+    def _width_changed(self, value):
+        if self.keep_aspect.isChecked():
+            self.height_spin.blockSignals(True)
+            self.height_spin.setValue(max(1, round(value / self.aspect)))
+            self.height_spin.blockSignals(False)
+
+    def _height_changed(self, value):
+        if self.keep_aspect.isChecked():
+            self.width_spin.blockSignals(True)
+            self.width_spin.setValue(max(1, round(value * self.aspect)))
+            self.width_spin.blockSignals(False)
+
+class TrimDialog(QDialog):
+    # Background color and tolerance for Image > Trim Borders
+    BACKGROUNDS = (("Corner color", None), ("Brush color", "brush"),
+                   ("White", QColor(255, 255, 255)), ("Transparent", QColor(0, 0, 0, 0)))
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setWindowTitle("Trim Borders")
+        form = QFormLayout(self)
+        self.background_combo = QComboBox()
+        for label, color in self.BACKGROUNDS:
+            self.background_combo.addItem(label, color)
+        self.tolerance_spin = QSpinBox()
+        self.tolerance_spin.setRange(0, 255)
+        self.tolerance_spin.setValue(10)
+        form.addRow("Background", self.background_combo)
+        form.addRow("Tolerance", self.tolerance_spin)
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        form.addRow(buttons)
+
+class DespeckleDialog(QDialog):
+    # Background, tolerance and speck size for Image > Despeckle
+    def __init__(self, parent, region, selected):
+        super().__init__(parent)
+        self.setWindowTitle("Despeckle")
+        form = QFormLayout(self)
+        self.background_combo = QComboBox()
+        for label, color in TrimDialog.BACKGROUNDS:
+            self.background_combo.addItem(label, color)
+        self.tolerance_spin = QSpinBox()
+        self.tolerance_spin.setRange(0, 255)
+        self.tolerance_spin.setValue(30)
+        self.size_spin = QSpinBox()
+        self.size_spin.setRange(2, 100000)
+        self.size_spin.setValue(20)
+        self.size_spin.setSuffix(" px")
+        form.addRow("Background", self.background_combo)
+        form.addRow("Tolerance", self.tolerance_spin)
+        form.addRow("Remove blobs under", self.size_spin)
+        where = "Selection" if selected else "Whole image"
+        form.addRow("Applies to", QLabel(f"{where}, {region.width()} x {region.height()}"))
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        form.addRow(buttons)
+
+class FilterDialog(QDialog):
+    # Settings for the Image > Filter entries
+    def __init__(self, parent, kind, region, selected):
+        super().__init__(parent)
+        self.setWindowTitle(FILTER_NAMES[kind])
+        form = QFormLayout(self)
+        if kind in ("gaussian", "unsharp"):
+            self.radius_spin = QDoubleSpinBox()
+            self.radius_spin.setRange(0.3, 50.0)
+            self.radius_spin.setSingleStep(0.5)
+            self.radius_spin.setValue(2.0 if kind == "gaussian" else 1.0)
+            form.addRow("Radius (sigma, px)", self.radius_spin)
+        else:
+            self.radius_spin = QSpinBox()
+            # The median's window grows with the square of the radius
+            self.radius_spin.setRange(1, 5 if kind == "median" else 50)
+            self.radius_spin.setValue(1 if kind == "median" else 2)
+            form.addRow("Radius (px)", self.radius_spin)
+        self.amount_spin = QSpinBox()
+        self.amount_spin.setRange(1, 500)
+        self.amount_spin.setValue(100)
+        self.amount_spin.setSuffix(" %")
+        self.threshold_spin = QSpinBox()
+        self.threshold_spin.setRange(0, 255)
+        if kind == "unsharp":
+            form.addRow("Amount", self.amount_spin)
+            form.addRow("Threshold", self.threshold_spin)
+        where = "Selection" if selected else "Whole image"
+        form.addRow("Applies to", QLabel(f"{where}, {region.width()} x {region.height()}"))
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        form.addRow(buttons)
+
+class CurveWidget(QWidget):
+    # Editable tone curve: click to add a point, drag to move, right-click to remove
+    changed = pyqtSignal()
+    GRAB = 8
+
+    def __init__(self):
+        super().__init__()
+        self.setFixedSize(220, 220)
+        self.points = [[0.0, 0.0], [1.0, 1.0]]
+        self._drag = None
+
+    def reset(self):
+        self.points = [[0.0, 0.0], [1.0, 1.0]]
+        self.update()
+        self.changed.emit()
+
+    def curve(self):
+        # None while the curve is the identity
+        return None if self.points == [[0.0, 0.0], [1.0, 1.0]] else [tuple(p) for p in self.points]
+
+    def _to_widget(self, x, y):
+        return QPoint(int(x * (self.width() - 1)), int((1 - y) * (self.height() - 1)))
+
+    def _from_widget(self, pos):
+        return (min(max(pos.x() / (self.width() - 1), 0.0), 1.0),
+                min(max(1 - pos.y() / (self.height() - 1), 0.0), 1.0))
+
+    def _point_at(self, pos):
+        for i, (x, y) in enumerate(self.points):
+            if (self._to_widget(x, y) - pos).manhattanLength() <= self.GRAB:
+                return i
+        return None
+
+    def mousePressEvent(self, event):
+        pos = event.position().toPoint()
+        index = self._point_at(pos)
+        if event.button() == Qt.MouseButton.RightButton:
+            if index not in (None, 0, len(self.points) - 1):
+                del self.points[index]
+                self.update()
+                self.changed.emit()
+            return
+        if index is None:
+            x, y = self._from_widget(pos)
+            if not 0.0 < x < 1.0:
+                return
+            index = next(i for i, p in enumerate(self.points) if p[0] > x)
+            self.points.insert(index, [x, y])
+        self._drag = index
+        self.mouseMoveEvent(event)
+
+    def mouseMoveEvent(self, event):
+        if self._drag is None:
+            return
+        x, y = self._from_widget(event.position().toPoint())
+        i = self._drag
+        if i == 0 or i == len(self.points) - 1:
+            # The end points only move up and down
+            x = self.points[i][0]
+        else:
+            x = min(max(x, self.points[i - 1][0] + 0.01), self.points[i + 1][0] - 0.01)
+        self.points[i] = [x, y]
+        self.update()
+        self.changed.emit()
+
+    def mouseReleaseEvent(self, event):
+        self._drag = None
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor("#FFFFFF"))
+        painter.setPen(QPen(QColor("#E5E7EB"), 1))
+        for i in range(1, 4):
+            painter.drawLine(self._to_widget(i / 4, 0), self._to_widget(i / 4, 1))
+            painter.drawLine(self._to_widget(0, i / 4), self._to_widget(1, i / 4))
+        painter.setPen(QPen(QColor("#D1D5DB"), 1, Qt.PenStyle.DashLine))
+        painter.drawLine(self._to_widget(0, 0), self._to_widget(1, 1))
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing, True)
+        lut = tone_lut(8, curve=[tuple(p) for p in self.points])
+        path = QPainterPath()
+        for i, value in enumerate(lut):
+            point = self._to_widget(i / 255, value / 255)
+            if i == 0:
+                path.moveTo(point.x(), point.y())
+            else:
+                path.lineTo(point.x(), point.y())
+        painter.setPen(QPen(QColor("#111827"), 2))
+        painter.drawPath(path)
+        painter.setBrush(QColor("#FFFFFF"))
+        for x, y in self.points:
+            painter.drawEllipse(self._to_widget(x, y), 4, 4)
+        painter.end()
 
-    def sizeHint(self):
-        return QSize(int(self.image.width() * self.zoom_factor), int(self.image.height() * self.zoom_factor))
+class ToneDialog(QDialog):
+    # Levels, gamma, curve and brightness/contrast for Image > Adjust Tones,
+    # previewed on the canvas while the controls move
+    def __init__(self, parent, canvas):
+        super().__init__(parent)
+        self.setWindowTitle("Adjust Tones")
+        self.canvas = canvas
+        self.depth = canvas.tone_depth()
+        form = QFormLayout(self)
+        self.black_slider = self._slider(form, "Black point", 0, 255, 0)
+        self.white_slider = self._slider(form, "White point", 0, 255, 255)
+        # Gamma on a log scale: -100..100 is 0.1..10
+        self.gamma_slider = self._slider(form, "Gamma", -100, 100, 0, lambda v: f"{10 ** (v / 100):.2f}")
+        self.brightness_slider = self._slider(form, "Brightness", -100, 100, 0)
+        self.contrast_slider = self._slider(form, "Contrast", -100, 100, 0)
+        self.curve = CurveWidget()
+        self.curve.changed.connect(self._preview)
+        form.addRow("Curve", self.curve)
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel |
+                                   QDialogButtonBox.StandardButton.Reset)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        buttons.button(QDialogButtonBox.StandardButton.Reset).clicked.connect(self._reset)
+        form.addRow(buttons)
 
-    def set_scroll_area(self, sa: QScrollArea):
-        self._scroll_area = sa
+    def _slider(self, form, label, low, high, value, text=str):
+        slider = QSlider(Qt.Orientation.Horizontal)
+        slider.setRange(low, high)
+        slider.setValue(value)
+        slider.setProperty("default", value)
+        readout = QLabel(text(value))
+        readout.setMinimumWidth(36)
+        slider.valueChanged.connect(lambda v: readout.setText(text(v)))
+        slider.valueChanged.connect(self._preview)
+        row = QHBoxLayout()
+        row.addWidget(slider, 1)
+        row.addWidget(readout)
+        form.addRow(label, row)
+        return slider
 
-    def set_tool_cursor(self, tool: str):
-        # Pointer uses default arrow
-        if tool == "pointer":
-            self.unsetCursor()
-            return
+    def _reset(self):
+        for slider in (self.black_slider, self.white_slider, self.gamma_slider,
+                       self.brightness_slider, self.contrast_slider):
+            slider.setValue(slider.property("default"))
+        self.curve.reset()
 
-        # Determine cursor visual based on tool and brush size
-        d = max(1, int(self.brush_size * self.zoom_factor))
-        size = max(24, d + 8)
-        pix = QPixmap(size, size)
-        pix.fill(Qt.GlobalColor.transparent)
-        p = QPainter(pix)
-        p.setRenderHint(QPainter.RenderHint.Antialiasing, True)
-        pen = QPen(Qt.GlobalColor.black, 2)
-        p.setPen(pen)
+    def lut(self):
+        # None while the settings leave the image unchanged
+        black, white = self.black_slider.value() / 255, self.white_slider.value() / 255
+        settings = dict(black=min(black, white - 1 / 255), white=white,
+                        gamma=10 ** (self.gamma_slider.value() / 100),
+                        brightness=self.brightness_slider.value() / 100,
+                        contrast=self.contrast_slider.value() / 100, curve=self.curve.curve())
+        if settings == dict(black=0.0, white=1.0, gamma=1.0, brightness=0.0, contrast=0.0, curve=None):
+            return None
+        return tone_lut(self.depth, **settings)
 
-        hotspot = QPoint(size // 2, size // 2)
+    def _preview(self):
+        self.canvas.set_tone_preview(self.lut())
 
-        if tool in ["brush", "line", "eraser"]:
-            # Circle matching current size
-            x = (size - d) // 2
-            y = (size - d) // 2
-            p.drawEllipse(x, y, d, d)
-        elif tool == "bucket":
-            p.drawRect(6, 6, size - 12, (size // 2) - 6)
-            p.drawLine(6, 6, 4, 10)
-            p.drawEllipse(size - 7, size - 8, 4, 6)
-        elif tool == "removebg":
-            margin = 5
-            p.drawLine(margin, margin, size - margin, size - margin)
-            p.drawLine(size - margin, margin, margin, size - margin)
-        else:
-            p.drawRect(5, 5, size - 10, size - 10)
+class HistoryPanel(QListWidget):
+    # The current document's undo history, oldest first, with the redo steps
+    # after the current one grayed out; clicking a row jumps to that state.
+    # Thumbnails are made on the idle scheduler's worker while the panel is
+    # shown and kept with the document
+    def __init__(self, scheduler, parent=None):
+        super().__init__(parent)
+        self.scheduler = scheduler
+        self.canvas = None
+        self._signature = None
+        self._rows = {}  # id(entry) -> row
+        self.setIconSize(QSize(HISTORY_THUMBNAIL, HISTORY_THUMBNAIL))
+        self.setUniformItemSizes(True)
+        self.setFixedWidth(HISTORY_THUMBNAIL + 150)
+        placeholder = QPixmap(HISTORY_THUMBNAIL, HISTORY_THUMBNAIL)
+        placeholder.fill(Qt.GlobalColor.lightGray)
+        self._placeholder = QIcon(placeholder)
+        self.itemClicked.connect(self._clicked)
+        # The history changes in many places (edits, undo, opening files, idle
+        # compression), so while shown the list is checked against it
+        self._timer = QTimer(self)
+        self._timer.setInterval(250)
+        self._timer.timeout.connect(self.refresh)
 
-        p.end()
-        self.setCursor(QCursor(pix, hotspot.x(), hotspot.y()))
+    def set_canvas(self, canvas):
+        if self.canvas is not None:
+            self.scheduler.cancel(("history-thumbnails", id(self.canvas)))
+        self.canvas = canvas
+        self._signature = None
+        self.refresh()
 
-class PaintBrushApp(QMainWindow):
-    def __init__(self):
+    def showEvent(self, event):
+        super().showEvent(event)
+        self._timer.start()
+        self.refresh()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self._timer.stop()
+        if self.canvas is not None:
+            self.scheduler.cancel(("history-thumbnails", id(self.canvas)))
+
+    def refresh(self):
+        canvas = self.canvas
+        if canvas is None or not self.isVisible():
+            return
+        entries = list(canvas.history) + list(reversed(canvas.redo_stack))
+        current = len(canvas.history) - 1
+        signature = ([id(state) for state in entries], current)
+        if signature == self._signature:
+            return
+        self._signature = signature
+        self._rows = {key: row for row, key in enumerate(signature[0])}
+        thumbs = canvas._history_thumbnails
+        for key in [key for key in thumbs if key not in self._rows]:
+            del thumbs[key]
+        while self.count() > len(entries):
+            self.takeItem(self.count() - 1)
+        while self.count() < len(entries):
+            self.addItem(QListWidgetItem())
+        redo_color = self.palette().color(self.palette().ColorGroup.Disabled, self.palette().ColorRole.Text)
+        for row, state in enumerate(entries):
+            item = self.item(row)
+            item.setText(f"{row}  {history_label(state)}")
+            item.setForeground(redo_color if row > current else self.palette().text().color())
+            thumb = thumbs.get(id(state))
+            item.setIcon(thumb[2] if thumb is not None and thumb[2] is not None else self._placeholder)
+        self.blockSignals(True)
+        self.setCurrentRow(current)
+        self.blockSignals(False)
+        if any(id(state) not in thumbs for state in entries):
+            known = {key: thumb[1] for key, thumb in thumbs.items()}
+            # Ahead of compressing the history: these are on screen
+            self.scheduler.submit(("history-thumbnails", id(canvas)), history_thumbnails(entries, known),
+                                  priority=2, worker=True, step=lambda made, c=canvas: self._thumbnail_made(c, made))
+
+    def _thumbnail_made(self, canvas, made):
+        state, thumb = made
+        icon = QIcon(QPixmap.fromImage(thumb[0])) if thumb is not None else None
+        canvas._history_thumbnails[id(state)] = (state, thumb, icon)
+        row = self._rows.get(id(state))
+        if canvas is self.canvas and row is not None and icon is not None:
+            self.item(row).setIcon(icon)
+
+    def _clicked(self, item):
+        if self.canvas is not None and self.canvas.jump_to(self.row(item)):
+            self.refresh()
+        else:
+            self.setCurrentRow(len(self.canvas.history) - 1 if self.canvas is not None else -1)
+
+class DocumentView(QWidget):
+    # One document tab: its canvas inside a scroll area, with rulers
+    def __init__(self, canvas):
         super().__init__()
-        self.setWindowTitle("Tabula Rasa")
-        self.setGeometry(100, 100, 900, 700)
-        self.assets_dir = resource_path("assets")
-        self.current_file_path = None
-        
-        # Create main widget and layout
-        main_widget = QWidget()
-        self.setCentralWidget(main_widget)
-        layout = QVBoxLayout()
-        
-        # Create canvas inside a scroll area
-        self.canvas = Canvas()
-        self.canvas.setMouseTracking(True)
+        self.canvas = canvas
+        canvas.setMouseTracking(True)
         self.scroll = QScrollArea()
-        self.scroll.setWidget(self.canvas)
+        self.scroll.setWidget(canvas)
         self.scroll.setWidgetResizable(False)
         # Use ScrollBarAsNeeded to show scrollbars only when content exceeds viewport
         self.scroll.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAsNeeded)
@@ -664,7 +3152,124 @@ class PaintBrushApp(QMainWindow):
             }
         """)
         
-        self.canvas.set_scroll_area(self.scroll)
+        canvas.set_scroll_area(self.scroll)
+
+        grid = QGridLayout()
+        grid.setContentsMargins(0, 0, 0, 0)
+        grid.setSpacing(0)
+        self.setLayout(grid)
+        # Corner spacer with matching background
+        corner = QWidget()
+        corner.setFixedSize(24, 24)
+        corner.setStyleSheet("background: #f0f0f0; border: 1px solid #d0d0d0;")
+        
+        # Rulers with proper styling
+        h_ruler = RulerWidget(canvas, Qt.Orientation.Horizontal)
+        v_ruler = RulerWidget(canvas, Qt.Orientation.Vertical)
+        
+        # Set ruler styles
+        h_ruler.setStyleSheet("""
+            QWidget {
+                background: #f0f0f0;
+                border-bottom: 1px solid #d0d0d0;
+                border-right: 1px solid #d0d0d0;
+            }
+        """)
+        
+        v_ruler.setStyleSheet("""
+            QWidget {
+                background: #f0f0f0;
+                border-right: 1px solid #d0d0d0;
+                border-bottom: 1px solid #d0d0d0;
+            }
+        """)
+        
+        # Add widgets to grid
+        grid.addWidget(corner, 0, 0)
+        grid.addWidget(h_ruler, 0, 1)
+        grid.addWidget(v_ruler, 1, 0)
+        grid.addWidget(self.scroll, 1, 1)
+        
+        # Set grid row/column stretch factors
+        grid.setRowStretch(1, 1)
+        grid.setColumnStretch(1, 1)
+        
+        # Sync rulers with scroll and zoom
+        self.scroll.horizontalScrollBar().valueChanged.connect(h_ruler.update)
+        self.scroll.verticalScrollBar().valueChanged.connect(v_ruler.update)
+        canvas.zoomChanged.connect(h_ruler.update)
+        canvas.zoomChanged.connect(v_ruler.update)
+        
+        # Ensure initial update of rulers
+        QTimer.singleShot(100, lambda: [h_ruler.update(), v_ruler.update()])
+
+        # Frame slider, shown for multi-page TIFFs and animated GIFs
+        self.frame_bar = QWidget()
+        bar = QHBoxLayout(self.frame_bar)
+        bar.setContentsMargins(6, 2, 6, 2)
+        self.frame_slider = QSlider(Qt.Orientation.Horizontal)
+        self.frame_slider.valueChanged.connect(canvas.show_frame)
+        self.frame_label = QLabel()
+        self.frame_label.setMinimumWidth(self.frame_label.fontMetrics().horizontalAdvance("Frame 0000 / 0000 (decoding)"))
+        bar.addWidget(self.frame_slider, 1)
+        bar.addWidget(self.frame_label)
+        grid.addWidget(self.frame_bar, 2, 0, 1, 2)
+        canvas.frameChanged.connect(self.update_frame_bar)
+        self.update_frame_bar()
+
+    def update_frame_bar(self):
+        stack = self.canvas.stack
+        self.frame_bar.setVisible(stack is not None)
+        if stack is None:
+            return
+        wanted = self.canvas.wanted_frame
+        index = self.canvas.frame if wanted is None else wanted
+        self.frame_slider.blockSignals(True)
+        self.frame_slider.setMaximum(stack.count - 1)
+        self.frame_slider.setValue(index)
+        self.frame_slider.blockSignals(False)
+        self.frame_label.setText(f"Frame {index + 1} / {stack.count}" + ("" if wanted is None else " (decoding)"))
+
+
+class PaintBrushApp(QMainWindow):
+    def __init__(self, profile_path=None, stall_threshold=0.25, trace_path=None):
+        super().__init__()
+        self.setWindowTitle("Tabula Rasa")
+        self.setGeometry(100, 100, 900, 700)
+        self.assets_dir = resource_path("assets")
+        # Log GUI stalls with the stack that caused them; optionally profile the session
+        self.watchdog = StallWatchdog(stall_threshold, parent=self)
+        self.watchdog.start()
+        self.profiler = SessionProfiler()
+        self.profile_path = profile_path
+        if profile_path:
+            self.profiler.start()
+        # Input trace recorder, while Help > Record Input Trace is checked
+        self.recorder = None
+        self.trace_path = trace_path
+        
+        # Create main widget and layout
+        main_widget = QWidget()
+        self.setCentralWidget(main_widget)
+        layout = QVBoxLayout()
+        
+        # Documents, one per tab; self.canvas is the one in the current tab
+        self.tabs = QTabWidget()
+        self.tabs.setDocumentMode(True)
+        self.tabs.setTabsClosable(True)
+        self.tabs.setMovable(True)
+        self.tabs.setIconSize(QSize(24, 24))
+        self.tabs.tabCloseRequested.connect(self.close_tab)
+        self._active_canvas = None
+        # Tool and brush settings, applied to whichever document is current
+        self.current_tool = "pointer"
+        self.gradient_kind = "linear"
+        self.gradient_stops = [(0.0, QColor(Qt.GlobalColor.black)), (1.0, QColor(Qt.GlobalColor.white))]
+        self.gradient_region = False
+        # Housekeeping that waits for the user to pause
+        self.idle = IdleScheduler(parent=self)
+        self.idle.add_idle_hook(self.idle_work)
+        self.idle.start()
         
         # Create tool buttons
         self.tool_group = QButtonGroup(self)
@@ -677,6 +3282,15 @@ class PaintBrushApp(QMainWindow):
         self.bucket_btn = self.create_tool_button("Bucket", "bucket")
         self.eraser_btn = self.create_tool_button("Eraser", "eraser")
         self.removebg_btn = self.create_tool_button("Remove BG", "removebg")
+        self.eyedrop_btn = self.create_tool_button("Eyedropper (averages brush size)", "eyedrop")
+        self.crop_btn = self.create_tool_button("Crop (drag a rectangle)", "crop")
+        self.select_btn = self.create_tool_button("Select (drag a rectangle for filters; click to clear)", "select")
+        self.gradient_btn = self.create_tool_button("Gradient (drag from start to end; the arrow opens its settings)",
+                                                    "gradient")
+        self.gradient_btn.setPopupMode(QToolButton.ToolButtonPopupMode.MenuButtonPopup)
+        gradient_menu = QMenu(self.gradient_btn)
+        gradient_menu.addAction("Gradient Settings...", self.gradient_dialog)
+        self.gradient_btn.setMenu(gradient_menu)
 
         # Zoom buttons (not part of toggle group)
         self.zoom_in_btn = QToolButton()
@@ -707,7 +3321,7 @@ class PaintBrushApp(QMainWindow):
         if os.path.exists(undo_path):
             self.undo_btn.setIcon(QIcon(undo_path))
             self.undo_btn.setIconSize(QSize(24, 24))
-        self.undo_btn.clicked.connect(self.canvas.undo)
+        self.undo_btn.clicked.connect(lambda: self.canvas.undo())
         
         self.redo_btn = QToolButton()
         self.redo_btn.setToolTip("Redo (Ctrl+Y)")
@@ -715,7 +3329,7 @@ class PaintBrushApp(QMainWindow):
         if os.path.exists(redo_path):
             self.redo_btn.setIcon(QIcon(redo_path))
             self.redo_btn.setIconSize(QSize(24, 24))
-        self.redo_btn.clicked.connect(self.canvas.redo)
+        self.redo_btn.clicked.connect(lambda: self.canvas.redo())
         
         # Color button
         self.color_btn = QPushButton()
@@ -731,6 +3345,11 @@ class PaintBrushApp(QMainWindow):
         self.size_slider.setTickPosition(QSlider.TickPosition.TicksBelow)
         self.size_slider.setTickInterval(5)
         self.size_slider.valueChanged.connect(self.update_brush_size)
+
+        # Brush hardness, opacity and flow in percent
+        self.hardness_slider = self.create_percent_slider("Hardness", self.update_brush_hardness)
+        self.opacity_slider = self.create_percent_slider("Opacity", self.update_brush_opacity)
+        self.flow_slider = self.create_percent_slider("Flow", self.update_brush_flow)
         
         # No size label; slider alone indicates size
         
@@ -743,7 +3362,7 @@ class PaintBrushApp(QMainWindow):
             clear_btn.setIconSize(QSize(24, 24))
         else:
             clear_btn.setText("Clear")
-        clear_btn.clicked.connect(self.canvas.clear_canvas)
+        clear_btn.clicked.connect(lambda: self.canvas.clear_canvas())
         
         open_btn = QToolButton()
         open_btn.setToolTip("Open")
@@ -782,8 +3401,12 @@ class PaintBrushApp(QMainWindow):
         top_toolbar.addWidget(self.square_btn)
         top_toolbar.addWidget(self.circle_btn)
         top_toolbar.addWidget(self.bucket_btn)
+        top_toolbar.addWidget(self.gradient_btn)
         top_toolbar.addWidget(self.eraser_btn)
         top_toolbar.addWidget(self.removebg_btn)
+        top_toolbar.addWidget(self.eyedrop_btn)
+        top_toolbar.addWidget(self.crop_btn)
+        top_toolbar.addWidget(self.select_btn)
         top_toolbar.addSpacing(12)
         # Zoom
         top_toolbar.addWidget(self.zoom_in_btn)
@@ -793,6 +3416,9 @@ class PaintBrushApp(QMainWindow):
         top_toolbar.addWidget(self.color_btn)
         top_toolbar.addSpacing(6)
         top_toolbar.addWidget(self.size_slider)
+        top_toolbar.addWidget(self.hardness_slider)
+        top_toolbar.addWidget(self.opacity_slider)
+        top_toolbar.addWidget(self.flow_slider)
         
         top_toolbar.addStretch()
         
@@ -809,62 +3435,28 @@ class PaintBrushApp(QMainWindow):
             "#TopToolbar QSlider::handle:horizontal { background: #374151; border: 2px solid #FFFFFF; height: 14px; width: 14px; margin: -4px -5px; border-radius: 7px; }"
         )
         layout.addWidget(toolbar_widget)
-        work_area = QWidget()
-        grid = QGridLayout()
-        grid.setContentsMargins(0, 0, 0, 0)
-        grid.setSpacing(0)
-        work_area.setLayout(grid)
-        # Corner spacer with matching background
-        corner = QWidget()
-        corner.setFixedSize(24, 24)
-        corner.setStyleSheet("background: #f0f0f0; border: 1px solid #d0d0d0;")
-        
-        # Rulers with proper styling
-        h_ruler = RulerWidget(self.canvas, Qt.Orientation.Horizontal)
-        v_ruler = RulerWidget(self.canvas, Qt.Orientation.Vertical)
-        
-        # Set ruler styles
-        h_ruler.setStyleSheet("""
-            QWidget {
-                background: #f0f0f0;
-                border-bottom: 1px solid #d0d0d0;
-                border-right: 1px solid #d0d0d0;
-            }
-        """)
-        
-        v_ruler.setStyleSheet("""
-            QWidget {
-                background: #f0f0f0;
-                border-right: 1px solid #d0d0d0;
-                border-bottom: 1px solid #d0d0d0;
-            }
-        """)
-        
-        # Add widgets to grid
-        grid.addWidget(corner, 0, 0)
-        grid.addWidget(h_ruler, 0, 1)
-        grid.addWidget(v_ruler, 1, 0)
-        grid.addWidget(self.scroll, 1, 1)
-        
-        # Set grid row/column stretch factors
-        grid.setRowStretch(1, 1)
-        grid.setColumnStretch(1, 1)
-        
-        # Sync rulers with scroll and zoom
-        self.scroll.horizontalScrollBar().valueChanged.connect(h_ruler.update)
-        self.scroll.verticalScrollBar().valueChanged.connect(v_ruler.update)
-        self.canvas.zoomChanged.connect(h_ruler.update)
-        self.canvas.zoomChanged.connect(v_ruler.update)
-        
-        # Ensure initial update of rulers
-        QTimer.singleShot(100, lambda: [h_ruler.update(), v_ruler.update()])
-        layout.addWidget(work_area, 1)
+        # Undo history of the current document beside it (View > History)
+        self.history_panel = HistoryPanel(self.idle)
+        self.history_panel.hide()
+        documents = QHBoxLayout()
+        documents.addWidget(self.tabs, 1)
+        documents.addWidget(self.history_panel)
+        layout.addLayout(documents, 1)
+
+        # Thumbnails of the folder being worked through (File > Open Folder)
+        self.thumbnails = ThumbnailLoader(parent=self)
+        self.filmstrip = Filmstrip(self.thumbnails)
+        self.filmstrip.imageChosen.connect(self.open_folder_image)
+        self.filmstrip.hide()
+        layout.addWidget(self.filmstrip)
+        # Decodes the images next to the current one while it is being edited
+        self.prefetcher = Prefetcher(prefetch_decode)
+        # The same thumbnails serve as the document tabs' icons
+        self.thumbnails.ready.connect(self._thumbnail_ready)
         
         # Initialize with black color
         self.current_color = QColor(Qt.GlobalColor.black.value)
-        self.canvas.set_brush_color(self.current_color)
         self.update_color_button()
-        self.update_title()
         
         # Set the layout to the main widget
         main_widget.setLayout(layout)
@@ -887,8 +3479,138 @@ class PaintBrushApp(QMainWindow):
         self.setup_shortcuts()
         # Setup menu bar
         self.setup_menu_bar()
+        # Progress and Cancel for background jobs (open, save, fill, remove BG)
+        self.job_label = QLabel()
+        self.job_progress = QProgressBar()
+        self.job_progress.setFixedWidth(160)
+        self.job_progress.setRange(0, 1000)
+        self.job_cancel = QPushButton("Cancel")
+        self.job_cancel.setToolTip("Cancel (Esc)")
+        self.job_cancel.clicked.connect(lambda: self.canvas.cancel_job())
+        for widget in (self.job_label, self.job_progress, self.job_cancel):
+            self.statusBar().addPermanentWidget(widget)
+            widget.hide()
+        # Start with one empty document
+        self.tabs.currentChanged.connect(self.tab_changed)
+        self.new_document()
+        # Recording needs a document to start from, so --record-trace starts here
+        if self.trace_path:
+            self.trace_action.setChecked(True)
         # No theme-dependent icon styling (icons use fixed strokes)
         
+    @property
+    def canvas(self):
+        return self.tabs.currentWidget().canvas
+
+    @property
+    def current_file_path(self):
+        return self.canvas.file_path
+
+    def canvases(self):
+        return [self.tabs.widget(i).canvas for i in range(self.tabs.count())]
+
+    def new_document(self):
+        # Open a tab with a blank canvas and make it current
+        canvas = Canvas()
+        canvas.statusMessage.connect(lambda text: self.statusBar().showMessage(text, 5000))
+        canvas.colorPicked.connect(self.set_picked_color)
+        canvas.documentOpened.connect(lambda file_name, c=canvas: self.document_opened(c, file_name))
+        canvas.documentSaved.connect(lambda file_name, c=canvas: self.document_saved(c, file_name))
+        # Only the current document's job is shown in the status bar
+        canvas.jobStarted.connect(lambda job, c=canvas: c is self.canvas and self.show_job(job))
+        canvas.jobEnded.connect(lambda c=canvas: c is self.canvas and self.hide_job())
+        self.tabs.setCurrentIndex(self.tabs.addTab(DocumentView(canvas), "Untitled"))
+        return canvas
+
+    def close_tab(self, index):
+        view = self.tabs.widget(index)
+        canvas = view.canvas
+        # Ask about unsaved changes with the document in view; its job is
+        # only stopped once the close is certain
+        self.tabs.setCurrentIndex(index)
+        if not self.maybe_save():
+            return False
+        canvas.end_job()
+        self.idle.cancel(("pack-history", id(canvas)))
+        self.idle.cancel(("color-histogram", id(canvas)))
+        canvas._close_source()
+        canvas._set_stack(None)
+        if self.tabs.count() == 1:
+            # The window always has a document; the last one is replaced by a blank one
+            self.new_document()
+        self.tabs.removeTab(self.tabs.indexOf(view))
+        if self._active_canvas is canvas:
+            self._active_canvas = None
+        view.deleteLater()
+        return True
+
+    def tab_changed(self, index):
+        if index < 0:
+            return
+        canvas = self.canvas
+        previous = self._active_canvas
+        if previous is canvas:
+            return
+        if previous is not None:
+            # Background documents keep their pixels and history but no
+            # caches; idle time compresses all of their undo snapshots
+            previous._end_stroke()
+            previous.drawing = False
+            previous.release_caches()
+        self._active_canvas = canvas
+        # The toolbar's settings carry over to the document switched to
+        canvas.current_tool = self.current_tool
+        canvas.set_brush_size(self.size_slider.value())
+        canvas.set_brush_color(self.current_color)
+        canvas.brush_hardness = self.hardness_slider.value() / 100.0
+        canvas.brush_opacity = self.opacity_slider.value() / 100.0
+        canvas.brush_flow = self.flow_slider.value() / 100.0
+        canvas.gradient_kind = self.gradient_kind
+        canvas.gradient_stops = list(self.gradient_stops)
+        canvas.gradient_region = self.gradient_region
+        canvas.save_history = self.history_action.isChecked()
+        canvas.set_tool_cursor(self.current_tool)
+        self.blink_action.setChecked(canvas.compare_blink)
+        self.history_panel.set_canvas(canvas)
+        self.hide_job()
+        if canvas.job is not None:
+            self.show_job(canvas.job)
+        if canvas.file_path:
+            self.filmstrip.select_path(canvas.file_path)
+        self.update_title()
+
+    def idle_work(self, scheduler):
+        # The current document's housekeeping first, then the background ones'
+        for canvas in self.canvases():
+            canvas.idle_work(scheduler, canvas is self.canvas)
+        for i in range(self.tabs.count()):
+            self.update_tab(self.tabs.widget(i).canvas)
+
+    def update_tab(self, canvas):
+        index = self._tab_index(canvas)
+        if index < 0:
+            return
+        name = os.path.basename(canvas.file_path) if canvas.file_path else "Untitled"
+        self.tabs.setTabText(index, name + ("*" if canvas.modified else ""))
+        usage = canvas.memory_usage()
+        self.tabs.setTabToolTip(index, f"{canvas.file_path or 'Untitled'}\n"
+                                       f"Memory: image {format_bytes(usage['image'])}, "
+                                       f"undo {format_bytes(usage['history'])} ({len(canvas.history)} steps), "
+                                       f"caches {format_bytes(usage['caches'])}")
+
+    def _tab_index(self, canvas):
+        for i in range(self.tabs.count()):
+            if self.tabs.widget(i).canvas is canvas:
+                return i
+        return -1
+
+    def _thumbnail_ready(self, path, image):
+        path = os.path.abspath(path)
+        for i in range(self.tabs.count()):
+            file_path = self.tabs.widget(i).canvas.file_path
+            if file_path and os.path.abspath(file_path) == path:
+                self.tabs.setTabIcon(i, QIcon(QPixmap.fromImage(image)))
+
     def create_tool_button(self, text, tool_name):
         btn = QToolButton()
         btn.setCheckable(True)
@@ -901,7 +3623,7 @@ class PaintBrushApp(QMainWindow):
             "bucket": "bucket.svg",
             "eraser": "eraser.svg",
             "removebg": "remove_background.svg",
-            # "eyedrop": "eyedrop.svg",  # add if tool is added to UI
+            "eyedrop": "eyedrop.svg",
         }
         fname = icon_map.get(tool_name)
         icon_set = False
@@ -920,12 +3642,22 @@ class PaintBrushApp(QMainWindow):
         self.tool_group.addButton(btn)
         return btn
         
+    def create_percent_slider(self, text, slot):
+        slider = QSlider(Qt.Orientation.Horizontal)
+        slider.setRange(1, 100)
+        slider.setValue(100)
+        slider.setFixedWidth(70)
+        slider.setToolTip(text)
+        slider.valueChanged.connect(slot)
+        return slider
+
     def set_tool(self, tool_name):
         # Uncheck all buttons first
         for btn in self.tool_group.buttons():
             btn.setChecked(False)
             
         # Set the current tool in the canvas
+        self.current_tool = tool_name
         self.canvas.current_tool = tool_name
         
         # Update cursor to reflect selected tool
@@ -942,8 +3674,12 @@ class PaintBrushApp(QMainWindow):
             'square': self.square_btn,
             'circle': self.circle_btn,
             'bucket': self.bucket_btn,
+            'gradient': self.gradient_btn,
             'eraser': self.eraser_btn,
-            'removebg': self.removebg_btn
+            'removebg': self.removebg_btn,
+            'eyedrop': self.eyedrop_btn,
+            'crop': self.crop_btn,
+            'select': self.select_btn
         }
         if tool_name in tool_buttons:
             tool_buttons[tool_name].setChecked(True)
@@ -952,12 +3688,12 @@ class PaintBrushApp(QMainWindow):
         # Undo/Redo
         self.undo_shortcut = QAction(self)
         self.undo_shortcut.setShortcut("Ctrl+Z")
-        self.undo_shortcut.triggered.connect(self.canvas.undo)
+        self.undo_shortcut.triggered.connect(lambda: self.canvas.undo())
         self.addAction(self.undo_shortcut)
         
         self.redo_shortcut = QAction(self)
         self.redo_shortcut.setShortcut("Ctrl+Y")
-        self.redo_shortcut.triggered.connect(self.canvas.redo)
+        self.redo_shortcut.triggered.connect(lambda: self.canvas.redo())
         self.addAction(self.redo_shortcut)
         
         # Tool shortcuts
@@ -965,8 +3701,12 @@ class PaintBrushApp(QMainWindow):
             "B": "brush",
             "L": "line",
             "F": "bucket",
+            "G": "gradient",
             "E": "eraser",
             "R": "removebg",
+            "I": "eyedrop",
+            "C": "crop",
+            "M": "select",
         }
         
         for key, tool in shortcuts.items():
@@ -975,6 +3715,12 @@ class PaintBrushApp(QMainWindow):
             action.triggered.connect(lambda checked, t=tool: self.set_tool(t))
             self.addAction(action)
 
+        # Esc cancels a running background job
+        cancel_action = QAction(self)
+        cancel_action.setShortcut("Esc")
+        cancel_action.triggered.connect(lambda: self.canvas.cancel_job())
+        self.addAction(cancel_action)
+
         # Save As only
         save_as_action = QAction(self)
         save_as_action.setShortcut("Ctrl+Shift+S")
@@ -984,7 +3730,117 @@ class PaintBrushApp(QMainWindow):
     def setup_menu_bar(self):
         # Create menu bar
         menubar = self.menuBar()
+
+        # File menu
+        file_menu = menubar.addMenu("File")
+        new_tab_action = QAction("New Tab", self)
+        new_tab_action.setShortcut("Ctrl+T")
+        new_tab_action.triggered.connect(self.new_document)
+        file_menu.addAction(new_tab_action)
+        close_tab_action = QAction("Close Tab", self)
+        close_tab_action.setShortcut("Ctrl+W")
+        close_tab_action.triggered.connect(lambda: self.close_tab(self.tabs.currentIndex()))
+        file_menu.addAction(close_tab_action)
+        for text, shortcut, step in (("Next Tab", "Ctrl+Tab", 1), ("Previous Tab", "Ctrl+Shift+Tab", -1)):
+            action = QAction(text, self)
+            action.setShortcut(shortcut)
+            action.triggered.connect(lambda checked, s=step: self.tabs.setCurrentIndex(
+                (self.tabs.currentIndex() + s) % self.tabs.count()))
+            file_menu.addAction(action)
+        file_menu.addSeparator()
+        open_folder_action = QAction("Open Folder...", self)
+        open_folder_action.triggered.connect(self.open_folder_dialog)
+        file_menu.addAction(open_folder_action)
+        next_action = QAction("Next Image", self)
+        next_action.setShortcut("PgDown")
+        next_action.triggered.connect(lambda: self.step_folder(1))
+        file_menu.addAction(next_action)
+        previous_action = QAction("Previous Image", self)
+        previous_action.setShortcut("PgUp")
+        previous_action.triggered.connect(lambda: self.step_folder(-1))
+        file_menu.addAction(previous_action)
+        file_menu.addSeparator()
+        save_project_action = QAction("Save Project", self)
+        save_project_action.setShortcut("Ctrl+S")
+        save_project_action.triggered.connect(self.save_project)
+        file_menu.addAction(save_project_action)
+        self.history_action = QAction("Include Undo History in Projects", self)
+        self.history_action.setCheckable(True)
+        self.history_action.toggled.connect(lambda checked: setattr(self.canvas, 'save_history', checked))
+        file_menu.addAction(self.history_action)
+        file_menu.addSeparator()
+        export_palette_action = QAction("Export Palette PNG...", self)
+        export_palette_action.triggered.connect(self.export_palette_dialog)
+        file_menu.addAction(export_palette_action)
+
+        # Image menu
+        image_menu = menubar.addMenu("Image")
+        resize_action = QAction("Resize...", self)
+        resize_action.triggered.connect(self.resize_dialog)
+        image_menu.addAction(resize_action)
+        trim_action = QAction("Trim Borders...", self)
+        trim_action.triggered.connect(self.trim_dialog)
+        image_menu.addAction(trim_action)
+        despeckle_action = QAction("Despeckle...", self)
+        despeckle_action.triggered.connect(self.despeckle_dialog)
+        image_menu.addAction(despeckle_action)
+        tone_action = QAction("Adjust Tones...", self)
+        tone_action.setShortcut("Ctrl+L")
+        tone_action.triggered.connect(self.tone_dialog)
+        image_menu.addAction(tone_action)
+        filter_menu = image_menu.addMenu("Filter")
+        for kind, text in FILTER_NAMES.items():
+            action = QAction(text + "...", self)
+            action.triggered.connect(lambda checked, k=kind: self.filter_dialog(k))
+            filter_menu.addAction(action)
+        compare_menu = image_menu.addMenu("Compare")
+        compare_file_action = QAction("With File...", self)
+        compare_file_action.triggered.connect(self.compare_file_dialog)
+        compare_menu.addAction(compare_file_action)
+        compare_history_action = QAction("With Undo Step...", self)
+        compare_history_action.triggered.connect(self.compare_history_dialog)
+        compare_menu.addAction(compare_history_action)
+        compare_menu.addSeparator()
+        self.blink_action = QAction("Blink Instead of Heatmap", self)
+        self.blink_action.setCheckable(True)
+        self.blink_action.toggled.connect(lambda checked: self.canvas.set_compare_blink(checked))
+        compare_menu.addAction(self.blink_action)
+        next_difference_action = QAction("Next Difference", self)
+        next_difference_action.setShortcut("F3")
+        next_difference_action.triggered.connect(lambda: self.canvas.show_next_difference())
+        compare_menu.addAction(next_difference_action)
+        end_compare_action = QAction("End Comparison", self)
+        end_compare_action.triggered.connect(lambda: self.canvas.end_compare())
+        compare_menu.addAction(end_compare_action)
+        image_menu.addSeparator()
+        apply_frames_action = QAction("Apply Last Edit to All Frames", self)
+        apply_frames_action.setShortcut("Ctrl+Shift+A")
+        apply_frames_action.triggered.connect(lambda: self.canvas.apply_to_all_frames())
+        image_menu.addAction(apply_frames_action)
+        image_menu.addSeparator()
+        for text, slot in (("Rotate 90° Clockwise", lambda: self.canvas.rotate_image(1)),
+                           ("Rotate 180°", lambda: self.canvas.rotate_image(2)),
+                           ("Rotate 90° Counter-clockwise", lambda: self.canvas.rotate_image(3)),
+                           ("Flip Horizontal", lambda: self.canvas.flip_image(True)),
+                           ("Flip Vertical", lambda: self.canvas.flip_image(False))):
+            action = QAction(text, self)
+            action.triggered.connect(slot)
+            image_menu.addAction(action)
         
+        # View menu
+        view_menu = menubar.addMenu("View")
+        history_panel_action = QAction("History", self)
+        history_panel_action.setShortcut("Ctrl+H")
+        history_panel_action.setCheckable(True)
+        history_panel_action.toggled.connect(self.history_panel.setVisible)
+        view_menu.addAction(history_panel_action)
+        view_menu.addSeparator()
+        for text, shortcut, step in (("Next Frame", ".", 1), ("Previous Frame", ",", -1)):
+            action = QAction(text, self)
+            action.setShortcut(shortcut)
+            action.triggered.connect(lambda checked, s=step: self.canvas.step_frame(s))
+            view_menu.addAction(action)
+
         # Help menu
         help_menu = menubar.addMenu("Help")
         
@@ -993,6 +3849,58 @@ class PaintBrushApp(QMainWindow):
         about_action.triggered.connect(self.show_about_dialog)
         help_menu.addAction(about_action)
 
+        # Diagnostics
+        help_menu.addSeparator()
+        stall_action = QAction("Stall Report...", self)
+        stall_action.triggered.connect(self.show_stall_report)
+        help_menu.addAction(stall_action)
+        self.profile_action = QAction("Profile Session", self)
+        self.profile_action.setCheckable(True)
+        self.profile_action.setChecked(self.profiler.active)
+        self.profile_action.toggled.connect(self.toggle_profiling)
+        help_menu.addAction(self.profile_action)
+        self.trace_action = QAction("Record Input Trace", self)
+        self.trace_action.setCheckable(True)
+        self.trace_action.toggled.connect(self.toggle_trace)
+        help_menu.addAction(self.trace_action)
+
+    def show_stall_report(self):
+        msg = QMessageBox(self)
+        msg.setWindowTitle("Stall Report")
+        msg.setText(self.watchdog.report().split("\n\n")[0])
+        msg.setDetailedText(self.watchdog.report())
+        msg.exec()
+
+    def toggle_profiling(self, checked):
+        if checked:
+            self.profiler.start()
+            self.statusBar().showMessage("Profiling; uncheck Help > Profile Session to save the profile", 5000)
+            return
+        path = self.profile_path
+        if not path:
+            path, _ = QFileDialog.getSaveFileName(self, "Save Profile", "tabula_rasa.prof", "Profile (*.prof)")
+        self.profiler.stop(path)
+        if path:
+            self.statusBar().showMessage(f"Profile written to {path}", 5000)
+
+    def toggle_trace(self, checked):
+        # Record canvas input for headless replay with input_trace.py
+        if checked:
+            path = self.trace_path
+            if not path:
+                path, _ = QFileDialog.getSaveFileName(self, "Record Input Trace", "session.trace",
+                                                      "Input trace (*.trace)")
+            if not path:
+                self.trace_action.setChecked(False)
+                return
+            self.recorder = InputRecorder(self, path)
+            self.recorder.start()
+            self.statusBar().showMessage("Recording input; uncheck Help > Record Input Trace to stop", 5000)
+        elif self.recorder is not None:
+            self.recorder.stop()
+            self.statusBar().showMessage(f"Recorded {self.recorder.events:,} events to {self.recorder.path}", 5000)
+            self.recorder = None
+
     def show_about_dialog(self):
         # Load the app logo
         logo_path = os.path.join(self.assets_dir, "Tabula_rasa.png")
@@ -1010,7 +3918,7 @@ class PaintBrushApp(QMainWindow):
         <p><b>Features:</b></p>
         <ul>
             <li>Drawing tools (Brush, Line, Square, Circle)</li>
-            <li>Paint bucket fill tool</li>
+            <li>Paint bucket fill and gradient tools</li>
             <li>Eraser and background removal</li>
             <li>Zoom and pan controls</li>
             <li>Undo/Redo functionality</li>
@@ -1022,11 +3930,18 @@ class PaintBrushApp(QMainWindow):
             <li><b>B</b> - Brush tool</li>
             <li><b>L</b> - Line tool</li>
             <li><b>F</b> - Fill tool</li>
+            <li><b>G</b> - Gradient tool</li>
             <li><b>E</b> - Eraser</li>
             <li><b>R</b> - Remove background</li>
+            <li><b>I</b> - Eyedropper</li>
+            <li><b>C</b> - Crop</li>
             <li><b>Ctrl+Z</b> - Undo</li>
             <li><b>Ctrl+Y</b> - Redo</li>
+            <li><b>Ctrl+T</b> / <b>Ctrl+W</b> - New / Close Tab</li>
+            <li><b>Ctrl+Tab</b> - Next Tab</li>
+            <li><b>Ctrl+S</b> - Save Project</li>
             <li><b>Ctrl+Shift+S</b> - Save As</li>
+            <li><b>F3</b> - Next difference (Image &gt; Compare)</li>
             <li><b>Ctrl+Scroll</b> - Zoom</li>
         </ul>
         <br>
@@ -1077,12 +3992,29 @@ class PaintBrushApp(QMainWindow):
             p.drawRect(6, 6, 10, 8)
             p.drawLine(6, 6, 4, 10)
             p.drawEllipse(17, 16, 4, 6)
+        elif tool == "gradient":
+            # Box shaded from dark to light
+            ramp = QLinearGradient(5, 0, 19, 0)
+            ramp.setColorAt(0.0, Qt.GlobalColor.black)
+            ramp.setColorAt(1.0, Qt.GlobalColor.white)
+            p.setBrush(QBrush(ramp))
+            p.drawRect(5, 6, 14, 12)
         elif tool == "eraser":
             p.drawRect(6, 10, 12, 8)
             p.drawLine(6, 14, 18, 14)
         elif tool == "eyedrop":
             p.drawEllipse(5, 6, 6, 6)
             p.drawLine(10, 10, 18, 18)
+        elif tool == "crop":
+            # Two overlapping corner brackets
+            p.drawLine(7, 3, 7, 17)
+            p.drawLine(7, 17, 21, 17)
+            p.drawLine(3, 7, 17, 7)
+            p.drawLine(17, 7, 17, 21)
+        elif tool == "select":
+            # Dashed marquee
+            p.setPen(QPen(Qt.GlobalColor.black, 2, Qt.PenStyle.DashLine))
+            p.drawRect(4, 6, 16, 12)
         elif tool == "removebg":
             # Scissors icon for remove background
             p.drawLine(6, 6, 12, 12)
@@ -1096,6 +4028,19 @@ class PaintBrushApp(QMainWindow):
         p.end()
         return QIcon(pix)
     
+    def gradient_dialog(self):
+        dialog = GradientDialog(self, self.gradient_kind, self.gradient_stops, self.gradient_region)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        self.gradient_kind = dialog.kind()
+        self.gradient_stops = dialog.stops()
+        self.gradient_region = dialog.region_check.isChecked()
+        canvas = self.canvas
+        canvas.gradient_kind = self.gradient_kind
+        canvas.gradient_stops = list(self.gradient_stops)
+        canvas.gradient_region = self.gradient_region
+        self.set_tool("gradient")
+
     def choose_color(self):
         color = QColorDialog.getColor()
         if color.isValid():
@@ -1103,10 +4048,24 @@ class PaintBrushApp(QMainWindow):
             self.canvas.set_brush_color(color)
             self.update_color_button()
             
+    def set_picked_color(self, color):
+        self.current_color = color
+        self.update_color_button()
+        self.statusBar().showMessage(f"Picked {color.name()}", 5000)
+
     def update_brush_size(self, size):
         self.canvas.set_brush_size(size)
         if self.canvas.current_tool in ["brush", "line", "eraser"]:
             self.canvas.set_tool_cursor(self.canvas.current_tool)
+
+    def update_brush_hardness(self, value):
+        self.canvas.brush_hardness = value / 100.0
+
+    def update_brush_opacity(self, value):
+        self.canvas.brush_opacity = value / 100.0
+
+    def update_brush_flow(self, value):
+        self.canvas.brush_flow = value / 100.0
     
     
         
@@ -1145,78 +4104,317 @@ class PaintBrushApp(QMainWindow):
     def open_file_dialog(self):
         file_name, _ = QFileDialog.getOpenFileName(
             self, "Open Image", "", 
-            "Images (*.png *.xpm *.jpg *.jpeg *.bmp);;All Files (*)"
+            "Images (*.png *.xpm *.jpg *.jpeg *.bmp *.gif *.tif *.tiff *.btf *.svs *.tbr);;"
+            "Projects (*.tbr);;Arrays (*.npy *.raw *.bin);;All Files (*)"
         )
         if file_name:
-            self.canvas.open_image(file_name)
-            self.current_file_path = file_name
-            self.update_title()
+            if self.show_document(file_name):
+                return
+            # A new tab, unless the current one is an untouched blank canvas
+            if self.canvas.file_path or self.canvas.modified or self.canvas.job is not None:
+                self.new_document()
+            ext = os.path.splitext(file_name)[1].lower()
+            if ext in ('.npy', '.raw', '.bin'):
+                self.open_mapped_file(file_name, ext)
+            else:
+                self.canvas.open_image(file_name)
+
+    def show_document(self, file_name):
+        # Switch to the tab that already has file_name open, if any
+        for i, canvas in enumerate(self.canvases()):
+            if canvas.file_path and os.path.abspath(canvas.file_path) == os.path.abspath(file_name):
+                self.tabs.setCurrentIndex(i)
+                return True
+        return False
+
+    def open_mapped_file(self, file_name, ext):
+        shape, dtype, offset = None, None, 0
+        if ext != '.npy':
+            dialog = RawGeometryDialog(self, os.path.getsize(file_name))
+            if dialog.exec() != QDialog.DialogCode.Accepted:
+                return False
+            shape, dtype, offset = dialog.geometry_spec()
+        try:
+            self.canvas.open_mapped(file_name, shape, dtype, offset)
+        except (ValueError, OSError) as e:
+            QMessageBox.warning(self, "Open Array", f"Could not open {os.path.basename(file_name)}:\n{e}")
+            return False
+        return True
     
-    def save_file_dialog(self):
+    def save_file_dialog(self, background=True):
         file_name, _ = QFileDialog.getSaveFileName(
             self, "Save Image", "", 
-            "PNG (*.png);;JPEG (*.jpg *.jpeg);;BMP (*.bmp);;All Files (*)"
+            "PNG (*.png);;JPEG (*.jpg *.jpeg);;BMP (*.bmp);;TIFF (*.tif *.tiff);;Animated GIF (*.gif);;NumPy (*.npy);;"
+            "Project (*.tbr);;All Files (*)"
         )
         if file_name:
-            self.canvas.save_image(file_name)
-            self.current_file_path = file_name
-            self.canvas.modified = False
-            self.update_title()
+            self.canvas.save_image(file_name, background)
+
+    def save_project(self):
+        # Save back into the open project (only the edited tiles are written);
+        # anything else is first given a project file name
+        file_name = self.current_file_path
+        if not file_name or not is_project(file_name):
+            file_name, _ = QFileDialog.getSaveFileName(self, "Save Project", "", "Project (*.tbr)")
+            if not file_name:
+                return
+            if not is_project(file_name):
+                file_name += ".tbr"
+        self.canvas.save_image(file_name)
+
+    def open_folder_dialog(self):
+        folder = QFileDialog.getExistingDirectory(self, "Open Folder")
+        if folder:
+            self.open_folder(folder)
+
+    def open_folder(self, folder):
+        if not self.filmstrip.set_folder(folder):
+            self.statusBar().showMessage(f"No images in {folder}", 5000)
+            return
+        self.filmstrip.show()
+        self.open_folder_image(self.filmstrip.paths()[0])
+
+    def step_folder(self, step):
+        path = self.filmstrip.neighbor(self.current_file_path, step)
+        if path is not None:
+            self.open_folder_image(path)
+
+    def open_folder_image(self, path):
+        if self.canvas.job is not None or path == self.current_file_path:
+            return
+        if not self.maybe_save():
+            self.filmstrip.select_path(self.current_file_path or "")
+            return
+        # Prefetched neighbors open synchronously, without a decode
+        self.canvas.open_image(path, decoded=self.prefetcher.take(path))
+
+    def document_opened(self, canvas, file_name):
+        canvas.file_path = file_name
+        self._request_tab_icon(canvas)
+        if canvas is not self.canvas:
+            self.update_tab(canvas)
+            return
+        self.update_title()
+        if self.filmstrip.select_path(file_name):
+            self.prefetcher.prefetch(p for p in (self.filmstrip.neighbor(file_name, 1),
+                                                 self.filmstrip.neighbor(file_name, -1)) if p)
+
+    def document_saved(self, canvas, file_name):
+        canvas.file_path = file_name
+        canvas.modified = False
+        self.update_title()
+        self.update_tab(canvas)
+        self.filmstrip.refresh(file_name)
+        self._request_tab_icon(canvas)
+
+    def _request_tab_icon(self, canvas):
+        # The file's thumbnail, shared with the filmstrip, as the tab's icon
+        index = self._tab_index(canvas)
+        image = self.thumbnails.cached(canvas.file_path)
+        if image is not None:
+            self.tabs.setTabIcon(index, QIcon(QPixmap.fromImage(image)))
+        else:
+            self.tabs.setTabIcon(index, QIcon())
+            self.thumbnails.request(canvas.file_path)
+
+    def show_job(self, job):
+        self.job_label.setText(f"{job.label}...")
+        # Busy indicator until the job reports progress
+        self.job_progress.setRange(0, 0)
+        job.progress.connect(self.update_job_progress)
+        for widget in (self.job_label, self.job_progress, self.job_cancel):
+            widget.show()
+
+    def update_job_progress(self, fraction):
+        if self.canvas.job is not None and self.canvas.job is self.sender():
+            self.job_progress.setRange(0, 1000)
+            self.job_progress.setValue(int(fraction * 1000))
+
+    def hide_job(self):
+        for widget in (self.job_label, self.job_progress, self.job_cancel):
+            widget.hide()
+
+    def compare_file_dialog(self):
+        file_name, _ = QFileDialog.getOpenFileName(
+            self, "Compare with File", "", "Images (*.png *.jpg *.jpeg *.bmp *.tif *.tiff);;All Files (*)")
+        if file_name:
+            self.canvas.compare_with_file(file_name)
+
+    def compare_history_dialog(self):
+        history = list(self.canvas.history)
+        if len(history) < 2:
+            self.statusBar().showMessage("There are no earlier undo steps to compare with", 5000)
+            return
+        labels = [f"{i}: {history_label(state)}" for i, state in enumerate(history[:-1])]
+        labels[0] += " (oldest)"
+        label, ok = QInputDialog.getItem(self, "Compare with Undo Step", "Compare the image with:",
+                                         labels, 0, False)
+        if ok:
+            self.canvas.compare_with_history(labels.index(label))
+
+    def export_palette_dialog(self):
+        dialog = PaletteExportDialog(self)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        file_name, _ = QFileDialog.getSaveFileName(self, "Export Palette PNG", "", "PNG (*.png)")
+        if file_name:
+            self.canvas.export_palette_png(file_name, dialog.colors_spin.value(),
+                                           dialog.dither_check.isChecked())
+
+    def resize_dialog(self):
+        dialog = ResizeDialog(self, self.canvas.doc_size())
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        self.canvas.resize_image(dialog.width_spin.value(), dialog.height_spin.value(),
+                                 dialog.filter_combo.currentData())
+        self.update_title()
+
+    def trim_dialog(self):
+        dialog = TrimDialog(self)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        background = dialog.background_combo.currentData()
+        if background == "brush":
+            background = self.canvas.brush_color
+        self.canvas.trim_borders(background, dialog.tolerance_spin.value())
+        self.update_title()
+
+    def tone_dialog(self):
+        if self.canvas.source is not None:
+            self.statusBar().showMessage("Tone adjustments are not available on tiled images", 5000)
+            return
+        dialog = ToneDialog(self, self.canvas)
+        accepted = dialog.exec() == QDialog.DialogCode.Accepted
+        lut = dialog.lut()
+        self.canvas.set_tone_preview(None)
+        if accepted and lut is not None:
+            self.canvas.adjust_tones(lut)
+        self.update_title()
+
+    def despeckle_dialog(self):
+        if self.canvas.source is not None:
+            self.statusBar().showMessage("Despeckle is not available on tiled images", 5000)
+            return
+        region = self.canvas.filter_region()
+        dialog = DespeckleDialog(self, region, region.size() != self.canvas.image.size())
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        background = dialog.background_combo.currentData()
+        if background == "brush":
+            background = self.canvas.brush_color
+        self.canvas.despeckle(background, dialog.tolerance_spin.value(), dialog.size_spin.value())
+        self.update_title()
+
+    def filter_dialog(self, kind):
+        if self.canvas.source is not None:
+            self.statusBar().showMessage("Filters are not available on tiled images", 5000)
+            return
+        region = self.canvas.filter_region()
+        dialog = FilterDialog(self, kind, region, region.size() != self.canvas.image.size())
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        self.canvas.apply_filter(kind, dialog.radius_spin.value(), dialog.amount_spin.value() / 100,
+                                 dialog.threshold_spin.value())
+        self.update_title()
 
     def update_title(self):
         name = os.path.basename(self.current_file_path) if self.current_file_path else "Untitled"
         star = "*" if getattr(self.canvas, 'modified', False) else ""
         self.setWindowTitle(f"Tabula Rasa - {name}{star}")
+        self.update_tab(self.canvas)
+
+    def maybe_save(self):
+        # Ask whether to save unsaved changes before the document is replaced
+        # or closed; False means stay on it
+        if not getattr(self.canvas, 'modified', False):
+            return True
+        msg = QMessageBox(self)
+        msg.setIcon(QMessageBox.Icon.Warning)
+        msg.setWindowTitle("Unsaved Changes")
+        msg.setText("You have unsaved changes.")
+        msg.setInformativeText("Do you want to save your changes?")
+        msg.setStandardButtons(QMessageBox.StandardButton.Save |
+                               QMessageBox.StandardButton.Discard |
+                               QMessageBox.StandardButton.Cancel)
+        msg.setDefaultButton(QMessageBox.StandardButton.Save)
+        # Ensure readable text/buttons on forced light background
+        msg.setStyleSheet(
+            "QMessageBox { background: #FFFFFF; }"
+            "QLabel { color: #111827; }"
+            "QPushButton { color: #111827; background: #F3F4F6; border: 1px solid #D1D5DB; border-radius: 6px; padding: 4px 10px; }"
+            "QPushButton:hover { background: #F9FAFB; }"
+        )
+        # Explicitly set button texts and remove icons to avoid icon-only rendering
+        for sb, text in [
+            (QMessageBox.StandardButton.Save, "Save"),
+            (QMessageBox.StandardButton.Discard, "Discard"),
+            (QMessageBox.StandardButton.Cancel, "Cancel"),
+        ]:
+            btn = msg.button(sb)
+            if btn is not None:
+                btn.setText(text)
+                btn.setIcon(QIcon())
+        ret = msg.exec()
+        if ret == QMessageBox.StandardButton.Save:
+            # Let a running edit land first, so it is part of what is saved
+            self.canvas.finish_job()
+            self.save_file_dialog(background=False)
+            # Still modified if the save was canceled or failed
+            return not getattr(self.canvas, 'modified', False)
+        return ret == QMessageBox.StandardButton.Discard
 
     def closeEvent(self, event):
-        # Prompt to save if there are unsaved changes
-        if getattr(self.canvas, 'modified', False):
-            msg = QMessageBox(self)
-            msg.setIcon(QMessageBox.Icon.Warning)
-            msg.setWindowTitle("Unsaved Changes")
-            msg.setText("You have unsaved changes.")
-            msg.setInformativeText("Do you want to save your changes?")
-            msg.setStandardButtons(QMessageBox.StandardButton.Save |
-                                   QMessageBox.StandardButton.Discard |
-                                   QMessageBox.StandardButton.Cancel)
-            msg.setDefaultButton(QMessageBox.StandardButton.Save)
-            # Ensure readable text/buttons on forced light background
-            msg.setStyleSheet(
-                "QMessageBox { background: #FFFFFF; }"
-                "QLabel { color: #111827; }"
-                "QPushButton { color: #111827; background: #F3F4F6; border: 1px solid #D1D5DB; border-radius: 6px; padding: 4px 10px; }"
-                "QPushButton:hover { background: #F9FAFB; }"
-            )
-            # Explicitly set button texts and remove icons to avoid icon-only rendering
-            for sb, text in [
-                (QMessageBox.StandardButton.Save, "Save"),
-                (QMessageBox.StandardButton.Discard, "Discard"),
-                (QMessageBox.StandardButton.Cancel, "Cancel"),
-            ]:
-                btn = msg.button(sb)
-                if btn is not None:
-                    btn.setText(text)
-                    btn.setIcon(QIcon())
-            ret = msg.exec()
-            if ret == QMessageBox.StandardButton.Save:
-                self.save_file_dialog()
-                if getattr(self.canvas, 'modified', False):
-                    # Save was canceled or failed
+        # Prompt to save each document with unsaved changes, showing it first
+        for i in range(self.tabs.count()):
+            if self.tabs.widget(i).canvas.modified:
+                self.tabs.setCurrentIndex(i)
+                if not self.maybe_save():
                     event.ignore()
                     return
-                event.accept()
-            elif ret == QMessageBox.StandardButton.Discard:
-                event.accept()
-            else:
-                event.ignore()
-        else:
-            event.accept()
+        event.accept()
+        for canvas in self.canvases():
+            canvas.end_job()
+            # Removes the temporary files of edited frames
+            canvas._set_stack(None)
+        self.idle.shutdown()
+        self.thumbnails.shutdown()
+        self.prefetcher.shutdown()
+        if self.recorder is not None:
+            self.trace_action.setChecked(False)
+        if self.profiler.active:
+            path = self.profile_path or os.path.join(os.path.expanduser("~"), "tabula_rasa.prof")
+            self.profiler.stop(path)
+            logging.getLogger("tabula_rasa").info("Profile written to %s", path)
 
-    # No plain Save; use Save As only
+    # Images are written with Save As; Save (Ctrl+S) is for projects
 
 def main():
-    app = QApplication(sys.argv)
-    window = PaintBrushApp()
+    # Apply to All Frames uses spawned worker processes; in a frozen build
+    # they start this executable, which must run the worker instead of the app
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="Tabula Rasa")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="profile the session with cProfile and write the stats to FILE on exit")
+    parser.add_argument("--stall-threshold", metavar="MS", type=float, default=250,
+                        help="log GUI stalls longer than MS milliseconds (default 250)")
+    parser.add_argument("--record-trace", metavar="FILE",
+                        help="record canvas input to FILE for replay with input_trace.py")
+    parser.add_argument("--serve", action="store_true",
+                        help="run headless, serving JSON jobs over --socket or --port (see server.py)")
+    parser.add_argument("--socket", metavar="PATH", help="with --serve: listen on this Unix socket")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="with --serve: listen on this localhost port (default 8765)")
+    parser.add_argument("--jobs", type=int, default=0, help="with --serve: jobs run at once (default: CPU count)")
+    parser.add_argument("--queue", type=int, default=16,
+                        help="with --serve: jobs waiting beyond those before requests are refused (default 16)")
+    args, qt_args = parser.parse_known_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s: %(message)s")
+    if args.serve:
+        from server import serve
+        sys.exit(serve(args.socket, args.port, args.jobs or None, args.queue))
+    app = QApplication(sys.argv[:1] + qt_args)
+    window = PaintBrushApp(profile_path=args.profile, stall_threshold=args.stall_threshold / 1000,
+                           trace_path=args.record_trace)
     window.show()
     sys.exit(app.exec())
 
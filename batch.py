@@ -0,0 +1,130 @@
+"""
+Headless batch processing of a folder of images, without the GUI.
+
+    python batch.py trim SCANS [--out DIR] [--tolerance N] [--background corner|#rrggbb]
+    python batch.py despeckle SCANS [--out DIR] [--max-size N] [--tolerance N] [--background ...]
+
+Files are processed in parallel; results are written to --out (by default
+a subfolder of the input folder) in the same format, PNGs compacted the
+same way the app saves them.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtGui import QColor
+
+from image_io import image_files, load_image, save_image, ensure_app
+from image_ops import qimage_view, pixel_value, corner_color, despeckle, trim
+
+def _trim_file(path, out_dir, background, tolerance, dry_run):
+    start = time.perf_counter()
+    image = load_image(path)
+    t0 = time.perf_counter()
+    trimmed, box = trim(image, background, tolerance)
+    detect = time.perf_counter() - t0
+    name = os.path.basename(path)
+    if box is None:
+        return f"{name}: all background, skipped"
+    if trimmed is None:
+        return f"{name}: no border"
+    if not dry_run:
+        save_image(trimmed, os.path.join(out_dir, name))
+    return (f"{name}: {image.width()} x {image.height()} -> {box[2]} x {box[3]} at ({box[0]}, {box[1]}) "
+            f"[detect {detect * 1000:.1f} ms, total {time.perf_counter() - start:.2f} s]")
+
+
+def despeckle_image(image, background=None, max_size=20, tolerance=0):
+    """ (copy of `image` with the blobs under `max_size` pixels filled, blobs removed, pixels changed) """
+    image = image.copy()
+    view = qimage_view(image)
+    value = corner_color(view) if background is None else pixel_value(background.getRgb(), image.format())
+    removed, pixels = despeckle(view, value, max_size, tolerance * (257 if view.dtype.itemsize == 2 else 1))
+    return image, removed, pixels
+
+
+def _despeckle_file(path, out_dir, background, max_size, tolerance, dry_run):
+    start = time.perf_counter()
+    image = load_image(path)
+    t0 = time.perf_counter()
+    cleaned, removed, pixels = despeckle_image(image, background, max_size, tolerance)
+    detect = time.perf_counter() - t0
+    name = os.path.basename(path)
+    if not removed:
+        return f"{name}: no specks"
+    if not dry_run:
+        save_image(cleaned, os.path.join(out_dir, name))
+    return (f"{name}: removed {removed:,} specks ({pixels:,} pixels) "
+            f"[despeckle {detect * 1000:.0f} ms, total {time.perf_counter() - start:.2f} s]")
+
+
+def _run_folder(args, default_out, process, *options):
+    # process(path, out_dir, background, *options, dry_run) for every image in
+    # args.folder on a thread pool, printing the line each returns
+    files = image_files(args.folder)
+    if not files:
+        print(f"No images in {args.folder}")
+        return 1
+    out_dir = args.out or os.path.join(args.folder, default_out)
+    if not args.dry_run:
+        os.makedirs(out_dir, exist_ok=True)
+    background = None if args.background == "corner" else QColor(args.background)
+    if background is not None and not background.isValid():
+        print(f"Unknown color {args.background}")
+        return 2
+    failed = 0
+    # QImage decoding, encoding and the numpy scans release the GIL
+    with ThreadPoolExecutor(args.jobs or os.cpu_count() or 4) as pool:
+        futures = [pool.submit(process, path, out_dir, background, *options, args.dry_run)
+                   for path in files]
+        for path, future in zip(files, futures):
+            try:
+                print(future.result(), flush=True)
+            except Exception as e:
+                failed += 1
+                print(f"{os.path.basename(path)}: failed: {e}", flush=True)
+    return 1 if failed else 0
+
+
+def run_trim(args):
+    return _run_folder(args, "trimmed", _trim_file, args.tolerance)
+
+
+def run_despeckle(args):
+    return _run_folder(args, "despeckled", _despeckle_file, args.max_size, args.tolerance)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tabula Rasa batch processing")
+    commands = parser.add_subparsers(dest="command", required=True)
+    trim_parser = commands.add_parser("trim", help="crop uniform borders off every image in a folder")
+    trim_parser.add_argument("folder")
+    trim_parser.add_argument("--out", metavar="DIR", help="output folder (default FOLDER/trimmed)")
+    trim_parser.add_argument("--tolerance", type=int, default=10,
+                             help="per-channel difference still counted as background, 0-255 (default 10)")
+    trim_parser.add_argument("--background", default="corner",
+                             help="'corner' (the color of the corners, default) or a color such as #ffffff")
+    trim_parser.add_argument("--dry-run", action="store_true", help="report the boxes without writing files")
+    trim_parser.add_argument("--jobs", type=int, default=0, help="files processed at once (default: CPU count)")
+    trim_parser.set_defaults(run=run_trim)
+    despeckle_parser = commands.add_parser("despeckle", help="remove small specks (dust) from every image in a folder")
+    despeckle_parser.add_argument("folder")
+    despeckle_parser.add_argument("--out", metavar="DIR", help="output folder (default FOLDER/despeckled)")
+    despeckle_parser.add_argument("--max-size", type=int, default=20,
+                                  help="blobs of fewer pixels than this are removed (default 20)")
+    despeckle_parser.add_argument("--tolerance", type=int, default=30,
+                                  help="per-channel difference still counted as background, 0-255 (default 30)")
+    despeckle_parser.add_argument("--background", default="corner",
+                                  help="'corner' (the color of the corners, default) or a color such as #ffffff")
+    despeckle_parser.add_argument("--dry-run", action="store_true", help="report the counts without writing files")
+    despeckle_parser.add_argument("--jobs", type=int, default=0, help="files processed at once (default: CPU count)")
+    despeckle_parser.set_defaults(run=run_despeckle)
+    args = parser.parse_args()
+    ensure_app()
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -35,12 +35,24 @@ def main():
         "--icon=TabulaRasa.icns",  # App icon
         "--add-data=assets:assets",  # Include assets folder
         "--add-data=resource_path.py:.",  # Include resource path helper
+        "--hidden-import=batch",
+        "--hidden-import=diagnostics",
+        "--hidden-import=filmstrip",
+        "--hidden-import=frames",
+        "--hidden-import=image_io",
+        "--hidden-import=idle",
+        "--hidden-import=image_ops",
+        "--hidden-import=input_trace",
+        "--hidden-import=jobs",
+        "--hidden-import=project",
+        "--hidden-import=server",
         "--hidden-import=PyQt6.QtCore",
         "--hidden-import=PyQt6.QtGui", 
         "--hidden-import=PyQt6.QtWidgets",
         "--hidden-import=PIL",
         "--hidden-import=PIL.Image",
         "--hidden-import=PIL.ImageQt",
+        "--hidden-import=numpy",
         "--osx-bundle-identifier=com.tabularasa.app",  # Bundle ID
         "Tabula_rasa.py"
     ]
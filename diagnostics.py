@@ -0,0 +1,145 @@
+"""
+Event-loop stall watchdog and session profiler, for turning "it froze"
+reports into something that points at code.
+"""
+import cProfile
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from PyQt6.QtCore import QObject, QTimer
+
+log = logging.getLogger("tabula_rasa.stalls")
+
+# Upper edges of the stall duration histogram buckets, in multiples of the threshold
+STALL_BUCKETS = (2, 4, 8, 20, 40, float("inf"))
+
+
+class StallWatchdog(QObject):
+    """ Measure GUI event-loop latency and record stalls.
+
+    A timer on the GUI thread stamps a heartbeat every `interval` seconds;
+    a helper thread watches the heartbeat, and once it is `threshold` late
+    grabs the GUI thread's Python stack. When the loop comes back the stall
+    is logged with that stack and counted in the histogram.
+    """
+
+    def __init__(self, threshold=0.25, interval=0.05, keep=20, parent=None):
+        super().__init__(parent)
+        self.threshold = threshold
+        self.interval = interval
+        self.counts = [0] * len(STALL_BUCKETS)
+        self.recent = deque(maxlen=keep)  # (start wall time, seconds, stack text)
+        self.worst_latency = 0.0
+        self._lock = threading.Lock()
+        self._main_ident = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stack = None  # (heartbeat it was late for, stack text)
+        self._running = False
+        self._timer = QTimer(self)
+        self._timer.setInterval(int(interval * 1000))
+        self._timer.timeout.connect(self._heartbeat)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._beat = time.monotonic()
+        self._timer.start()
+        threading.Thread(target=self._watch, name="stall-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._running = False
+        self._timer.stop()
+
+    def _heartbeat(self):
+        now = time.monotonic()
+        beat, self._beat = self._beat, now
+        late = now - beat - self.interval
+        if late > self.worst_latency:
+            self.worst_latency = late
+        captured, self._stack = self._stack, None
+        if late >= self.threshold:
+            self._record(late, captured[1] if captured and captured[0] == beat else None)
+
+    def _watch(self):
+        while self._running:
+            time.sleep(self.interval / 2)
+            beat = self._beat
+            late = time.monotonic() - beat - self.interval
+            if late >= self.threshold and self._stack is None:
+                frame = sys._current_frames().get(self._main_ident)
+                if frame is not None:
+                    self._stack = (beat, "".join(traceback.format_stack(frame)))
+                # Holding the frame would keep its locals (a paint event's
+                # QPainter, say) alive past their scope
+                del frame
+
+    def _record(self, seconds, stack):
+        with self._lock:
+            for i, factor in enumerate(STALL_BUCKETS):
+                if seconds < self.threshold * factor:
+                    self.counts[i] += 1
+                    break
+            self.recent.append((time.time() - seconds, seconds, stack or ""))
+        log.warning("GUI event loop stalled for %.0f ms%s", seconds * 1000,
+                    f"; main thread was at:\n{stack}" if stack else "")
+
+    def histogram(self):
+        """ [(bucket label, count)] of the stalls seen so far """
+        labels, low = [], self.threshold
+        for factor in STALL_BUCKETS:
+            if factor == float("inf"):
+                labels.append(f">= {low * 1000:.0f} ms")
+            else:
+                high = self.threshold * factor
+                labels.append(f"{low * 1000:.0f}-{high * 1000:.0f} ms")
+                low = high
+        with self._lock:
+            return list(zip(labels, self.counts))
+
+    def report(self):
+        """ Plain-text summary: histogram and the most recent stalls with stacks """
+        lines = [f"Stalls over {self.threshold * 1000:.0f} ms "
+                 f"(worst event-loop latency {self.worst_latency * 1000:.0f} ms):"]
+        lines += [f"  {label:>16}: {count}" for label, count in self.histogram()]
+        with self._lock:
+            recent = list(self.recent)
+        for started, seconds, stack in reversed(recent):
+            stamp = time.strftime("%H:%M:%S", time.localtime(started))
+            lines.append(f"\n{stamp}  {seconds * 1000:.0f} ms")
+            if stack:
+                lines.append(stack.rstrip())
+        return "\n".join(lines)
+
+
+class SessionProfiler:
+    """ cProfile of the GUI thread between start() and stop(), saved as a .prof file """
+
+    def __init__(self):
+        self._profile = None
+
+    @property
+    def active(self):
+        return self._profile is not None
+
+    def start(self):
+        if self._profile is None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self, path=None):
+        """ Stop profiling and write the stats to `path` (None discards them).
+
+        The file loads with pstats or snakeviz.
+        """
+        if self._profile is None:
+            return False
+        self._profile.disable()
+        profile, self._profile = self._profile, None
+        if path:
+            profile.dump_stats(path)
+        return True
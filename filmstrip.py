@@ -0,0 +1,238 @@
+"""
+Folder filmstrip: thumbnails of the images in a folder, made on a worker
+pool and cached on disk, plus decoding of the neighboring images ahead of
+time so stepping through the folder doesn't wait on the decoder.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import QObject, QSize, QStandardPaths, Qt, pyqtSignal
+from PyQt6.QtGui import QIcon, QImage, QImageReader, QPixmap
+from PyQt6.QtWidgets import QListView, QListWidget, QListWidgetItem
+
+from image_io import image_files, file_key
+
+THUMBNAIL_SIZE = 128
+# Thumbnails also kept in memory, for the filmstrip and the document tabs alike
+MEMORY_THUMBNAILS = 256
+
+
+def default_cache_dir():
+    base = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.GenericCacheLocation)
+    return os.path.join(base or os.path.expanduser("~/.cache"), "tabula_rasa", "thumbnails")
+
+
+class ThumbnailLoader(QObject):
+    """ Make thumbnails on a worker pool, cached on disk by path, mtime and size.
+
+    request() returns at once; `ready(path, image)` follows on the GUI
+    thread when the thumbnail is available. Bumping the generation with
+    clear() drops the requests still queued for a previous folder. The
+    most recent thumbnails are also kept in memory, so every view asking
+    for the same file shares one copy.
+    """
+    ready = pyqtSignal(str, QImage)
+
+    def __init__(self, cache_dir=None, size=THUMBNAIL_SIZE, workers=None, parent=None):
+        super().__init__(parent)
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.size = size
+        self._pool = ThreadPoolExecutor(workers or os.cpu_count() or 4, thread_name_prefix="thumbnail")
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # file_key -> QImage
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+
+    def request(self, path):
+        with self._lock:
+            generation = self._generation
+        self._pool.submit(self._load, path, generation)
+
+    def cached(self, path):
+        """ The thumbnail of `path` if it is in memory and current, else None """
+        try:
+            key = file_key(path)
+        except OSError:
+            return None
+        with self._lock:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+            return image
+
+    def shutdown(self):
+        self.clear()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def cache_path(self, key):
+        digest = hashlib.sha1(f"{key[0]}|{key[1]}|{key[2]}|{self.size}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".png")
+
+    def _load(self, path, generation):
+        if generation != self._generation:
+            return
+        try:
+            key = file_key(path)
+        except OSError:
+            return
+        image = self.cached(path)
+        if image is not None:
+            if generation == self._generation:
+                self.ready.emit(path, image)
+            return
+        cached = self.cache_path(key)
+        image = QImage(cached) if os.path.exists(cached) else QImage()
+        if image.isNull():
+            image = self._make(path)
+            if image.isNull():
+                return
+            try:
+                os.makedirs(os.path.dirname(cached), exist_ok=True)
+                tmp_name = f"{cached}.{threading.get_ident()}.tmp"
+                if image.save(tmp_name, "PNG"):
+                    os.replace(tmp_name, cached)
+            except OSError:
+                pass  # An unwritable cache only costs the next run some time
+        with self._lock:
+            self._memory[key] = image
+            while len(self._memory) > MEMORY_THUMBNAILS:
+                self._memory.popitem(last=False)
+        if generation == self._generation:
+            self.ready.emit(path, image)
+
+    def _make(self, path):
+        reader = QImageReader(path)
+        reader.setAutoTransform(True)
+        size = reader.size()
+        if size.isValid():
+            # Let the decoder scale down while decoding (JPEG decodes at 1/2..1/8 directly)
+            reader.setScaledSize(size.scaled(self.size, self.size, Qt.AspectRatioMode.KeepAspectRatio))
+        image = reader.read()
+        if image.isNull():
+            return image
+        if image.width() > self.size or image.height() > self.size:
+            image = image.scaled(self.size, self.size, Qt.AspectRatioMode.KeepAspectRatio,
+                                 Qt.TransformationMode.SmoothTransformation)
+        return image
+
+
+class Prefetcher:
+    """ Decode a few images ahead of time with `decode(path)` on a worker thread.
+
+    take() hands over a prefetched image if the file hasn't changed since;
+    one still being decoded is waited for, as that beats starting over.
+    """
+
+    def __init__(self, decode, keep=3):
+        self._decode = decode
+        self.keep = keep
+        self._pool = ThreadPoolExecutor(1, thread_name_prefix="prefetch")
+        self._futures = OrderedDict()  # file_key -> Future
+
+    def prefetch(self, paths):
+        for path in paths:
+            try:
+                key = file_key(path)
+            except OSError:
+                continue
+            if key in self._futures:
+                self._futures.move_to_end(key)
+            else:
+                self._futures[key] = self._pool.submit(self._decode, path)
+        while len(self._futures) > self.keep:
+            _, future = self._futures.popitem(last=False)
+            future.cancel()
+
+    def take(self, path):
+        """ The decoded image of `path`, or None if it wasn't prefetched (or failed) """
+        try:
+            future = self._futures.pop(file_key(path), None)
+        except OSError:
+            return None
+        if future is None or future.cancelled():
+            return None
+        try:
+            return future.result()
+        except Exception:
+            return None
+
+    def shutdown(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class Filmstrip(QListWidget):
+    """ One row of thumbnails of the images in a folder; emits imageChosen(path) on click """
+    imageChosen = pyqtSignal(str)
+
+    def __init__(self, loader, parent=None):
+        super().__init__(parent)
+        self.folder = None
+        self.loader = loader
+        self._items = {}  # absolute path -> item
+        self.setViewMode(QListView.ViewMode.IconMode)
+        self.setFlow(QListView.Flow.LeftToRight)
+        self.setWrapping(False)
+        self.setMovement(QListView.Movement.Static)
+        self.setUniformItemSizes(True)
+        self.setIconSize(QSize(96, 96))
+        self.setGridSize(QSize(112, 124))
+        self.setFixedHeight(148)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        placeholder = QPixmap(96, 96)
+        placeholder.fill(Qt.GlobalColor.lightGray)
+        self._placeholder = QIcon(placeholder)
+        self.itemClicked.connect(lambda item: self.imageChosen.emit(item.data(Qt.ItemDataRole.UserRole)))
+        loader.ready.connect(self._thumbnail_ready)
+
+    def set_folder(self, folder):
+        self.loader.clear()
+        self.clear()
+        self._items.clear()
+        self.folder = folder
+        for path in image_files(folder):
+            item = QListWidgetItem(self._placeholder, os.path.basename(path))
+            item.setData(Qt.ItemDataRole.UserRole, path)
+            item.setToolTip(path)
+            self.addItem(item)
+            self._items[os.path.abspath(path)] = item
+            self.loader.request(path)
+        return self.count()
+
+    def paths(self):
+        return [self.item(i).data(Qt.ItemDataRole.UserRole) for i in range(self.count())]
+
+    def select_path(self, path):
+        """ Highlight `path` if it is in the strip; returns whether it is """
+        item = self._items.get(os.path.abspath(path))
+        if item is None:
+            return False
+        self.setCurrentItem(item)
+        self.scrollToItem(item)
+        return True
+
+    def neighbor(self, path, step):
+        """ The image `step` places from `path` in the strip (None past either end) """
+        item = self._items.get(os.path.abspath(path)) if path else None
+        row = self.row(item) + step if item is not None else (0 if step > 0 else self.count() - 1)
+        if 0 <= row < self.count():
+            return self.item(row).data(Qt.ItemDataRole.UserRole)
+        return None
+
+    def refresh(self, path):
+        # The file changed (saved over): make its thumbnail again
+        if os.path.abspath(path) in self._items:
+            self.loader.request(path)
+
+    def _thumbnail_ready(self, path, image):
+        item = self._items.get(os.path.abspath(path))
+        if item is not None:
+            item.setIcon(QIcon(QPixmap.fromImage(image)))
@@ -0,0 +1,413 @@
+"""
+Multi-frame documents: the pages of a multi-page TIFF or the frames of an
+animated GIF, decoded one at a time as they are looked at.
+
+Decoded frames are kept in an LRU cache bounded in bytes and a worker
+decodes the neighbors of the frame in view ahead of time, so scrubbing
+through hundreds of frames stays smooth while memory stays at the cache
+size. Edited frames are compressed to files in a temporary folder rather
+than kept in memory, and apply_to_frames() runs one operation over many
+frames on a pool of processes.
+"""
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import numpy as np
+from PyQt6.QtCore import QObject, QRect, pyqtSignal
+from PyQt6.QtGui import QImage, QImageReader
+
+from image_io import write_multipage_tiff, ensure_app
+from image_ops import (qimage_view, wrap_array, editable_image, rgb_index, rotate90, flip, apply_lut,
+                       make_transparent, named_filter, with_alpha, PackedImage, ALPHA_FORMATS)
+
+log = logging.getLogger("tabula_rasa.frames")
+
+FRAME_EXTENSIONS = ('.tif', '.tiff', '.gif')
+# Budget for decoded frames kept by a FrameStack
+DEFAULT_FRAME_CACHE_BYTES = 512 * 1024 * 1024
+# Frames decoded ahead on each side of the one in view
+PREFETCH_FRAMES = 2
+# Edited frames written out by a FrameStack or the apply_to_frames() workers
+FRAME_SUFFIX = ".frame"
+
+
+def frame_count(path):
+    """ Number of frames in `path` if it is a TIFF or GIF holding more than one, else 0 """
+    if not path.lower().endswith(FRAME_EXTENSIONS):
+        return 0
+    reader = QImageReader(path)
+    count = reader.imageCount() if reader.canRead() else 0
+    return count if count > 1 else 0
+
+
+def write_frame(path, image):
+    """ Store `image` in `path` losslessly, as zlib-compressed row bands """
+    packed = PackedImage.pack(image)
+    with open(path, 'wb') as f:
+        pickle.dump((packed.width, packed.height, packed.format.value, packed.bands), f,
+                    pickle.HIGHEST_PROTOCOL)
+
+
+def read_frame(path):
+    """ The image stored in `path` by write_frame() """
+    with open(path, 'rb') as f:
+        width, height, fmt, bands = pickle.load(f)
+    return PackedImage(width, height, QImage.Format(fmt), bands).unpack()
+
+
+class _Reader:
+    # One thread's reader of a frame file, and the frame it reads next
+    def __init__(self, path):
+        self.reader = QImageReader(path)
+        self.next = 0
+
+
+def load_frame(path, page, readers, keep=None):
+    """ Decode frame `page` of `path`, in the format documents are edited in.
+
+    `readers` ({path: reader}) keeps the calling thread's files open from
+    one call to the next. TIFF pages are jumped to; GIF frames can only be
+    read in order, so reading goes on from the last frame read, starting
+    over to go back, and `keep(page, image)` gets the frames passed on the way.
+    """
+    if path.endswith(FRAME_SUFFIX):
+        return read_frame(path)
+    state = readers.get(path)
+    if state is None:
+        state = readers[path] = _Reader(path)
+    if state.reader.jumpToImage(page):
+        state.next = page
+    elif state.next > page:
+        state = readers[path] = _Reader(path)
+    while True:
+        image = state.reader.read()
+        if image.isNull():
+            raise ValueError(f"can't read frame {state.next + 1} of {os.path.basename(path)}: "
+                             f"{state.reader.errorString()}")
+        state.next += 1
+        if state.next > page:
+            return editable_image(image)
+        if keep is not None:
+            keep(state.next - 1, editable_image(image))
+
+
+class FrameStack(QObject):
+    """ The frames of a multi-frame file, decoded on demand.
+
+    frame(i) returns frame i from the cache or decoded on the calling
+    thread. request(i) returns at once and has a worker decode frame i and
+    its neighbors, the newest request first; `ready(i)` follows on the GUI
+    thread for each, or `failed(i, message)`. The most recently used frames
+    are kept up to `cache_bytes`. `sources` holds the (path, page) each
+    frame is read from: a page of the file, or an edited frame that
+    replace() wrote out to a temporary folder.
+    """
+    ready = pyqtSignal(int)
+    failed = pyqtSignal(int, str)
+
+    def __init__(self, path, count, cache_bytes=DEFAULT_FRAME_CACHE_BYTES, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.count = count
+        self.budget = cache_bytes
+        self.sources = [(path, i) for i in range(count)]
+        self._cache = OrderedDict()  # frame index -> QImage
+        self._cache_bytes = 0
+        self._writing = {}  # frame index -> edited image still being written out
+        # Bumped when a frame's source changes, so decodes of the old one are dropped
+        self._versions = [0] * count
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._file_version = 0  # bumped when the file is rewritten, so readers reopen it
+        self._pool = ThreadPoolExecutor(1, thread_name_prefix="frames")
+        self._generation = 0  # bumped by each request(), so older ones stop
+        self._names = itertools.count()
+        self._folder = None
+        self._closed = False
+
+    @property
+    def cache_bytes(self):
+        return self._cache_bytes
+
+    def release_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self._cache_bytes = 0
+
+    def cached(self, index):
+        """ Frame `index` if it is decoded already, else None """
+        with self._lock:
+            image = self._cache.get(index)
+            if image is not None:
+                self._cache.move_to_end(index)
+                return image
+            return self._writing.get(index)
+
+    def frame(self, index):
+        image = self.cached(index)
+        return image if image is not None else self._decode(index)
+
+    def request(self, index):
+        """ Have the worker decode frame `index` and the frames around it, nearest first """
+        self._generation += 1
+        wanted = [index]
+        for step in range(1, PREFETCH_FRAMES + 1):
+            wanted += [index + step, index - step]
+        wanted = [i for i in wanted if 0 <= i < self.count and self.cached(i) is None]
+        if wanted:
+            self._pool.submit(self._decode_ahead, wanted, self._generation)
+
+    def _decode_ahead(self, indices, generation):
+        for index in indices:
+            if generation != self._generation or self._closed:
+                # A newer request came in
+                return
+            if self.cached(index) is None:
+                try:
+                    self._decode(index)
+                except Exception as e:
+                    log.error("Frame %d of %s: %s", index + 1, self.path, e)
+                    self.failed.emit(index, str(e))
+                    continue
+            self.ready.emit(index)
+
+    def _readers(self):
+        # The calling thread's open readers, dropped when the file was rewritten
+        if getattr(self._local, 'version', None) != self._file_version:
+            self._local.readers = {}
+            self._local.version = self._file_version
+        return self._local.readers
+
+    def _decode(self, index):
+        version = self._versions[index]
+        path, page = self.sources[index]
+
+        def keep(skipped, image):
+            if self.sources[skipped] == (path, skipped):
+                self._store(skipped, image, self._versions[skipped])
+        image = load_frame(path, page, self._readers(), keep)
+        self._store(index, image, version)
+        return image
+
+    def _store(self, index, image, version):
+        with self._lock:
+            if version != self._versions[index] or self._closed:
+                return
+            old = self._cache.pop(index, None)
+            if old is not None:
+                self._cache_bytes -= old.sizeInBytes()
+            self._cache[index] = image
+            self._cache_bytes += image.sizeInBytes()
+            while self._cache_bytes > self.budget and len(self._cache) > 1:
+                _, dropped = self._cache.popitem(last=False)
+                self._cache_bytes -= dropped.sizeInBytes()
+
+    def work_folder(self):
+        """ The temporary folder edited frames are written to, removed by close() """
+        if self._folder is None:
+            self._folder = tempfile.mkdtemp(prefix="tabula-frames-")
+        return self._folder
+
+    def replace(self, index, image):
+        """ Make `image` frame `index`: cached at once, and written out on the worker """
+        path = os.path.join(self.work_folder(), f"{index:06d}-{next(self._names)}{FRAME_SUFFIX}")
+        with self._lock:
+            self._versions[index] += 1
+            self._writing[index] = image
+        self.sources[index] = (path, 0)
+        self._store(index, image, self._versions[index])
+        self._pool.submit(self._write, index, path, image)
+
+    def _write(self, index, path, image):
+        try:
+            write_frame(path, image)
+        except Exception as e:
+            # The edit stays in memory instead
+            log.error("Can't write frame %d to %s: %s", index + 1, path, e)
+            return
+        with self._lock:
+            if self._writing.get(index) is image:
+                del self._writing[index]
+
+    def flush(self):
+        """ Wait until the edited frames handed to replace() are written out """
+        self._pool.submit(lambda: None).result()
+
+    def set_sources(self, sources):
+        """ Read frames from elsewhere from now on: {index: (path, page)} """
+        with self._lock:
+            for index, source in sources.items():
+                self.sources[index] = source
+                self._versions[index] += 1
+                self._writing.pop(index, None)
+                image = self._cache.pop(index, None)
+                if image is not None:
+                    self._cache_bytes -= image.sizeInBytes()
+
+    def rebase(self, path):
+        """ Read every frame from `path`, which now holds all of them as they are """
+        # The cached frames are the ones saved, so they stay
+        self.path = path
+        self.sources = [(path, i) for i in range(self.count)]
+        self._file_version += 1
+
+    def gif_delays(self):
+        """ Milliseconds each frame of the GIF the stack was opened from is shown for """
+        from PIL import Image
+        delays = []
+        with Image.open(self.path) as gif:
+            for i in range(self.count):
+                try:
+                    gif.seek(i)
+                except EOFError:
+                    break
+                delays.append(gif.info.get("duration") or 100)
+        return delays + [100] * (self.count - len(delays))
+
+    def close(self):
+        self._closed = True
+        self._generation += 1
+        # A frame being decoded or written finishes first
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self.release_cache()
+        self._writing.clear()
+        if self._folder is not None:
+            shutil.rmtree(self._folder, ignore_errors=True)
+            self._folder = None
+
+
+def _page_array(image, eight_bit=False):
+    # The pixels of a frame as a gray or R, G, B(, A) array for writing
+    view = qimage_view(image, readonly=True)
+    if image.format() in (QImage.Format.Format_ARGB32, QImage.Format.Format_ARGB32_Premultiplied,
+                          QImage.Format.Format_RGB32):
+        view = view[..., [2, 1, 0, 3]]
+    if eight_bit and view.dtype == np.uint16:
+        view = (view >> 8).astype(np.uint8)
+    return view
+
+
+def save_frames(path, count, frame, fmt, delays=None, check=None):
+    """ Write frame(0) .. frame(count - 1) to `path` as a multi-page "TIFF" or an animated "GIF".
+
+    TIFF pages are written as they come, lossless and in each frame's own
+    depth, so only one frame is held at a time. GIF frames are reduced to
+    256 colors by Pillow, which keeps them all until it has written the
+    file; `delays` are their durations in ms.
+    """
+    def page(i):
+        if check is not None:
+            check(i / count)
+        return frame(i)
+    if fmt == "TIFF":
+        write_multipage_tiff(path, count, lambda i: _page_array(page(i)))
+        return
+    from PIL import Image
+    first = Image.fromarray(np.ascontiguousarray(_page_array(page(0), True)))
+    rest = (Image.fromarray(np.ascontiguousarray(_page_array(page(i), True))) for i in range(1, count))
+    first.save(path, format="GIF", save_all=True, append_images=rest, duration=delays or 100,
+               loop=0, disposal=2)
+
+
+def apply_operation(image, operation):
+    """ A copy of `image` with `operation` applied, as the canvas recorded it.
+
+    Operations are ("crop", (x, y, w, h)), ("rotate", quarter turns),
+    ("flip", horizontal), ("tones", lut), ("removebg", 8-bit (r, g, b)) and
+    ("filter", (kind, radius, amount, 8-bit threshold, (x, y, w, h))).
+    """
+    kind, arg = operation
+    fmt = image.format()
+    if kind == "crop":
+        return image.copy(QRect(*arg))
+    if kind == "rotate":
+        return wrap_array(rotate90(qimage_view(image, readonly=True), arg), fmt)
+    if kind == "flip":
+        image = image.copy()
+        flip(qimage_view(image), arg)
+        return image
+    if kind == "tones":
+        depth = 16 if fmt in (QImage.Format.Format_Grayscale16, QImage.Format.Format_RGBA64) else 8
+        if len(arg) != 1 << depth:
+            raise ValueError("the tone curve was made for frames of another bit depth")
+        work = QImage(image.size(), fmt)
+        apply_lut(qimage_view(image, readonly=True), arg, rgb_index(fmt), out=qimage_view(work))
+        return work
+    if kind == "removebg":
+        work = with_alpha(image)
+        scale = 257 if work.format() == QImage.Format.Format_RGBA64 else 1
+        make_transparent(qimage_view(work), tuple(c * scale for c in arg), rgb_index(work.format()))
+        return work
+    if kind == "filter":
+        name, radius, amount, threshold, box = arg
+        rect = QRect(*box).intersected(image.rect())
+        if rect.isEmpty():
+            return image.copy()
+        x, y, w, h = rect.x(), rect.y(), rect.width(), rect.height()
+        view = qimage_view(image, readonly=True)
+        scale = 257 if view.dtype == np.uint16 else 1
+        after = named_filter(view, name, radius, amount, threshold * scale, (x, y, w, h),
+                             3 if fmt in ALPHA_FORMATS else None)
+        work = image.copy()
+        qimage_view(work)[y:y + h, x:x + w] = after
+        return work
+    raise ValueError(f"Unknown operation: {kind}")
+
+
+def _start_worker():
+    ensure_app()
+
+
+def _apply_run(frames, operation, folder):
+    # In a worker process: apply `operation` to (index, path, page) frames
+    # and write each result to `folder`; {index: (path, 0)} of the results
+    readers = {}
+    written = {}
+    for index, path, page in frames:
+        image = apply_operation(load_frame(path, page, readers), operation)
+        out = os.path.join(folder, f"{index:06d}{FRAME_SUFFIX}")
+        write_frame(out, image)
+        written[index] = (out, 0)
+    return written
+
+
+def apply_to_frames(frames, operation, folder, workers=None, check=None):
+    """ Apply `operation` to (index, path, page) frames on a pool of processes.
+
+    The results are written to `folder`; returns {index: (path, 0)} of
+    them. Frames go out in runs of consecutive ones, as GIF frames are
+    cheapest read in order, a few runs per process so the processes finish
+    together. `check(fraction)` is called as runs finish and may raise to
+    stop: runs not yet started are dropped.
+    """
+    if not frames:
+        return {}
+    workers = max(1, min(workers or os.cpu_count() or 1, len(frames)))
+    size = max(1, math.ceil(len(frames) / (workers * 4)))
+    runs = [frames[i:i + size] for i in range(0, len(frames), size)]
+    # Spawned rather than forked: forking a process with Qt threads running isn't safe
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_start_worker)
+    results = {}
+    try:
+        pending = {pool.submit(_apply_run, run, operation, folder) for run in runs}
+        while pending:
+            done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            for future in done:
+                results.update(future.result())
+            if check is not None:
+                check(1 - len(pending) / len(runs))
+    except BaseException:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+    return results
@@ -0,0 +1,212 @@
+"""
+Idle-time scheduler: housekeeping work that runs in small units only while
+the user isn't giving input, most urgent first, and stops at the next mouse
+or key event so it never adds input latency.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import QEvent, QObject, QTimer, pyqtSignal
+from PyQt6.QtWidgets import QApplication
+
+log = logging.getLogger("tabula_rasa.idle")
+
+# Events that count as the user doing something
+_INPUT_EVENTS = frozenset((
+    QEvent.Type.MouseButtonPress, QEvent.Type.MouseButtonRelease, QEvent.Type.MouseButtonDblClick,
+    QEvent.Type.MouseMove, QEvent.Type.Wheel, QEvent.Type.KeyPress, QEvent.Type.KeyRelease,
+    QEvent.Type.TabletPress, QEvent.Type.TabletMove, QEvent.Type.TabletRelease,
+    QEvent.Type.TouchBegin, QEvent.Type.TouchUpdate, QEvent.Type.TouchEnd,
+))
+
+
+class IdleTask:
+    """ One piece of background work: a generator advanced one unit at a time """
+
+    def __init__(self, key, steps, priority, worker, done, step=None):
+        self.key = key
+        self.steps = steps
+        self.priority = priority
+        self.worker = worker
+        self.done = done
+        self.step = step
+        self.running = False  # a unit is out on the worker pool
+        self.cancelled = False
+        self.units = 0
+
+
+class IdleScheduler(QObject):
+    """ Run prioritized, time-sliced work while input is idle.
+
+    submit() takes a generator: each next() is one unit of work, small
+    enough (a few ms) that finishing it never holds up the user, and its
+    return value goes to `done` on the GUI thread. Units run on the GUI
+    thread in slices of at most `slice_ms`, or on a worker pool with
+    `worker=True`. Nothing runs until `idle_delay` seconds after the last
+    input event; the next input event pauses the work between units, and
+    the highest priority task goes first each time a unit is picked, so a
+    newly submitted urgent task preempts a running one.
+
+    Idle hooks are called each time the user goes idle, to queue work that
+    depends on the state of the app.
+    """
+    _unit_done = pyqtSignal(object, object, object)  # task, finished, result or exception
+
+    def __init__(self, idle_delay=0.3, slice_ms=4, workers=1, parent=None):
+        super().__init__(parent)
+        self.idle_delay = idle_delay
+        self.slice_ms = slice_ms
+        self.idle = False
+        self._tasks = {}
+        self._hooks = []
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="idle")
+        self._workers = workers
+        self._idle_timer = QTimer(self)
+        self._idle_timer.setSingleShot(True)
+        self._idle_timer.timeout.connect(self._went_idle)
+        self._run_timer = QTimer(self)
+        self._run_timer.setSingleShot(True)
+        self._run_timer.timeout.connect(self._run_slice)
+        self._unit_done.connect(self._worker_unit_done)
+        self.units_run = 0
+
+    def start(self):
+        """ Watch the application's input events and start counting idle time """
+        QApplication.instance().installEventFilter(self)
+        self._idle_timer.start(int(self.idle_delay * 1000))
+
+    def shutdown(self):
+        QApplication.instance().removeEventFilter(self)
+        self._idle_timer.stop()
+        self._run_timer.stop()
+        for task in self._tasks.values():
+            task.cancelled = True
+        self._tasks.clear()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def add_idle_hook(self, func):
+        """ Call func(scheduler) on the GUI thread whenever the user goes idle """
+        self._hooks.append(func)
+
+    def submit(self, key, steps, priority=0, worker=False, done=None, step=None):
+        """ Queue generator `steps` under `key`, replacing a task with that key.
+
+        Higher `priority` runs first. `done(result)` gets the generator's
+        return value on the GUI thread once it is exhausted, and `step(value)`
+        each value it yields, for work that delivers results as it goes.
+        """
+        self.cancel(key)
+        self._tasks[key] = IdleTask(key, steps, priority, worker, done, step)
+        if self.idle:
+            self._run_timer.start(0)
+
+    def cancel(self, key):
+        task = self._tasks.pop(key, None)
+        if task is not None:
+            # A unit still out on the pool finishes, but nothing follows it
+            task.cancelled = True
+
+    def pending(self, key):
+        return key in self._tasks
+
+    def eventFilter(self, obj, event):
+        if event.type() in _INPUT_EVENTS:
+            self.poke()
+        return False
+
+    def poke(self):
+        """ Note user input: pause until input has been idle for idle_delay again """
+        self.idle = False
+        self._run_timer.stop()
+        self._idle_timer.start(int(self.idle_delay * 1000))
+
+    def _went_idle(self):
+        self.idle = True
+        for hook in list(self._hooks):
+            try:
+                hook(self)
+            except Exception:
+                log.exception("Idle hook failed")
+        self._run_timer.start(0)
+
+    def _by_priority(self):
+        return sorted(self._tasks.values(), key=lambda task: -task.priority)
+
+    def _run_slice(self):
+        if not self.idle:
+            return
+        tasks = self._by_priority()
+        # Keep the pool busy with the most urgent worker tasks
+        busy = sum(task.running for task in tasks)
+        for task in tasks:
+            if busy >= self._workers:
+                break
+            if task.worker and not task.running:
+                task.running = True
+                busy += 1
+                self._pool.submit(self._worker_unit, task)
+        # Then GUI-thread units for one slice, re-picking the most urgent task
+        # after every unit
+        deadline = time.perf_counter() + self.slice_ms / 1000
+        while self.idle and time.perf_counter() < deadline:
+            task = next((t for t in self._by_priority() if not t.worker), None)
+            if task is None:
+                break
+            try:
+                value = next(task.steps)
+                task.units += 1
+                self.units_run += 1
+                if task.step is not None:
+                    self._step(task, value)
+            except StopIteration as stop:
+                self._finish(task, stop.value)
+            except Exception:
+                log.exception("Idle task %s failed", task.key)
+                self._tasks.pop(task.key, None)
+        if self.idle and any(not task.worker for task in self._tasks.values()):
+            # Back to the event loop between slices, so input is seen at once
+            self._run_timer.start(0)
+
+    def _worker_unit(self, task):
+        if task.cancelled:
+            return
+        try:
+            value = next(task.steps)
+        except StopIteration as stop:
+            self._unit_done.emit(task, True, stop.value)
+        except Exception as e:
+            self._unit_done.emit(task, None, e)
+        else:
+            self._unit_done.emit(task, False, value)
+
+    def _worker_unit_done(self, task, finished, result):
+        task.running = False
+        if task.cancelled or self._tasks.get(task.key) is not task:
+            return
+        if finished is None:
+            log.error("Idle task %s failed: %s", task.key, result)
+            self._tasks.pop(task.key, None)
+        elif finished:
+            self._finish(task, result)
+        else:
+            task.units += 1
+            self.units_run += 1
+            if task.step is not None:
+                self._step(task, result)
+        if self.idle:
+            self._run_timer.start(0)
+
+    def _step(self, task, value):
+        try:
+            task.step(value)
+        except Exception:
+            log.exception("Idle task %s: step callback failed", task.key)
+
+    def _finish(self, task, result):
+        self._tasks.pop(task.key, None)
+        if task.done is not None:
+            try:
+                task.done(result)
+            except Exception:
+                log.exception("Idle task %s: done callback failed", task.key)
@@ -0,0 +1,709 @@
+"""
+Image file readers and writers that go beyond what QImage.load/save handle
+"""
+import io
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+from PyQt6.QtCore import QCoreApplication
+from PyQt6.QtGui import QImage
+
+from image_ops import qimage_view, compact_image
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+
+_app = None
+
+
+def ensure_app():
+    """ The running Qt application, or a QCoreApplication kept for the life of the
+    process: QImage finds its format plugins through the application object, so
+    headless callers need one before they load or save """
+    global _app
+    _app = QCoreApplication.instance() or _app or QCoreApplication(sys.argv[:1])
+    return _app
+
+
+def image_files(folder):
+    """ Sorted paths of the images directly inside `folder` """
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if name.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(os.path.join(folder, name)))
+
+
+def load_image(path):
+    image = QImage(path)
+    if image.isNull():
+        raise ValueError(f"can't read {os.path.basename(path)}")
+    if image.format() == QImage.Format.Format_Indexed8:
+        # Palette indices aren't colors; trimming compares colors
+        return image.convertToFormat(QImage.Format.Format_ARGB32)
+    try:
+        qimage_view(image, readonly=True)
+    except ValueError:
+        image = image.convertToFormat(QImage.Format.Format_ARGB32)
+    return image
+
+
+def save_image(image, path):
+    """ Write `image` next to `path` first and then replace it, like the app's Save """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.png':
+        image, _ = compact_image(image)
+    tmp_name = path + ".tmp"
+    if not image.save(tmp_name, ext.lstrip('.').upper()):
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise OSError(f"can't write {os.path.basename(path)}")
+    os.replace(tmp_name, path)
+
+
+def file_key(path):
+    """ (absolute path, mtime in ns, size): changes whenever the file does """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+# Budget for decoded tiles kept by a TiledImageSource
+DEFAULT_TILE_CACHE_BYTES = 256 * 1024 * 1024
+
+# (numpy dtype code, bytes per value) for each TIFF field type
+_TIFF_TYPES = {
+    1: ('u1', 1), 2: ('u1', 1), 3: ('u2', 2), 4: ('u4', 4), 5: ('u4', 8),
+    6: ('i1', 1), 7: ('u1', 1), 8: ('i2', 2), 9: ('i4', 4), 10: ('i4', 8),
+    11: ('f4', 4), 12: ('f8', 8), 13: ('u4', 4), 16: ('u8', 8), 17: ('i8', 8),
+    18: ('u8', 8),
+}
+
+_TAG_WIDTH = 256
+_TAG_HEIGHT = 257
+_TAG_BITS = 258
+_TAG_COMPRESSION = 259
+_TAG_PHOTOMETRIC = 262
+_TAG_STRIP_OFFSETS = 273
+_TAG_SAMPLES = 277
+_TAG_ROWS_PER_STRIP = 278
+_TAG_STRIP_COUNTS = 279
+_TAG_PLANAR = 284
+_TAG_PREDICTOR = 317
+_TAG_COLORMAP = 320
+_TAG_TILE_WIDTH = 322
+_TAG_TILE_HEIGHT = 323
+_TAG_TILE_OFFSETS = 324
+_TAG_TILE_COUNTS = 325
+_TAG_SUBIFDS = 330
+_TAG_EXTRA_SAMPLES = 338
+_TAG_SAMPLE_FORMAT = 339
+_TAG_JPEG_TABLES = 347
+
+
+def _lzw_decode(data):
+    # TIFF flavour of LZW: MSB-first codes of 9..12 bits with "early change"
+    out = bytearray()
+    table = [bytes([i]) for i in range(256)] + [b'', b'']
+    padded = bytes(data) + b'\0\0\0'
+    total_bits = len(data) * 8
+    bitpos = 0
+    nbits = 9
+    prev = None
+    while bitpos + nbits <= total_bits:
+        byte = bitpos >> 3
+        chunk = int.from_bytes(padded[byte:byte + 3], 'big')
+        code = (chunk >> (24 - nbits - (bitpos & 7))) & ((1 << nbits) - 1)
+        bitpos += nbits
+        if code == 257:
+            break
+        if code == 256:
+            del table[258:]
+            nbits = 9
+            prev = None
+            continue
+        if prev is None:
+            entry = table[code]
+        elif code < len(table):
+            entry = table[code]
+            table.append(prev + entry[:1])
+        else:
+            entry = prev + prev[:1]
+            table.append(entry)
+        out += entry
+        prev = entry
+        if len(table) >= (1 << nbits) - 1 and nbits < 12:
+            nbits += 1
+    return bytes(out)
+
+
+def _packbits_decode(data):
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        header = data[i]
+        i += 1
+        if header < 128:
+            out += data[i:i + header + 1]
+            i += header + 1
+        elif header > 128:
+            out += bytes([data[i]]) * (257 - header)
+            i += 1
+    return bytes(out)
+
+
+class _TiffLevel:
+    # One decodable image (IFD) of a TIFF file, described as a grid of blocks.
+    # Strip-organized images are treated as tiles spanning the full width.
+    def __init__(self, tags, byteorder):
+        def first(tag, default=None):
+            value = tags.get(tag)
+            return int(value[0]) if value is not None and len(value) else default
+
+        self.width = first(_TAG_WIDTH)
+        self.height = first(_TAG_HEIGHT)
+        self.samples = first(_TAG_SAMPLES, 1)
+        bits = tags.get(_TAG_BITS)
+        self.bits = int(bits[0]) if bits is not None else 1
+        self.compression = first(_TAG_COMPRESSION, 1)
+        self.photometric = first(_TAG_PHOTOMETRIC, 1)
+        self.planar = first(_TAG_PLANAR, 1)
+        self.predictor = first(_TAG_PREDICTOR, 1)
+        self.sample_format = first(_TAG_SAMPLE_FORMAT, 1)
+        self.jpeg_tables = tags.get(_TAG_JPEG_TABLES)
+        self.colormap = tags.get(_TAG_COLORMAP)
+        self.byteorder = byteorder
+        if _TAG_TILE_WIDTH in tags:
+            self.tiled = True
+            self.tile_w = first(_TAG_TILE_WIDTH)
+            self.tile_h = first(_TAG_TILE_HEIGHT)
+            self.offsets = tags.get(_TAG_TILE_OFFSETS)
+            self.counts = tags.get(_TAG_TILE_COUNTS)
+        else:
+            self.tiled = False
+            self.tile_w = self.width
+            self.tile_h = min(first(_TAG_ROWS_PER_STRIP, self.height), self.height)
+            self.offsets = tags.get(_TAG_STRIP_OFFSETS)
+            self.counts = tags.get(_TAG_STRIP_COUNTS)
+        self.tiles_across = -(-self.width // self.tile_w)
+        self.tiles_down = -(-self.height // self.tile_h)
+        self.downsample = 1.0
+
+    def supported(self):
+        if self.width is None or self.height is None or self.offsets is None or self.counts is None:
+            return False
+        if self.compression not in (1, 5, 7, 8, 32773, 32946):
+            return False
+        if self.bits not in (8, 16) or self.sample_format not in (1, None):
+            return False
+        if self.photometric not in (0, 1, 2, 3, 6):
+            return False
+        if self.photometric == 6 and self.compression != 7:
+            return False
+        if self.photometric == 3 and (self.colormap is None or self.samples != 1):
+            return False
+        return self.samples in (1, 2, 3, 4)
+
+
+class TileSource:
+    """ Base of the lazily read images: tiles decoded on demand into an LRU cache.
+
+    Subclasses set `levels` (objects with width, height, tile_w, tile_h and
+    downsample, largest first), `width` and `height`, and implement
+    _load_tile(level_index, tx, ty) returning the (h, w, 4) uint8 B, G, R, A
+    pixels of one tile, the ARGB32 memory layout.
+    """
+    tiled = True
+
+    def __init__(self, cache_bytes=DEFAULT_TILE_CACHE_BYTES):
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self.cache_limit = cache_bytes
+        self._lock = threading.Lock()
+
+    def _load_tile(self, level_index, tx, ty):
+        raise NotImplementedError
+
+    def tile(self, level_index, tx, ty):
+        """ Decoded tile (tx, ty) of a level, served from the LRU cache """
+        key = (level_index, tx, ty)
+        with self._lock:
+            tile = self._cache.get(key)
+            if tile is not None:
+                self._cache.move_to_end(key)
+                return tile
+        tile = self._load_tile(level_index, tx, ty)
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = tile
+                self._cache_bytes += tile.nbytes
+                while self._cache_bytes > self.cache_limit and len(self._cache) > 1:
+                    _, old = self._cache.popitem(last=False)
+                    self._cache_bytes -= old.nbytes
+        return tile
+
+    def level_for_scale(self, scale):
+        """ Index of the smallest level that still has at least `scale` detail """
+        best = 0
+        for i, level in enumerate(self.levels):
+            if level.downsample * scale <= 1.0 + 1e-6:
+                best = i
+        return best
+
+    def read_region(self, level_index, x, y, w, h, step=1):
+        """ Pixels of a rectangle given in level coordinates, optionally subsampled by `step` """
+        level = self.levels[level_index]
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(level.width, x + w), min(level.height, y + h)
+        out_w = -(-w // step)
+        out_h = -(-h // step)
+        out = np.zeros((out_h, out_w, 4), np.uint8)
+        if x1 <= x0 or y1 <= y0:
+            return out
+        for ty in range(y0 // level.tile_h, (y1 - 1) // level.tile_h + 1):
+            for tx in range(x0 // level.tile_w, (x1 - 1) // level.tile_w + 1):
+                tile = self.tile(level_index, tx, ty)
+                ox, oy = tx * level.tile_w, ty * level.tile_h
+                # Intersection in level coordinates, snapped to the step grid
+                ix0 = max(x0, ox)
+                iy0 = max(y0, oy)
+                ix0 += (x - ix0) % step
+                iy0 += (y - iy0) % step
+                ix1 = min(x1, ox + tile.shape[1])
+                iy1 = min(y1, oy + tile.shape[0])
+                if ix1 <= ix0 or iy1 <= iy0:
+                    continue
+                src = tile[iy0 - oy:iy1 - oy:step, ix0 - ox:ix1 - ox:step]
+                dy, dx = (iy0 - y) // step, (ix0 - x) // step
+                out[dy:dy + src.shape[0], dx:dx + src.shape[1]] = src
+        return out
+
+    @property
+    def cache_bytes(self):
+        return self._cache_bytes
+
+    def release_cache(self):
+        """ Drop the decoded tiles; they are read again as they are needed """
+        with self._lock:
+            self._cache.clear()
+            self._cache_bytes = 0
+
+    def close(self):
+        self.release_cache()
+
+
+class TiledImageSource(TileSource):
+    """ Lazily decoded view of a (possibly pyramidal) TIFF/BigTIFF file.
+
+    Only the tiles covering a requested region are read and decoded; decoded
+    tiles are kept in an LRU cache bounded by `cache_bytes`.
+    """
+
+    def __init__(self, path, cache_bytes=DEFAULT_TILE_CACHE_BYTES):
+        super().__init__(cache_bytes)
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            self._file.close()
+            raise ValueError("Not a TIFF file")
+        try:
+            self.levels = self._read_levels()
+        except (struct.error, IndexError, ValueError):
+            self.close()
+            raise ValueError("Not a readable TIFF file")
+        if not self.levels:
+            self.close()
+            raise ValueError("Unsupported TIFF layout")
+        self.width = self.levels[0].width
+        self.height = self.levels[0].height
+
+    @property
+    def tiled(self):
+        return self.levels[0].tiled
+
+    # --- file structure -----------------------------------------------------
+    def _read_levels(self):
+        buf = self._map
+        order = buf[:2]
+        if order == b'II':
+            self._bo = '<'
+        elif order == b'MM':
+            self._bo = '>'
+        else:
+            raise ValueError("Not a TIFF file")
+        magic = struct.unpack(self._bo + 'H', buf[2:4])[0]
+        if magic == 42:
+            self._big = False
+            first = struct.unpack(self._bo + 'I', buf[4:8])[0]
+        elif magic == 43:
+            self._big = True
+            first = struct.unpack(self._bo + 'Q', buf[8:16])[0]
+        else:
+            raise ValueError("Not a TIFF file")
+
+        ifds = []
+        seen = set()
+        offset = first
+        while offset and offset not in seen and len(ifds) < 1024:
+            seen.add(offset)
+            tags, offset = self._read_ifd(offset)
+            ifds.append(tags)
+        # Pyramids are stored either as SubIFDs of the first image or as
+        # following images in the main chain (e.g. SVS, OME-TIFF).
+        subifds = ifds[0].get(_TAG_SUBIFDS) if ifds else None
+        if subifds is not None:
+            for sub in subifds:
+                ifds.append(self._read_ifd(int(sub))[0])
+
+        levels = [_TiffLevel(tags, self._bo) for tags in ifds]
+        base = levels[0]
+        if not base.supported():
+            return []
+        aspect = base.width / base.height
+        result = [base]
+        for level in sorted(levels[1:], key=lambda lv: -(lv.width or 0)):
+            if not level.supported() or level.width >= result[-1].width:
+                continue
+            if (level.samples, level.bits, level.photometric) != (base.samples, base.bits, base.photometric):
+                continue
+            # Skip label/macro images whose aspect ratio doesn't match
+            if abs(level.width / level.height - aspect) > 0.02 * aspect + 2.0 / level.height:
+                continue
+            level.downsample = base.width / level.width
+            result.append(level)
+        return result
+
+    def _read_ifd(self, offset):
+        buf = self._map
+        bo = self._bo
+        if self._big:
+            count = struct.unpack(bo + 'Q', buf[offset:offset + 8])[0]
+            entry_size, pos, inline = 20, offset + 8, 8
+        else:
+            count = struct.unpack(bo + 'H', buf[offset:offset + 2])[0]
+            entry_size, pos, inline = 12, offset + 2, 4
+        tags = {}
+        for i in range(count):
+            e = pos + i * entry_size
+            tag, typ = struct.unpack(bo + 'HH', buf[e:e + 4])
+            if self._big:
+                n = struct.unpack(bo + 'Q', buf[e + 4:e + 12])[0]
+            else:
+                n = struct.unpack(bo + 'I', buf[e + 4:e + 8])[0]
+            if typ not in _TIFF_TYPES:
+                continue
+            code, size = _TIFF_TYPES[typ]
+            nbytes = n * size
+            value_pos = e + entry_size - inline
+            if nbytes > inline:
+                fmt = 'Q' if self._big else 'I'
+                value_pos = struct.unpack(bo + fmt, buf[value_pos:value_pos + inline])[0]
+            raw = buf[value_pos:value_pos + nbytes]
+            if typ in (2, 7):
+                tags[tag] = bytes(raw) if tag == _TAG_JPEG_TABLES else np.frombuffer(raw, 'u1')
+            elif typ in (5, 10):
+                tags[tag] = np.frombuffer(raw, bo + code).reshape(-1, 2)
+            else:
+                tags[tag] = np.frombuffer(raw, bo + code)
+        pos += count * entry_size
+        if self._big:
+            next_ifd = struct.unpack(bo + 'Q', buf[pos:pos + 8])[0]
+        else:
+            next_ifd = struct.unpack(bo + 'I', buf[pos:pos + 4])[0]
+        return tags, next_ifd
+
+    # --- decoding -----------------------------------------------------------
+    def _decode_block(self, level, index, rows):
+        # Decode one stored block (tile, strip or single plane of either)
+        offset = int(level.offsets[index])
+        count = int(level.counts[index])
+        data = self._map[offset:offset + count]
+        samples = 1 if level.planar == 2 else level.samples
+        comp = level.compression
+        if comp == 7:
+            from PIL import Image
+            tables = level.jpeg_tables
+            if tables:
+                data = tables[:-2] + data[2:]
+            with Image.open(io.BytesIO(data)) as im:
+                arr = np.asarray(im.convert('L' if samples == 1 else 'RGB'))
+            return arr.reshape(arr.shape[0], arr.shape[1], -1)
+        if comp == 8 or comp == 32946:
+            data = zlib.decompress(data)
+        elif comp == 5:
+            data = _lzw_decode(data)
+        elif comp == 32773:
+            data = _packbits_decode(data)
+        dtype = np.dtype(level.byteorder + ('u1' if level.bits == 8 else 'u2'))
+        expected = rows * level.tile_w * samples
+        arr = np.frombuffer(data, dtype, count=min(expected, len(data) // dtype.itemsize))
+        if arr.size < expected:
+            arr = np.concatenate([arr, np.zeros(expected - arr.size, dtype)])
+        arr = arr.reshape(rows, level.tile_w, samples)
+        if level.predictor == 2:
+            arr = np.cumsum(arr, axis=1, dtype=dtype)
+        return arr
+
+    def _to_bgra(self, level, arr):
+        if level.photometric == 3:
+            lut = (level.colormap.reshape(3, -1).T >> 8).astype(np.uint8)
+            rgb = lut[arr[..., 0]]
+            arr = np.concatenate([rgb, np.full(arr.shape[:2] + (1,), 255, np.uint8)], axis=2)
+        elif arr.dtype != np.uint8:
+            arr = (arr >> 8).astype(np.uint8)
+        h, w, s = arr.shape
+        out = np.empty((h, w, 4), np.uint8)
+        if s <= 2:
+            gray = arr[..., 0]
+            if level.photometric == 0:
+                gray = 255 - gray
+            out[..., 0] = gray
+            out[..., 1] = gray
+            out[..., 2] = gray
+            out[..., 3] = arr[..., 1] if s == 2 else 255
+        else:
+            out[..., 0] = arr[..., 2]
+            out[..., 1] = arr[..., 1]
+            out[..., 2] = arr[..., 0]
+            out[..., 3] = arr[..., 3] if s >= 4 else 255
+        return out
+
+    def _load_tile(self, level_index, tx, ty):
+        level = self.levels[level_index]
+        rows = level.tile_h if level.tiled else min(level.tile_h, level.height - ty * level.tile_h)
+        index = ty * level.tiles_across + tx
+        if level.planar == 2 and level.samples > 1:
+            per_plane = level.tiles_across * level.tiles_down
+            planes = [self._decode_block(level, index + p * per_plane, rows)
+                      for p in range(level.samples)]
+            arr = np.concatenate(planes, axis=2)
+        else:
+            arr = self._decode_block(level, index, rows)
+        # Crop the padding of edge tiles
+        w = min(level.tile_w, level.width - tx * level.tile_w)
+        h = min(rows, level.height - ty * level.tile_h)
+        return self._to_bgra(level, arr[:h, :w])
+
+    def close(self):
+        super().close()
+        try:
+            self._map.close()
+        except (ValueError, AttributeError):
+            pass
+        self._file.close()
+
+
+def open_tiled_source(path, cache_bytes=DEFAULT_TILE_CACHE_BYTES):
+    """ Open a TIFF lazily, or return None if it isn't a TIFF we can read tile by tile """
+    if os.path.splitext(path)[1].lower() not in ('.tif', '.tiff', '.btf', '.tf8', '.svs', '.ome.tif'):
+        return None
+    try:
+        return TiledImageSource(path, cache_bytes)
+    except (ValueError, OSError):
+        return None
+
+
+# Pixel layouts offered for headerless raw files: (label, dtype, channels)
+RAW_LAYOUTS = [
+    ("Gray, 8-bit", 'u1', 1),
+    ("Gray, 16-bit", '<u2', 1),
+    ("RGB, 8-bit", 'u1', 3),
+    ("RGBA, 8-bit", 'u1', 4),
+    ("RGBA, 16-bit", '<u2', 4),
+]
+
+
+def open_mapped_array(path, shape=None, dtype=None, offset=0, mode='c'):
+    """ Memory-map a .npy file, or a raw file when `shape` and `dtype` are given.
+
+    The default copy-on-write mode keeps edits in private pages until they
+    are written back with `write_back_rows`.
+    """
+    if shape is None:
+        arr = np.load(path, mmap_mode=mode, allow_pickle=False)
+    else:
+        arr = np.memmap(path, dtype=np.dtype(dtype), mode=mode, offset=offset, shape=tuple(shape))
+    if arr.ndim == 3 and arr.shape[2] == 1:
+        arr = arr[..., 0]
+    if arr.ndim not in (2, 3) or not arr.flags.c_contiguous:
+        raise ValueError("Expected a C-ordered (height, width[, channels]) array")
+    if not arr.dtype.isnative and arr.dtype.itemsize > 1:
+        raise ValueError("Only native byte order can be edited in place")
+    return arr
+
+
+def mapped_qimage_format(arr):
+    """ QImage format that can view `arr` without conversion, or None """
+    from PyQt6.QtGui import QImage
+    channels = 1 if arr.ndim == 2 else arr.shape[2]
+    return {
+        ('u1', 1): QImage.Format.Format_Grayscale8,
+        ('u2', 1): QImage.Format.Format_Grayscale16,
+        ('u1', 3): QImage.Format.Format_RGB888,
+        ('u1', 4): QImage.Format.Format_RGBA8888,
+        ('u2', 4): QImage.Format.Format_RGBA64,
+    }.get((arr.dtype.kind + str(arr.dtype.itemsize), channels))
+
+
+def write_back_rows(arr, path, y0, y1, shape=None, offset=0):
+    """ Copy rows [y0, y1) of an edited mapping into the file it was mapped from """
+    if shape is None:
+        dst = np.load(path, mmap_mode='r+', allow_pickle=False)
+    else:
+        dst = np.memmap(path, dtype=arr.dtype, mode='r+', offset=offset, shape=tuple(shape))
+    dst = dst.reshape(arr.shape)
+    # Chunked so the dirty pages are flushed progressively
+    chunk = max(1, (64 * 1024 * 1024) // max(1, arr[0].nbytes))
+    for start in range(y0, y1, chunk):
+        dst[start:min(y1, start + chunk)] = arr[start:min(y1, start + chunk)]
+    dst.flush()
+    del dst
+
+
+def _write_ifd(f, entries, big):
+    # Write an IFD of (tag, type, values) entries, sorted by tag, at the end
+    # of `f`, with its values that don't fit inline after it. Returns (its
+    # offset, the offset of its next-IFD pointer, left 0)
+    bo = '<'
+    off_fmt = 'Q' if big else 'I'
+    type_codes = {3: 'H', 4: 'I', 16: 'Q'}
+    inline = 8 if big else 4
+    if f.tell() % 2:
+        f.write(b'\0')
+    ifd_offset = f.tell()
+    entry_size = 20 if big else 12
+    ifd_size = (8 if big else 2) + len(entries) * entry_size + inline
+    extra_pos = ifd_offset + ifd_size
+    ifd = bytearray(struct.pack(bo + ('Q' if big else 'H'), len(entries)))
+    extra = bytearray()
+    for tag, typ, values in entries:
+        payload = struct.pack(bo + type_codes[typ] * len(values), *values)
+        ifd += struct.pack(bo + 'HH', tag, typ)
+        ifd += struct.pack(bo + off_fmt, len(values))
+        if len(payload) <= inline:
+            ifd += payload.ljust(inline, b'\0')
+        else:
+            ifd += struct.pack(bo + off_fmt, extra_pos + len(extra))
+            extra += payload
+            if len(extra) % 2:
+                extra += b'\0'
+    ifd += struct.pack(bo + off_fmt, 0)
+    f.write(ifd)
+    f.write(extra)
+    return ifd_offset, ifd_offset + ifd_size - inline
+
+
+def write_tiled_tiff(path, width, height, read_tile, tile_size=512):
+    """ Stream a deflate-compressed, tiled RGBA TIFF to disk one tile at a time.
+
+    `read_tile(x, y, w, h)` must return a (h, w, 4) B, G, R, A uint8 array.
+    BigTIFF is used when the uncompressed data could exceed 4 GB.
+    """
+    big = width * height * 4 > 0xF0000000
+    bo = '<'
+    across = -(-width // tile_size)
+    down = -(-height // tile_size)
+    offsets = []
+    counts = []
+    with open(path, 'wb') as f:
+        if big:
+            f.write(b'II' + struct.pack(bo + 'HHHQ', 43, 8, 0, 0))
+        else:
+            f.write(b'II' + struct.pack(bo + 'HI', 42, 0))
+        padded = np.zeros((tile_size, tile_size, 4), np.uint8)
+        for ty in range(down):
+            for tx in range(across):
+                x, y = tx * tile_size, ty * tile_size
+                w, h = min(tile_size, width - x), min(tile_size, height - y)
+                bgra = read_tile(x, y, w, h)
+                padded[:] = 0
+                padded[:h, :w, 0] = bgra[..., 2]
+                padded[:h, :w, 1] = bgra[..., 1]
+                padded[:h, :w, 2] = bgra[..., 0]
+                padded[:h, :w, 3] = bgra[..., 3]
+                data = zlib.compress(padded.tobytes(), 6)
+                offsets.append(f.tell())
+                counts.append(len(data))
+                f.write(data)
+
+        # (tag, type, values) sorted by tag; type 3 SHORT, 4 LONG, 16 LONG8
+        long_type = 16 if big else 4
+        entries = [
+            (_TAG_WIDTH, 4, [width]),
+            (_TAG_HEIGHT, 4, [height]),
+            (_TAG_BITS, 3, [8, 8, 8, 8]),
+            (_TAG_COMPRESSION, 3, [8]),
+            (_TAG_PHOTOMETRIC, 3, [2]),
+            (_TAG_SAMPLES, 3, [4]),
+            (_TAG_PLANAR, 3, [1]),
+            (_TAG_TILE_WIDTH, 3, [tile_size]),
+            (_TAG_TILE_HEIGHT, 3, [tile_size]),
+            (_TAG_TILE_OFFSETS, long_type, offsets),
+            (_TAG_TILE_COUNTS, long_type, counts),
+            (_TAG_EXTRA_SAMPLES, 3, [2]),
+        ]
+        ifd_offset, _ = _write_ifd(f, entries, big)
+        # Point the header at the IFD
+        if big:
+            f.seek(8)
+            f.write(struct.pack(bo + 'Q', ifd_offset))
+        else:
+            f.seek(4)
+            f.write(struct.pack(bo + 'I', ifd_offset))
+
+
+def write_multipage_tiff(path, count, read_page, strip_bytes=1 << 20):
+    """ Stream a deflate-compressed, multi-page TIFF to disk one page at a time.
+
+    `read_page(i)` must return page i as a (h, w) gray or (h, w, 3 or 4)
+    R, G, B(, A) array of uint8 or uint16; a fourth channel is stored as
+    unassociated alpha. Only one page is held at a time. BigTIFF is used
+    when the uncompressed pages could exceed 4 GB.
+    """
+    page = read_page(0)
+    big = page.nbytes * count > 0xF0000000
+    bo = '<'
+    off_fmt = 'Q' if big else 'I'
+    long_type = 16 if big else 4
+    with open(path, 'wb') as f:
+        if big:
+            f.write(b'II' + struct.pack(bo + 'HHHQ', 43, 8, 0, 0))
+        else:
+            f.write(b'II' + struct.pack(bo + 'HI', 42, 0))
+        link = 8 if big else 4  # where the offset of the next IFD goes
+        for i in range(count):
+            if i:
+                page = read_page(i)
+            h, w = page.shape[:2]
+            samples = 1 if page.ndim == 2 else page.shape[2]
+            rows = max(1, min(h, strip_bytes // (w * samples * page.itemsize)))
+            offsets = []
+            counts = []
+            for y in range(0, h, rows):
+                data = zlib.compress(np.ascontiguousarray(page[y:y + rows], page.dtype.newbyteorder('<')), 6)
+                offsets.append(f.tell())
+                counts.append(len(data))
+                f.write(data)
+            entries = [
+                (_TAG_WIDTH, 4, [w]),
+                (_TAG_HEIGHT, 4, [h]),
+                (_TAG_BITS, 3, [page.itemsize * 8] * samples),
+                (_TAG_COMPRESSION, 3, [8]),
+                (_TAG_PHOTOMETRIC, 3, [1 if samples == 1 else 2]),
+                (_TAG_STRIP_OFFSETS, long_type, offsets),
+                (_TAG_SAMPLES, 3, [samples]),
+                (_TAG_ROWS_PER_STRIP, 4, [rows]),
+                (_TAG_STRIP_COUNTS, long_type, counts),
+                (_TAG_PLANAR, 3, [1]),
+            ]
+            if samples == 4:
+                entries.append((_TAG_EXTRA_SAMPLES, 3, [2]))
+            ifd_offset, next_link = _write_ifd(f, entries, big)
+            f.seek(link)
+            f.write(struct.pack(bo + off_fmt, ifd_offset))
+            f.seek(0, os.SEEK_END)
+            link = next_link
@@ -0,0 +1,1927 @@
+"""
+NumPy helpers for working directly on QImage pixel buffers
+"""
+import functools
+import math
+import os
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PyQt6 import sip
+from PyQt6.QtCore import QRect
+from PyQt6.QtGui import QImage
+
+# dtype and channel count of the raw buffer for each pixel format we edit.
+# 32-bit formats are stored as B, G, R, A bytes on little-endian machines.
+_FORMAT_LAYOUT = {
+    QImage.Format.Format_ARGB32: (np.uint8, 4),
+    QImage.Format.Format_ARGB32_Premultiplied: (np.uint8, 4),
+    QImage.Format.Format_RGB32: (np.uint8, 4),
+    QImage.Format.Format_RGB888: (np.uint8, 3),
+    QImage.Format.Format_RGBA8888: (np.uint8, 4),
+    QImage.Format.Format_Grayscale8: (np.uint8, 1),
+    QImage.Format.Format_Indexed8: (np.uint8, 1),
+    QImage.Format.Format_Grayscale16: (np.uint16, 1),
+    QImage.Format.Format_RGBA64: (np.uint16, 4),
+}
+
+
+def qimage_view(image, readonly=False):
+    """ Return an ndarray view of the QImage buffer (no copy).
+
+    The view is only valid while `image` is alive and not reallocated.
+    Single-channel formats give (h, w), the others (h, w, channels).
+    A writable view detaches a shared QImage first; `readonly` avoids that.
+    """
+    layout = _FORMAT_LAYOUT.get(image.format())
+    if layout is None:
+        raise ValueError(f"Unsupported image format: {image.format()}")
+    dtype, channels = layout
+    itemsize = np.dtype(dtype).itemsize
+    height, width = image.height(), image.width()
+    ptr = image.constBits() if readonly else image.bits()
+    ptr.setsize(image.sizeInBytes())
+    arr = np.ndarray(shape=(height, width, channels), dtype=dtype, buffer=ptr,
+                     strides=(image.bytesPerLine(), channels * itemsize, itemsize))
+    if readonly:
+        arr.flags.writeable = False
+    return arr[..., 0] if channels == 1 else arr
+
+
+def wrap_array(arr, fmt=QImage.Format.Format_ARGB32):
+    """ Wrap a C-contiguous row array in a QImage that shares its memory.
+
+    The caller must keep `arr` alive for as long as the QImage is used.
+    """
+    height, width = arr.shape[:2]
+    if arr.flags.writeable:
+        # A raw pointer selects the writable (non-const) constructor, so painting
+        # on the QImage writes through to `arr` instead of detaching a copy
+        image = QImage(sip.voidptr(arr.ctypes.data), width, height, arr.strides[0], fmt)
+    else:
+        # Read-only buffers get a const QImage that copies itself before any write
+        image = QImage(arr.data, width, height, arr.strides[0], fmt)
+    # Keep a reference on the wrapper so short-lived callers can't free it early
+    image._array_ref = arr
+    return image
+
+
+def array_to_qimage(arr, fmt=QImage.Format.Format_ARGB32):
+    """ Copy an array into a new, self-owned QImage """
+    return wrap_array(np.ascontiguousarray(arr), fmt).copy()
+
+
+# Formats documents are edited in as loaded, rather than converted to ARGB32
+NATIVE_FORMATS = (QImage.Format.Format_Grayscale8, QImage.Format.Format_Grayscale16,
+                  QImage.Format.Format_RGB888, QImage.Format.Format_RGBA64)
+
+
+def editable_image(image):
+    """ A decoded `image` in the format documents are edited in.
+
+    Gray, 24-bit and 16-bit images keep their own format (a quarter of the
+    memory for 8-bit gray, the full precision for 16-bit), the rest become ARGB32.
+    """
+    fmt = image.format()
+    if fmt in NATIVE_FORMATS:
+        return image
+    if fmt == QImage.Format.Format_RGBX64:
+        return image.convertToFormat(QImage.Format.Format_RGBA64)
+    if fmt == QImage.Format.Format_Indexed8 and image.allGray():
+        return image.convertToFormat(QImage.Format.Format_Grayscale8)
+    return image.convertToFormat(QImage.Format.Format_ARGB32)
+
+
+# Formats with a straight alpha channel, channel 3 of their qimage_view()
+ALPHA_FORMATS = (QImage.Format.Format_ARGB32, QImage.Format.Format_RGBA8888, QImage.Format.Format_RGBA64)
+
+
+def with_alpha(image):
+    """ A copy of `image` that can hold transparency: in its own format if that
+    has an alpha channel, else converted to ARGB32 """
+    if image.format() in ALPHA_FORMATS:
+        return image.copy()
+    return image.convertToFormat(QImage.Format.Format_ARGB32)
+
+
+def pixel_value(rgba, fmt):
+    """ Channel values of an (r, g, b, a) color in the buffer layout of `fmt` """
+    r, g, b, a = rgba
+    if fmt in (QImage.Format.Format_ARGB32, QImage.Format.Format_ARGB32_Premultiplied):
+        return (b, g, r, a)
+    if fmt == QImage.Format.Format_RGB32:
+        return (b, g, r, 255)
+    if fmt == QImage.Format.Format_RGBA8888:
+        return (r, g, b, a)
+    if fmt == QImage.Format.Format_RGB888:
+        return (r, g, b)
+    if fmt == QImage.Format.Format_RGBA64:
+        return (r * 257, g * 257, b * 257, a * 257)
+    # Same weights as qGray()
+    gray = (r * 11 + g * 16 + b * 5) // 32
+    if fmt == QImage.Format.Format_Grayscale16:
+        return gray * 257
+    return gray
+
+
+def rgb_index(fmt):
+    """ Buffer channel indices of (r, g, b) for `fmt`, or None for grayscale """
+    if fmt in (QImage.Format.Format_Grayscale8, QImage.Format.Format_Grayscale16):
+        return None
+    if fmt in (QImage.Format.Format_RGBA8888, QImage.Format.Format_RGB888, QImage.Format.Format_RGBA64):
+        return (0, 1, 2)
+    return (2, 1, 0)
+
+
+@functools.lru_cache(maxsize=128)
+def dab_mask(diameter, hardness):
+    """ Float32 coverage mask of a round dab, cached by (diameter, hardness) """
+    radius = diameter / 2.0
+    n = int(np.ceil(diameter)) + 2
+    center = (n - 1) / 2.0
+    yy, xx = np.mgrid[0:n, 0:n]
+    dist = np.hypot(xx - center, yy - center)
+    if hardness >= 0.999:
+        # Hard dab with a one-pixel antialiased rim
+        mask = np.clip(radius + 0.5 - dist, 0.0, 1.0)
+    else:
+        inner = radius * hardness
+        t = np.clip((dist - inner) / max(radius - inner, 1e-6), 0.0, 1.0)
+        mask = (1.0 - t * t) ** 2
+    mask = mask.astype(np.float32)
+    mask.flags.writeable = False
+    return mask
+
+
+class DabStroke:
+    """ A brush stroke made of dab masks stamped at regular spacing along the path.
+
+    Opacity caps the coverage a single stroke can reach, flow is how much
+    each dab adds towards it. Coverage is tracked in a float buffer that
+    grows with the stroke's bounding box.
+    """
+
+    def __init__(self, pixel, size, hardness=1.0, opacity=1.0, flow=1.0, spacing=0.15):
+        self.pixel = np.asarray(pixel, np.float32)
+        self.size = size
+        self.hardness = round(hardness, 2)
+        self.opacity = opacity
+        self.flow = flow
+        self.spacing = spacing
+        self._last = None
+        self._carry = 0.0
+        self._cov = None
+        self._cov_x = 0
+        self._cov_y = 0
+
+    def _dab(self, x, y, pressure):
+        return (x, y, max(1, int(round(self.size * pressure))), self.opacity * pressure)
+
+    def _step(self, pressure):
+        return max(1.0, self.spacing * self.size * pressure)
+
+    def dabs_to(self, x, y, pressure=1.0):
+        """ Dabs (x, y, diameter, opacity) needed to extend the stroke to (x, y) """
+        if self._last is None:
+            self._last = (x, y, pressure)
+            self._carry = self._step(pressure)
+            return [self._dab(x, y, pressure)]
+        lx, ly, lp = self._last
+        dx, dy = x - lx, y - ly
+        length = float(np.hypot(dx, dy))
+        if length == 0:
+            return []
+        dabs = []
+        # Distance along this segment to the next dab; the rest carries over
+        pos = self._carry
+        while pos <= length:
+            t = pos / length
+            p = lp + (pressure - lp) * t
+            dabs.append(self._dab(lx + dx * t, ly + dy * t, p))
+            pos += self._step(p)
+        self._carry = pos - length
+        self._last = (x, y, pressure)
+        return dabs
+
+    @staticmethod
+    def bounds(dabs):
+        """ (x0, y0, x1, y1) image rectangle touched by `dabs` """
+        x0 = min(int(x - d / 2.0) - 2 for x, y, d, o in dabs)
+        y0 = min(int(y - d / 2.0) - 2 for x, y, d, o in dabs)
+        x1 = max(int(x + d / 2.0) + 3 for x, y, d, o in dabs)
+        y1 = max(int(y + d / 2.0) + 3 for x, y, d, o in dabs)
+        return x0, y0, x1, y1
+
+    def _coverage(self, x0, y0, x1, y1):
+        # Coverage buffer view for an image rectangle, growing the buffer if needed
+        if self._cov is None:
+            self._cov_x, self._cov_y = x0 - 64, y0 - 64
+            self._cov = np.zeros((y1 - y0 + 128, x1 - x0 + 128), np.float32)
+        cy, cx = self._cov.shape
+        if x0 < self._cov_x or y0 < self._cov_y or x1 > self._cov_x + cx or y1 > self._cov_y + cy:
+            nx0 = min(x0, self._cov_x) - 64
+            ny0 = min(y0, self._cov_y) - 64
+            nx1 = max(x1, self._cov_x + cx) + 64
+            ny1 = max(y1, self._cov_y + cy) + 64
+            grown = np.zeros((ny1 - ny0, nx1 - nx0), np.float32)
+            grown[self._cov_y - ny0:self._cov_y - ny0 + cy,
+                  self._cov_x - nx0:self._cov_x - nx0 + cx] = self._cov
+            self._cov, self._cov_x, self._cov_y = grown, nx0, ny0
+        return self._cov[y0 - self._cov_y:y1 - self._cov_y, x0 - self._cov_x:x1 - self._cov_x]
+
+    def apply(self, pieces, dabs):
+        """ Blend `dabs` into buffer pieces given as (view, x, y) image-space blocks """
+        for x, y, diameter, opacity in dabs:
+            mask = dab_mask(diameter, self.hardness)
+            n = mask.shape[0]
+            mx0 = int(round(x - (n - 1) / 2.0))
+            my0 = int(round(y - (n - 1) / 2.0))
+            for view, ox, oy in pieces:
+                # Intersection of the dab with this piece, in image coordinates
+                ix0, iy0 = max(mx0, ox), max(my0, oy)
+                ix1 = min(mx0 + n, ox + view.shape[1])
+                iy1 = min(my0 + n, oy + view.shape[0])
+                if ix1 <= ix0 or iy1 <= iy0:
+                    continue
+                amount = mask[iy0 - my0:iy1 - my0, ix0 - mx0:ix1 - mx0] * self.flow
+                cov = self._coverage(ix0, iy0, ix1, iy1)
+                new_cov = np.where(cov < opacity, cov + (opacity - cov) * amount, cov)
+                # Fraction of the remaining distance to the brush color to cover
+                t = (new_cov - cov) / np.maximum(1.0 - cov, 1e-6)
+                cov[...] = new_cov
+                sub = view[iy0 - oy:iy1 - oy, ix0 - ox:ix1 - ox]
+                if sub.ndim == 3:
+                    t = t[..., None]
+                blended = sub + (self.pixel - sub) * t
+                sub[...] = np.rint(blended).astype(sub.dtype)
+
+
+def _rgb_key(view, rgb_index):
+    # Pack the color channels of a pixel block into one integer per pixel
+    if rgb_index is None:
+        return view.astype(np.uint32) if view.ndim == 2 else view[..., 0].astype(np.uint32)
+    r, g, b = (view[..., i] for i in rgb_index)
+    if view.dtype == np.uint8:
+        return (r.astype(np.uint32) << 16) | (g.astype(np.uint32) << 8) | b
+    return (r.astype(np.uint64) << 32) | (g.astype(np.uint64) << 16) | b
+
+
+class RegionStats:
+    """ Lazily built statistics over an image buffer for fast color queries.
+
+    Sums are kept per tile, with a summed-area table over the tile sums and
+    per-tile summed-area tables built on demand, so any rectangle's mean
+    costs a handful of lookups. Colors (ignoring alpha) are kept as a sorted
+    histogram of distinct values, which `histogram_steps` can count on a
+    worker thread in idle moments. Callers report edits with `before_edit`; the
+    affected tiles and histogram entries are updated on the next query.
+    """
+
+    TILE = 256
+    _LOCAL_CACHE = 64
+
+    def __init__(self, get_view, rgb_index=None):
+        self._get_view = get_view
+        self.rgb_index = rgb_index
+        self._tile_sums = None
+        self._tile_sat = None
+        self._local = OrderedDict()
+        self._colors = None
+        self._counts = None
+        self._pending = None
+        self._edits = 0
+
+    # --- maintenance --------------------------------------------------------
+    def _channels(self, view):
+        return view[..., None] if view.ndim == 2 else view
+
+    def _build_tiles(self):
+        view = self._channels(self._get_view())
+        h, w = view.shape[:2]
+        rows = np.arange(0, h, self.TILE)
+        cols = np.arange(0, w, self.TILE)
+        sums = np.empty((len(rows), len(cols), view.shape[2]), np.int64)
+        for i, y in enumerate(rows):
+            band = view[y:y + self.TILE].sum(axis=0, dtype=np.int64)
+            sums[i] = np.add.reduceat(band, cols, axis=0)
+        self._tile_sums = sums
+        self._tile_sat = None
+        self._local.clear()
+
+    @property
+    def histogram_ready(self):
+        return self._counts is not None
+
+    def histogram_steps(self, band_pixels=1 << 20):
+        """ Generator that counts colors one row band per step, for adopt_histogram().
+
+        Only distinct colors are kept, so memory follows the image's
+        palette rather than the color space. It only reads the buffer, so
+        it may run on a worker thread; an edit reported meanwhile abandons
+        the count.
+        """
+        edits = self._edits
+        view = self._get_view()
+        band = max(1, band_pixels // max(1, view.shape[1]))
+        colors, counts = np.zeros(0, np.uint64), np.zeros(0, np.int64)
+        for y in range(0, view.shape[0], band):
+            colors, counts = self._hist_merge(colors, counts, view[y:y + band], 1)
+            yield
+            if self._edits != edits:
+                return None
+        return edits, colors, counts
+
+    def adopt_histogram(self, result):
+        """ Install what histogram_steps() returned, unless the image changed since it started """
+        if result is None or result[0] != self._edits:
+            return False
+        # The pending edit was finished before the count began, so it is included
+        self._flush()
+        self._colors, self._counts = result[1], result[2]
+        return True
+
+    def _build_histogram(self):
+        self._flush()
+        steps = self.histogram_steps(4 * 1024 * 1024)
+        try:
+            while True:
+                next(steps)
+        except StopIteration as stop:
+            self.adopt_histogram(stop.value)
+
+    def _hist_merge(self, hist_colors, hist_counts, block, sign):
+        # (colors, counts) of the histogram with the pixels of block added or removed
+        colors, counts = np.unique(_rgb_key(block, self.rgb_index).astype(np.uint64),
+                                   return_counts=True)
+        idx = np.searchsorted(hist_colors, colors)
+        found = idx < len(hist_colors)
+        found[found] = hist_colors[idx[found]] == colors[found]
+        np.add.at(hist_counts, idx[found], sign * counts[found])
+        new = ~found
+        if new.any() and sign > 0:
+            hist_colors = np.insert(hist_colors, idx[new], colors[new])
+            hist_counts = np.insert(hist_counts, idx[new], counts[new])
+        return hist_colors, hist_counts
+
+    def _hist_add(self, block, sign):
+        self._colors, self._counts = self._hist_merge(self._colors, self._counts, block, sign)
+
+    def _flush(self):
+        # Add back the pixels of the last edited rect, now that the edit is done
+        if self._pending is None:
+            return
+        x0, y0, x1, y1 = self._pending
+        self._pending = None
+        view = self._get_view()
+        if self._counts is not None:
+            self._hist_add(view[y0:y1, x0:x1], 1)
+        if self._tile_sums is not None:
+            view = self._channels(view)
+            T = self.TILE
+            for ty in range(y0 // T, (y1 - 1) // T + 1):
+                for tx in range(x0 // T, (x1 - 1) // T + 1):
+                    self._tile_sums[ty, tx] = view[ty * T:(ty + 1) * T, tx * T:(tx + 1) * T].sum(
+                        axis=(0, 1), dtype=np.int64)
+                    self._local.pop((ty, tx), None)
+            self._tile_sat = None
+
+    def before_edit(self, rect=None):
+        """ Report that pixels in rect (x0, y0, x1, y1), or anywhere if None, are about to change """
+        self._edits += 1
+        if rect is None:
+            self.invalidate()
+            return
+        self._flush()
+        view = self._get_view()
+        h, w = view.shape[:2]
+        x0, y0, x1, y1 = max(0, rect[0]), max(0, rect[1]), min(w, rect[2]), min(h, rect[3])
+        if x1 <= x0 or y1 <= y0:
+            return
+        if self._counts is not None:
+            self._hist_add(view[y0:y1, x0:x1], -1)
+        self._pending = (x0, y0, x1, y1)
+
+    def invalidate(self):
+        self._edits += 1
+        self._tile_sums = None
+        self._tile_sat = None
+        self._local.clear()
+        self._colors = None
+        self._counts = None
+        self._pending = None
+
+    # --- queries ------------------------------------------------------------
+    def _local_sat(self, ty, tx):
+        sat = self._local.get((ty, tx))
+        if sat is None:
+            T = self.TILE
+            tile = self._channels(self._get_view())[ty * T:(ty + 1) * T, tx * T:(tx + 1) * T]
+            sat = np.zeros((tile.shape[0] + 1, tile.shape[1] + 1, tile.shape[2]), np.int64)
+            np.cumsum(np.cumsum(tile, axis=0, dtype=np.int64), axis=1, out=sat[1:, 1:])
+            self._local[(ty, tx)] = sat
+            if len(self._local) > self._LOCAL_CACHE:
+                self._local.popitem(last=False)
+        else:
+            self._local.move_to_end((ty, tx))
+        return sat
+
+    def sum(self, x0, y0, x1, y1):
+        """ Per-channel sum over the rectangle [x0, x1) x [y0, y1) """
+        self._flush()
+        if self._tile_sums is None:
+            self._build_tiles()
+        if self._tile_sat is None:
+            ts = self._tile_sums
+            sat = np.zeros((ts.shape[0] + 1, ts.shape[1] + 1, ts.shape[2]), np.int64)
+            np.cumsum(np.cumsum(ts, axis=0), axis=1, out=sat[1:, 1:])
+            self._tile_sat = sat
+        T = self.TILE
+        # Tiles fully inside the rect come from the tile-level table
+        ta_x, ta_y = -(-x0 // T), -(-y0 // T)
+        tb_x, tb_y = x1 // T, y1 // T
+        view_h, view_w = self._get_view().shape[:2]
+        if x1 == view_w:
+            tb_x = self._tile_sums.shape[1]
+        if y1 == view_h:
+            tb_y = self._tile_sums.shape[0]
+        total = np.zeros(self._tile_sums.shape[2], np.int64)
+        inner = ta_x < tb_x and ta_y < tb_y
+        if inner:
+            s = self._tile_sat
+            total += s[tb_y, tb_x] - s[ta_y, tb_x] - s[tb_y, ta_x] + s[ta_y, ta_x]
+        # Partially covered tiles along the border use their own tables
+        for ty in range(y0 // T, (y1 - 1) // T + 1):
+            for tx in range(x0 // T, (x1 - 1) // T + 1):
+                if inner and ta_x <= tx < tb_x and ta_y <= ty < tb_y:
+                    continue
+                sat = self._local_sat(ty, tx)
+                lx0, ly0 = max(x0 - tx * T, 0), max(y0 - ty * T, 0)
+                lx1 = min(x1 - tx * T, sat.shape[1] - 1)
+                ly1 = min(y1 - ty * T, sat.shape[0] - 1)
+                total += sat[ly1, lx1] - sat[ly0, lx1] - sat[ly1, lx0] + sat[ly0, lx0]
+        return total
+
+    def mean(self, x0, y0, x1, y1):
+        """ Per-channel mean over the rectangle, clipped to the image """
+        h, w = self._get_view().shape[:2]
+        x0, y0, x1, y1 = max(0, x0), max(0, y0), min(w, x1), min(h, y1)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return self.sum(x0, y0, x1, y1) / float((x1 - x0) * (y1 - y0))
+
+    def _histogram(self):
+        self._flush()
+        if self._counts is None:
+            self._build_histogram()
+        return self._colors, self._counts
+
+    def _unpack(self, colors):
+        if self.rgb_index is None:
+            return colors[:, None].astype(np.int64)
+        shift = 8 if self._get_view().dtype == np.uint8 else 16
+        mask = (1 << shift) - 1
+        return np.stack([(colors >> np.uint64(2 * shift)) & np.uint64(mask),
+                         (colors >> np.uint64(shift)) & np.uint64(mask),
+                         colors & np.uint64(mask)], axis=1).astype(np.int64)
+
+    def count_within(self, color, tolerance=0):
+        """ Number of pixels whose (r, g, b) or gray value is within `tolerance` of `color` """
+        colors, counts = self._histogram()
+        target = np.atleast_1d(np.asarray(color, np.int64))
+        if tolerance == 0 and colors.size:
+            if self.rgb_index is None:
+                key = int(target[0])
+            else:
+                shift = 8 if self._get_view().dtype == np.uint8 else 16
+                key = (int(target[0]) << (2 * shift)) | (int(target[1]) << shift) | int(target[2])
+            i = np.searchsorted(colors, np.uint64(key))
+            return int(counts[i]) if i < len(colors) and colors[i] == key else 0
+        near = np.all(np.abs(self._unpack(colors) - target) <= tolerance, axis=1)
+        return int(counts[near].sum())
+
+    def dominant(self, n=1):
+        """ The `n` most frequent colors as ((r, g, b) or (gray,), count) pairs """
+        colors, counts = self._histogram()
+        order = np.argsort(counts)[::-1][:n]
+        channels = self._unpack(colors[order])
+        return [(tuple(int(v) for v in c), int(k)) for c, k in zip(channels, counts[order]) if k > 0]
+
+
+# Pixels processed per band by the whole-image passes below
+_BAND_PIXELS = 4 * 1024 * 1024
+
+_BAYER8 = np.array([[0, 32, 8, 40, 2, 34, 10, 42], [48, 16, 56, 24, 50, 18, 58, 26],
+                    [12, 44, 4, 36, 14, 46, 6, 38], [60, 28, 52, 20, 62, 30, 54, 22],
+                    [3, 35, 11, 43, 1, 33, 9, 41], [51, 19, 59, 27, 49, 17, 57, 25],
+                    [15, 47, 7, 39, 13, 45, 5, 37], [63, 31, 55, 23, 61, 29, 53, 21]],
+                   np.float32) / 64.0 - 0.5
+
+
+def _bands(height, width):
+    step = max(1, _BAND_PIXELS // max(1, width))
+    return range(0, height, step), step
+
+
+def is_grayscale(view):
+    """ True if an ARGB32 (B, G, R, A) buffer is opaque with r == g == b everywhere """
+    rows, step = _bands(view.shape[0], view.shape[1])
+    for y in rows:
+        band = view[y:y + step]
+        if not ((band[..., 0] == band[..., 1]).all() and (band[..., 1] == band[..., 2]).all()
+                and (band[..., 3] == 255).all()):
+            return False
+    return True
+
+
+def _index_keys(view, palette):
+    # Palette indices of every pixel, or None and the colors missing from the palette
+    h, w = view.shape[:2]
+    indices = np.empty((h, w), np.uint8)
+    rows, step = _bands(h, w)
+    for y in rows:
+        keys = view[y:y + step].view(np.uint32)[..., 0]
+        idx = np.searchsorted(palette, keys)
+        idx[idx >= len(palette)] = 0
+        missing = palette[idx] != keys
+        if missing.any():
+            return None, np.unique(keys[missing])
+        indices[y:y + step] = idx
+    return indices, None
+
+
+def exact_palette(view, max_colors=256):
+    """ (indices, ARGB keys) for an ARGB32 buffer with at most `max_colors` colors, else None """
+    h, w = view.shape[:2]
+    # A subsample rules out photographic content without touching every pixel
+    sample = view[::max(1, h // 256), ::max(1, w // 256)].view(np.uint32)[..., 0]
+    palette = np.unique(sample)
+    while len(palette) <= max_colors:
+        indices, missing = _index_keys(view, palette)
+        if indices is not None:
+            return indices, palette
+        palette = np.union1d(palette, missing)
+    return None
+
+
+def median_cut(rgb, n_colors):
+    """ Palette of up to `n_colors` (k, 3) colors from (N, 3) samples by median cut """
+    boxes = [rgb]
+    while len(boxes) < n_colors:
+        # Split the box with the widest channel range at its median
+        best, best_range = None, 0
+        for i, box in enumerate(boxes):
+            if len(box) < 2:
+                continue
+            span = box.max(axis=0).astype(int) - box.min(axis=0)
+            if span.max() > best_range:
+                best, best_range = i, span.max()
+        if best is None:
+            break
+        box = boxes.pop(best)
+        channel = int(np.argmax(box.max(axis=0).astype(int) - box.min(axis=0)))
+        box = box[np.argsort(box[:, channel], kind='stable')]
+        mid = len(box) // 2
+        boxes += [box[:mid], box[mid:]]
+    return np.array([np.rint(box.mean(axis=0)) for box in boxes if len(box)], np.uint8)
+
+
+def palette_lut(palette):
+    """ 32x32x32 table mapping 5-bit (r, g, b) cells to the nearest palette index """
+    centers = (np.arange(32, dtype=np.float32) * 8 + 4)
+    grid = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'), axis=-1).reshape(-1, 1, 3)
+    lut = np.empty(grid.shape[0], np.uint8)
+    pal = palette.astype(np.float32)[None]
+    for start in range(0, grid.shape[0], 4096):
+        d = ((grid[start:start + 4096] - pal) ** 2).sum(axis=2)
+        lut[start:start + 4096] = np.argmin(d, axis=1)
+    return lut.reshape(32, 32, 32)
+
+
+def quantize(view, n_colors=256, dither=False, sample_size=200_000):
+    """ Reduce an ARGB32 buffer to (indices, ARGB keys) with at most `n_colors` entries.
+
+    The palette comes from median cut on a random subsample and is applied
+    through a 5-bit RGB lookup table, optionally with ordered dithering.
+    Pixels with alpha below 128 map to a single transparent entry.
+    """
+    h, w = view.shape[:2]
+    flat = view.reshape(-1, 4)
+    rng = np.random.default_rng(0)
+    pick = rng.integers(0, flat.shape[0], min(sample_size, flat.shape[0]))
+    sample = flat[pick]
+    opaque = sample[:, 3] >= 128
+    has_transparent = not opaque.all()
+    n_rgb = n_colors - 1 if has_transparent else n_colors
+    palette = median_cut(sample[opaque][:, [2, 1, 0]], max(1, n_rgb)) if opaque.any() \
+        else np.zeros((1, 3), np.uint8)
+    lut = palette_lut(palette)
+    spread = 255.0 / max(1.0, len(palette) ** (1.0 / 3.0))
+    indices = np.empty((h, w), np.uint8)
+    rows, step = _bands(h, w)
+    for y in rows:
+        band = view[y:y + step]
+        rgb = band[..., [2, 1, 0]]
+        if dither:
+            yy = (np.arange(y, y + band.shape[0]) % 8)[:, None]
+            xx = (np.arange(w) % 8)[None, :]
+            offset = (_BAYER8[yy, xx] * spread)[..., None]
+            rgb = np.clip(rgb + offset, 0, 255).astype(np.uint8)
+        cells = rgb >> 3
+        idx = lut[cells[..., 0], cells[..., 1], cells[..., 2]]
+        if has_transparent:
+            idx = idx + 1
+            idx[band[..., 3] < 128] = 0
+        indices[y:y + step] = idx
+    keys = (0xFF000000 | (palette[:, 0].astype(np.uint32) << 16)
+            | (palette[:, 1].astype(np.uint32) << 8) | palette[:, 2])
+    if has_transparent:
+        keys = np.concatenate([np.zeros(1, np.uint32), keys])
+    return indices, keys
+
+
+def indexed_qimage(indices, keys):
+    """ Format_Indexed8 QImage from palette indices and ARGB color keys """
+    h, w = indices.shape
+    image = QImage(w, h, QImage.Format.Format_Indexed8)
+    image.setColorTable([int(k) for k in keys])
+    qimage_view(image)[...] = indices
+    return image
+
+
+_FORMAT_NAMES = {
+    QImage.Format.Format_Grayscale8: "8-bit grayscale",
+    QImage.Format.Format_Grayscale16: "16-bit grayscale",
+    QImage.Format.Format_RGB888: "24-bit RGB",
+    QImage.Format.Format_RGBA64: "16-bit per channel RGBA",
+}
+
+
+def compact_image(image, n_colors=None, dither=False):
+    """ Smallest lossless encoding of an ARGB32 image, or a quantized one.
+
+    Returns (QImage, description). Opaque gray images become Grayscale8,
+    images with at most 256 colors become an exact palette, and with
+    `n_colors` set the colors are quantized to that many palette entries.
+    """
+    if image.format() != QImage.Format.Format_ARGB32:
+        return image, _FORMAT_NAMES.get(image.format(), "unchanged")
+    view = qimage_view(image, readonly=True)
+    if n_colors is None:
+        if is_grayscale(view):
+            return image.convertToFormat(QImage.Format.Format_Grayscale8), "8-bit grayscale"
+        exact = exact_palette(view)
+        if exact is None:
+            return image, "32-bit ARGB"
+        indices, keys = exact
+        return indexed_qimage(indices, keys), f"8-bit palette, {len(keys)} colors (lossless)"
+    indices, keys = quantize(view, n_colors, dither)
+    mode = "dithered" if dither else "quantized"
+    return indexed_qimage(indices, keys), f"8-bit palette, {len(keys)} colors ({mode})"
+
+
+_POOL = None
+
+
+def thread_pool():
+    """ Shared worker pool for stripe/tile-parallel NumPy passes (NumPy releases the GIL) """
+    global _POOL
+    if _POOL is None:
+        _POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="image-ops")
+    return _POOL
+
+
+def parallel_stripes(func, height, min_rows=32):
+    """ Run func(y0, y1) over horizontal stripes covering [0, height) on the pool """
+    workers = os.cpu_count() or 4
+    rows = max(min_rows, -(-height // (workers * 2)))
+    futures = [thread_pool().submit(func, y, min(height, y + rows)) for y in range(0, height, rows)]
+    for future in futures:
+        future.result()
+
+
+def _box(x):
+    return ((x > -0.5) & (x <= 0.5)).astype(np.float64)
+
+
+def _bicubic(x, a=-0.5):
+    x = np.abs(x)
+    return np.where(x < 1.0, ((a + 2.0) * x - (a + 3.0)) * x * x + 1,
+                    np.where(x < 2.0, (((x - 5) * x + 8) * x - 4) * a, 0.0))
+
+
+def _lanczos(x):
+    return np.where(np.abs(x) < 3.0, np.sinc(x) * np.sinc(x / 3.0), 0.0)
+
+
+# Resampling filters by name: (kernel, support), as defined by Pillow
+RESAMPLE_FILTERS = {
+    "lanczos": (_lanczos, 3.0),
+    "bicubic": (_bicubic, 2.0),
+    "area": (_box, 0.5),
+}
+
+
+def _resample_matrices(in_size, out_size, kernel, support, block=64):
+    # Banded resampling matrix cut into dense blocks: for every run of
+    # `block` outputs, (input start, input stop, output start, weights)
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = support * filterscale
+    centers = (np.arange(out_size) + 0.5) * scale
+    starts = np.maximum((centers - support + 0.5).astype(np.int64), 0)
+    ends = np.minimum((centers + support + 0.5).astype(np.int64), in_size)
+    taps = int((ends - starts).max())
+    pos = starts[:, None] + np.arange(taps)[None, :]
+    weights = kernel((pos - centers[:, None] + 0.5) / filterscale)
+    weights[pos >= ends[:, None]] = 0.0
+    total = weights.sum(axis=1, keepdims=True)
+    weights /= np.where(total == 0, 1.0, total)
+    pos = np.minimum(pos, ends[:, None] - 1)
+    blocks = []
+    for o0 in range(0, out_size, block):
+        o1 = min(out_size, o0 + block)
+        lo, hi = int(starts[o0:o1].min()), int(ends[o0:o1].max())
+        dense = np.zeros((hi - lo, o1 - o0), np.float32)
+        cols = np.repeat(np.arange(o1 - o0), taps)
+        np.add.at(dense, (pos[o0:o1].ravel() - lo, cols), weights[o0:o1].ravel())
+        blocks.append((lo, hi, o0, dense))
+    return blocks
+
+
+def resize(view, width, height, method="lanczos", alpha_channel=None, check=None):
+    """ Resample a (h, w[, c]) buffer to (height, width) with separable filter passes.
+
+    Each pass is a banded matrix product computed block by block on the
+    thread pool. The passes run horizontal then vertical, with the
+    intermediate rounded to the pixel range between them, like Pillow.
+    With `alpha_channel` the color channels are filtered premultiplied by
+    alpha. `check(fraction)` is called as blocks finish and may raise to
+    abort.
+    """
+    kernel, support = RESAMPLE_FILTERS[method]
+    src = view if view.ndim == 3 else view[..., None]
+    in_h, in_w, channels = src.shape
+    dtype = view.dtype
+    limit = float(np.iinfo(dtype).max)
+
+    # Planar float copy: (channels, rows, columns) so both passes are matmuls
+    planar = np.empty((channels, in_h, in_w), np.float32)
+
+    def convert(a, b):
+        block = src[a:b].astype(np.float32)
+        if alpha_channel is not None:
+            alpha = block[..., alpha_channel:alpha_channel + 1].copy()
+            block *= alpha / limit
+            block[..., alpha_channel:alpha_channel + 1] = alpha
+            np.rint(block, out=block)
+        planar[:, a:b] = block.transpose(2, 0, 1)
+    _checked_stripes(convert, in_h, check, 0.0, 0.1)
+
+    def run_blocks(blocks, func, start):
+        futures = [thread_pool().submit(func, *b) for b in blocks]
+        try:
+            for i, future in enumerate(futures):
+                future.result()
+                if check is not None:
+                    check(start + 0.4 * (i + 1) / len(futures))
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def horizontal(source, target):
+        def job(lo, hi, o0, dense):
+            np.matmul(source[:, :, lo:hi], dense, out=target[:, :, o0:o0 + dense.shape[1]])
+        run_blocks(_resample_matrices(source.shape[2], width, kernel, support), job, 0.1)
+
+    def vertical(source, target):
+        def job(lo, hi, o0, dense):
+            np.matmul(dense.T, source[:, lo:hi, :], out=target[:, o0:o0 + dense.shape[1], :])
+        run_blocks(_resample_matrices(source.shape[1], height, kernel, support), job, 0.5)
+
+    # Horizontal pass, then vertical, in Pillow's order: the intermediate is
+    # rounded to the pixel range, so the order changes the result. A pass
+    # that keeps its size is the identity and is skipped
+    if width != in_w:
+        mid = np.empty((channels, in_h, width), np.float32)
+        horizontal(planar, mid)
+        np.clip(np.floor(mid + 0.5, out=mid), 0, limit, out=mid)
+    else:
+        mid = planar
+    del planar
+    if height != in_h:
+        result = np.empty((channels, height, width), np.float32)
+        vertical(mid, result)
+    else:
+        result = mid
+    del mid
+
+    out = np.empty((height, width, channels), dtype)
+
+    def finish(a, b):
+        block = np.clip(np.floor(result[:, a:b].transpose(1, 2, 0) + 0.5), 0, limit)
+        if alpha_channel is not None:
+            alpha = block[..., alpha_channel:alpha_channel + 1].copy()
+            block *= np.where(alpha > 0, limit / np.maximum(alpha, 1.0), 0.0)
+            block[..., alpha_channel:alpha_channel + 1] = alpha
+            np.clip(np.floor(block + 0.5), 0, limit, out=block)
+        out[a:b] = block
+    _checked_stripes(finish, height, check, 0.9, 0.1)
+    return out if view.ndim == 3 else out[..., 0]
+
+
+def resize_image(image, width, height, method="lanczos", check=None):
+    """ `image` resampled to width x height, in its own format where that has a buffer layout """
+    fmt = image.format()
+    if fmt == QImage.Format.Format_ARGB32_Premultiplied or fmt == QImage.Format.Format_Indexed8:
+        image = image.convertToFormat(QImage.Format.Format_ARGB32)
+        fmt = image.format()
+    alpha = 3 if fmt in ALPHA_FORMATS else None
+    return array_to_qimage(resize(qimage_view(image, readonly=True), width, height, method, alpha, check), fmt)
+
+
+def _pixel_words(view):
+    # View 8-bit 4-channel pixels as one uint32 each so moves copy whole pixels
+    if view.ndim == 3 and view.shape[2] == 4 and view.dtype == np.uint8 and view.strides[1] == 4:
+        return view.view(np.uint32)[..., 0]
+    return view
+
+
+def flip(view, horizontal):
+    """ Mirror a (h, w[, c]) buffer in place, left-right or top-bottom """
+    arr = _pixel_words(view)
+    height = arr.shape[0]
+    if horizontal:
+        def job(a, b):
+            # The reversed stripe overlaps its target, so NumPy buffers one stripe
+            arr[a:b] = arr[a:b, ::-1]
+        parallel_stripes(job, height)
+        return
+    # Swap row blocks from both ends towards the middle
+    half = height // 2
+    block = 64
+
+    def swap(a, b):
+        for y in range(a, b, block):
+            y1 = min(b, y + block)
+            top = arr[y:y1].copy()
+            arr[y:y1] = arr[height - y1:height - y][::-1]
+            arr[height - y1:height - y] = top[::-1]
+    parallel_stripes(swap, half)
+
+
+def rotate90(view, turns):
+    """ New C-contiguous copy of a (h, w[, c]) buffer turned clockwise by 90 * turns degrees.
+
+    Half turns are flips; quarter turns copy the transposed source in tiles
+    so reads and writes both stay within cache.
+    """
+    turns %= 4
+    if turns == 0:
+        return view.copy()
+    if turns == 2:
+        out = view.copy()
+        flip(out, True)
+        flip(out, False)
+        return out
+    src = _pixel_words(view)
+    height, width = src.shape[:2]
+    # Clockwise: out[i, j] = src[h - 1 - j, i]; counter-clockwise: src[j, w - 1 - i]
+    rotated = src[::-1].swapaxes(0, 1) if turns == 1 else src.swapaxes(0, 1)[::-1]
+    out = np.empty((width, height) + view.shape[2:], view.dtype)
+    target = _pixel_words(out)
+    tile = 256
+
+    def job(a, b):
+        for x in range(0, height, tile):
+            target[a:b, x:x + tile] = rotated[a:b, x:x + tile]
+    parallel_stripes(job, width, min_rows=tile)
+    return out
+
+
+def _checked_stripes(func, height, check=None, start=0.0, span=1.0, min_rows=32):
+    # parallel_stripes with a cancellation/progress callback between stripes
+    workers = os.cpu_count() or 4
+    rows = max(min_rows, -(-height // (workers * 8)))
+    futures = [thread_pool().submit(func, y, min(height, y + rows)) for y in range(0, height, rows)]
+    try:
+        for i, future in enumerate(futures):
+            future.result()
+            if check is not None:
+                check(start + span * (i + 1) / len(futures))
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def match_mask(view, value, check=None, start=0.0, span=1.0):
+    """ Boolean (h, w) mask of the pixels of a (h, w[, c]) buffer equal to `value` """
+    mask = np.empty(view.shape[:2], bool)
+    value = np.asarray(value, view.dtype)
+    words = _pixel_words(view)
+    if words is not view:
+        # Compare whole 32-bit pixels instead of channel by channel
+        view, value = words, value.view(np.uint32)[0]
+
+    def job(a, b):
+        equal = view[a:b] == value
+        mask[a:b] = equal.all(axis=2) if view.ndim == 3 else equal
+    _checked_stripes(job, view.shape[0], check, start, span)
+    return mask
+
+
+def _run_at(line, col):
+    # [start, stop) of the run of True values in a mask row that contains col
+    left = line[:col][::-1]
+    start = col - int(np.argmin(left)) if left.size and not left.all() else 0
+    right = line[col:]
+    stop = col + int(np.argmin(right)) if not right.all() else line.size
+    return start, stop
+
+
+def flood_fill(view, x, y, value, check=None):
+    """ Scanline-fill the 4-connected area of the pixel at (x, y) with `value`, in place.
+
+    Matching is on the whole pixel (all channels) like QColor equality.
+    Returns the number of pixels filled. `check(fraction)` is called now
+    and then and may raise to abort.
+    """
+    height = view.shape[0]
+    value = np.asarray(value, view.dtype)
+    words = _pixel_words(view)
+    if words is not view:
+        view, value = words, value.view(np.uint32)[0]
+    target = view[y, x].copy()
+    if np.array_equal(target, value):
+        return 0
+    # Unfilled pixels of the target color; cleared as runs get filled
+    mask = match_mask(view, target, check, 0.0, 0.2)
+    total = max(1, int(np.count_nonzero(mask)))
+    filled = 0
+    spans = [(y,) + _run_at(mask[y], x)]
+    while spans:
+        row, a, b = spans.pop()
+        line = mask[row]
+        if not line[a]:
+            # Reached from another side already; runs are filled whole
+            continue
+        view[row, a:b] = value
+        line[a:b] = False
+        filled += b - a
+        for nrow in (row - 1, row + 1):
+            if 0 <= nrow < height:
+                seg = mask[nrow, a:b]
+                if not seg.any():
+                    continue
+                starts = np.flatnonzero(seg[1:] & ~seg[:-1]) + 1
+                if seg[0]:
+                    starts = np.concatenate(([0], starts))
+                for s in starts:
+                    spans.append((nrow,) + _run_at(mask[nrow], a + int(s)))
+        if check is not None:
+            check(0.2 + 0.8 * filled / total)
+    return filled
+
+
+def make_transparent(view, rgb, rgb_index, check=None):
+    """ Clear (all channels 0) every pixel whose color channels equal `rgb`, in place """
+    ri, gi, bi = rgb_index
+    r, g, b = rgb
+    counts = []
+    words = _pixel_words(view)
+    if words is not view:
+        # One masked compare per 32-bit pixel (little-endian channel order)
+        key = (r << 8 * ri) | (g << 8 * gi) | (b << 8 * bi)
+        color_bits = (0xFF << 8 * ri) | (0xFF << 8 * gi) | (0xFF << 8 * bi)
+
+        def job(a, b_):
+            block = words[a:b_]
+            hit = (block & np.uint32(color_bits)) == np.uint32(key)
+            block[hit] = 0
+            counts.append(int(np.count_nonzero(hit)))
+    else:
+        def job(a, b_):
+            block = view[a:b_]
+            hit = (block[..., ri] == r) & (block[..., gi] == g) & (block[..., bi] == b)
+            block[hit] = 0
+            counts.append(int(np.count_nonzero(hit)))
+    _checked_stripes(job, view.shape[0], check)
+    return sum(counts)
+
+
+def fill_region(view, x, y, check=None):
+    """ The area flood_fill() would fill from (x, y), as ((x, y, w, h), mask).
+
+    `mask` is the (h, w) bool mask of the area within its bounding box.
+    Found by labelling the runs of the target color rather than by filling,
+    so the cost doesn't depend on the shape of the area.
+    """
+    mask = match_mask(view, view[y, x].copy(), check, 0.0, 0.6)
+    rows, starts, stops, labels = label_components(mask, connectivity=4)
+    del mask
+    if check is not None:
+        check(0.9)
+    hit = np.flatnonzero((rows == y) & (starts <= x) & (stops > x))[0]
+    own = labels == labels[hit]
+    rows, starts, stops = rows[own], starts[own], stops[own]
+    x0, y0 = int(starts.min()), int(rows.min())
+    w, h = int(stops.max()) - x0, int(rows.max()) + 1 - y0
+    lengths = stops - starts
+    out = np.zeros((h, w), bool)
+    ys = np.repeat(rows - y0, lengths)
+    xs = np.repeat(starts - x0 - np.cumsum(lengths) + lengths, lengths) + np.arange(int(lengths.sum()))
+    out[ys, xs] = True
+    return (x0, y0, w, h), out
+
+
+# Entries in the color table a gradient is looked up in
+GRADIENT_STEPS = 4096
+
+
+def gradient_fill(view, kind, start, end, stops, alpha=None, mask=None, origin=(0, 0), step=1, check=None):
+    """ Paint a linear or radial gradient over a (h, w[, c]) buffer, in place.
+
+    The gradient runs from `start` to `end` (x, y): "linear" is constant
+    along lines across that vector, "radial" along circles around `start`
+    reaching `end`; past either end the end colors continue. `stops` are
+    (position 0-1, color in the buffer layout (see pixel_value()), opacity
+    0-1) in order of position. Translucent stops are composited over the
+    pixels, over their own alpha if the buffer has one at channel `alpha`.
+    With `mask` (bool, the buffer's shape) only its True pixels change.
+    Pixel (i, j) of the buffer is at origin + (j, i) * step, so a sampled
+    proxy shows the gradient the full image would get.
+    """
+    pixels = view if view.ndim == 3 else view[..., None]
+    h, w, channels = pixels.shape
+    top = np.iinfo(view.dtype).max
+    positions = [float(p) for p, _, _ in stops]
+    colors = np.array([np.broadcast_to(np.asarray(c, np.float32), (channels,)) for _, c, _ in stops])
+    grid = np.linspace(0.0, 1.0, GRADIENT_STEPS)
+    table = np.stack([np.interp(grid, positions, colors[:, i]) for i in range(channels)], axis=1)
+    opacity = np.interp(grid, positions, [float(a) for _, _, a in stops]).astype(np.float32)
+    opaque = bool((opacity >= 1.0).all())
+    lut = np.rint(table).astype(view.dtype)
+    # Translucent stops: the color already weighted by its opacity, and what
+    # is left of the pixel under it, per channel so the blend needs no
+    # broadcasting (which is several times slower than same-shape arithmetic)
+    weighted = (table * opacity[:, None]).astype(np.float32)
+    left = np.repeat((1.0 - opacity)[:, None], channels, axis=1)
+    words = _pixel_words(pixels)
+    if opaque and words is not pixels:
+        lut = lut.view(np.uint32)[:, 0]
+    sx, sy = start
+    dx, dy = end[0] - sx, end[1] - sy
+    length2 = max(dx * dx + dy * dy, 1e-12)
+    # Pixel centers relative to the start, as a row and a column to broadcast
+    xs = ((origin[0] + np.arange(w) * step + 0.5) - sx).astype(np.float32)[None, :]
+    ys = ((origin[1] + np.arange(h) * step + 0.5) - sy).astype(np.float32)[:, None]
+    if kind == "linear":
+        xs *= np.float32(dx / length2)
+        ys *= np.float32(dy / length2)
+    else:
+        xs /= np.float32(np.sqrt(length2))
+        ys /= np.float32(np.sqrt(length2))
+    # Rows per block, so the temporaries stay in cache: translucent stops
+    # blend through several float copies of the block
+    block = max(1, (1 << 16 if opaque else 1 << 14) // max(1, w))
+
+    def paint(a, b):
+        if kind == "linear":
+            t = xs + ys[a:b]
+        else:
+            t = np.hypot(xs, ys[a:b])
+        np.clip(t, 0.0, 1.0, out=t)
+        t *= GRADIENT_STEPS - 1
+        t += 0.5
+        index = t.astype(np.intp)
+        if opaque:
+            put(a, b, np.take(lut, index, axis=0))
+            return
+        dest = pixels[a:b].astype(np.float32)
+        under = np.take(left, index, axis=0)
+        if alpha is not None and not (pixels[a:b, :, alpha] == top).all():
+            # Source-over with non-premultiplied alpha: the pixel shows through
+            # in proportion to its own alpha. Over opaque pixels that comes to
+            # the plain blend below, alpha included
+            cover = 1.0 - under[..., alpha]
+            under *= np.repeat(dest[..., alpha:alpha + 1] * (1.0 / top), channels, axis=2)
+            total = cover + under[..., alpha]
+            np.maximum(total, 1e-6, out=total)
+            dest *= under
+            dest += np.take(weighted, index, axis=0)
+            dest /= np.repeat(total[..., None], channels, axis=2)
+            dest[..., alpha] = total * top
+        else:
+            dest *= under
+            dest += np.take(weighted, index, axis=0)
+        dest += 0.5
+        out = dest.astype(view.dtype)
+        put(a, b, out if words is pixels else _pixel_words(out))
+
+    def put(a, b, values):
+        # Store rows a:b, as whole 32-bit pixels where they are; a mask is
+        # spread over the channels first, as broadcasting it is slow
+        target = pixels[a:b] if words is pixels else words[a:b]
+        if mask is None:
+            target[...] = values
+        elif target.ndim == 3:
+            np.copyto(target, values, where=np.repeat(mask[a:b, :, None], channels, axis=2))
+        else:
+            np.copyto(target, values, where=mask[a:b])
+
+    def job(a, b):
+        for y in range(a, b, block):
+            paint(y, min(b, y + block))
+    _checked_stripes(job, h, check)
+
+
+def _fold(x, op):
+    # op.reduce over axis 1 of a (n, m, c) array by halving m: each step is a
+    # plain elementwise op, where numpy's own strided reduction over a middle
+    # axis with a few channels is some 50x slower
+    while x.shape[1] > 1:
+        half = x.shape[1] // 2
+        folded = op(x[:, :half], x[:, half:2 * half])
+        if x.shape[1] % 2:
+            folded[:, 0] = op(folded[:, 0], x[:, -1])
+        x = folded
+    return x[:, 0]
+
+
+def _edge_line(arr, axis, from_end, is_content):
+    # Index along `axis` of the first line (row or column) holding content,
+    # scanning in from one edge in bands that double in size, so wide
+    # margins are read once and the content beyond them not at all
+    n = arr.shape[axis]
+    pos, step = 0, 16
+    while pos < n:
+        count = min(step, n - pos)
+        first = n - pos - count if from_end else pos
+        band = arr[first:first + count] if axis == 0 else arr[:, first:first + count]
+        if axis == 0:
+            lo, hi = _fold(band, np.minimum), _fold(band, np.maximum)
+        else:
+            lo, hi = band.min(axis=0), band.max(axis=0)
+        hits = np.flatnonzero(is_content(lo, hi))
+        if hits.size:
+            return first + int(hits[-1] if from_end else hits[0])
+        pos += count
+        step = min(step * 2, 1024)
+    return None
+
+
+def corner_color(view):
+    """ Channel values of the color most of the four corner pixels share (top-left on a tie) """
+    h, w = view.shape[:2]
+    corners = [view[0, 0], view[0, w - 1], view[h - 1, 0], view[h - 1, w - 1]]
+    counts = [sum(np.array_equal(c, other) for other in corners) for c in corners]
+    return tuple(np.atleast_1d(corners[int(np.argmax(counts))]).tolist())
+
+
+def content_bbox(view, background, tolerance=0):
+    """ (x, y, w, h) bounding box of the pixels that differ from `background`.
+
+    A pixel is background when every channel is within `tolerance` of the
+    channel values in `background` (buffer layout, see pixel_value()).
+    Returns None when the whole buffer is background.
+    """
+    arr = view if view.ndim == 3 else view[..., None]
+    background = np.asarray(background, np.int64).reshape(-1)
+    low, high = background - tolerance, background + tolerance
+
+    def is_content(lo, hi):
+        # Min and max of each line per channel: all inside the band means background
+        return ((lo < low) | (hi > high)).any(axis=-1)
+
+    # Opposite edges are scanned in parallel; the column scans only need the
+    # rows between the top and bottom edges
+    pool = thread_pool()
+    bottom = pool.submit(_edge_line, arr, 0, True, is_content)
+    top = _edge_line(arr, 0, False, is_content)
+    bottom = bottom.result()
+    if top is None:
+        return None
+    rows = arr[top:bottom + 1]
+    right = pool.submit(_edge_line, rows, 1, True, is_content)
+    left = _edge_line(rows, 1, False, is_content)
+    right = right.result()
+    return left, top, right - left + 1, bottom - top + 1
+
+
+def trim(image, background=None, tolerance=0):
+    """ (trimmed copy of `image` or None if there is no border, bounding box or None) """
+    view = qimage_view(image, readonly=True)
+    if background is None:
+        value = corner_color(view)
+    else:
+        value = pixel_value(background.getRgb(), image.format())
+    box = content_bbox(view, value, tolerance * (257 if view.dtype.itemsize == 2 else 1))
+    if box is None or box == (0, 0, image.width(), image.height()):
+        return None, box
+    return image.copy(QRect(*box)), box
+
+
+def _monotone_cubic(points, x):
+    # Fritsch-Carlson monotone cubic through (x, y) control points, so a
+    # curve never overshoots between points; flat beyond the end points
+    xs, ys = (np.asarray(v, np.float64) for v in zip(*sorted(points)))
+    if xs.size < 2:
+        return np.full_like(x, ys[0] if ys.size else 0.0)
+    h = np.diff(xs)
+    h[h == 0] = 1e-9
+    d = np.diff(ys) / h
+    m = np.empty_like(xs)
+    m[0], m[-1] = d[0], d[-1]
+    m[1:-1] = np.where(d[:-1] * d[1:] > 0, (d[:-1] + d[1:]) / 2, 0.0)
+    for k in range(d.size):
+        if d[k] == 0:
+            m[k] = m[k + 1] = 0.0
+            continue
+        a, b = m[k] / d[k], m[k + 1] / d[k]
+        s = a * a + b * b
+        if s > 9:
+            t = 3 / np.sqrt(s)
+            m[k], m[k + 1] = t * a * d[k], t * b * d[k]
+    xc = np.clip(x, xs[0], xs[-1])
+    k = np.clip(np.searchsorted(xs, xc, side="right") - 1, 0, xs.size - 2)
+    t = (xc - xs[k]) / h[k]
+    t2, t3 = t * t, t * t * t
+    return ((2 * t3 - 3 * t2 + 1) * ys[k] + (t3 - 2 * t2 + t) * h[k] * m[k]
+            + (-2 * t3 + 3 * t2) * ys[k + 1] + (t3 - t2) * h[k] * m[k + 1])
+
+
+def tone_lut(depth, black=0.0, white=1.0, gamma=1.0, brightness=0.0, contrast=0.0, curve=None):
+    """ Lookup table of 2**depth entries (depth 8 or 16) for a tonal adjustment.
+
+    Applied in order: input levels `black`..`white` (fractions of full
+    scale) stretched to the full range, `gamma` (above 1 brightens the
+    midtones), the `curve` through [(x, y)] control points in 0..1, then
+    `brightness` and `contrast` in -1..1.
+    """
+    n = 1 << depth
+    x = np.linspace(0.0, 1.0, n)
+    x = np.clip((x - black) / max(white - black, 1e-6), 0.0, 1.0)
+    if gamma != 1.0:
+        x = x ** (1.0 / gamma)
+    if curve:
+        x = _monotone_cubic(curve, x)
+    if contrast or brightness:
+        contrast = min(max(contrast, -1.0), 0.99)
+        x = (x - 0.5) * ((1 + contrast) / (1 - contrast)) + 0.5 + brightness
+    return np.rint(np.clip(x, 0.0, 1.0) * (n - 1)).astype(np.uint8 if depth == 8 else np.uint16)
+
+
+def _pair_luts(lut, channels):
+    # 65536-entry tables mapping two 8-bit channels (one uint16) at once, for
+    # the low and the high byte pair of a 4-channel pixel; channels outside
+    # `channels` map to themselves
+    v = np.arange(65536, dtype=np.uint32)
+    low, high = v & 0xFF, v >> 8
+    tables = []
+    for first in (0, 2):
+        lo = lut[low] if first in channels else low
+        hi = lut[high] if first + 1 in channels else high
+        tables.append((lo | (hi.astype(np.uint32) << 8)).astype(np.uint16))
+    return tables
+
+
+def apply_lut(view, lut, channels=None, out=None, check=None):
+    """ Map the channels of a (h, w[, c]) buffer through `lut`, in parallel stripes.
+
+    `channels` lists the channel indices to map (default all); the others
+    are copied unchanged. Writes into `out` (a buffer of the same shape),
+    or in place when `out` is None. `check(fraction)` may raise to abort.
+    """
+    out = view if out is None else out
+    if view.ndim == 2:
+        def job(a, b):
+            out[a:b] = lut[view[a:b]]
+    else:
+        channels = range(view.shape[2]) if channels is None else channels
+        if (view.dtype == np.uint8 and view.shape[2] == 4 and view.strides[1] == 4
+                and out.strides[1] == 4):
+            # Look up two channels per index: half the gathers of one per channel
+            tables = _pair_luts(lut, set(channels))
+            src, dst = view.view(np.uint16), out.view(np.uint16)
+
+            def job(a, b):
+                for i, table in enumerate(tables):
+                    dst[a:b, :, i] = table[src[a:b, :, i]]
+        else:
+            def job(a, b):
+                if out is not view:
+                    out[a:b] = view[a:b]
+                for c in channels:
+                    out[a:b, :, c] = lut[view[a:b, :, c]]
+    _checked_stripes(job, view.shape[0], check)
+    return out
+
+
+_FILTER_TILE = 256
+_BAND_ROWS = 32
+
+
+def filter_tiles(view, func, halo, rect=None, check=None, tile=_FILTER_TILE):
+    """ Run func over `rect` (x, y, w, h; default all) of a (h, w[, c]) buffer tile by tile.
+
+    func gets each tile with `halo` pixels of context on every side (edge
+    pixels repeated past the image border) and returns the tile's result
+    without them; float results are rounded and clipped to the pixel range.
+    The tiles run on the thread pool. Returns the filtered rect as a new
+    array. `check(fraction)` is called as tiles finish and may raise to abort.
+    """
+    height, width = view.shape[:2]
+    x0, y0, w, h = rect or (0, 0, width, height)
+    out = np.empty((h, w) + view.shape[2:], view.dtype)
+    limit = np.iinfo(view.dtype).max
+
+    def job(tx, ty, tx1, ty1):
+        top, bottom = max(0, ty - halo), min(height, ty1 + halo)
+        left, right = max(0, tx - halo), min(width, tx1 + halo)
+        block = view[top:bottom, left:right]
+        pad = ((top - (ty - halo), ty1 + halo - bottom), (left - (tx - halo), tx1 + halo - right))
+        if any(pad[0]) or any(pad[1]):
+            block = np.pad(block, pad + ((0, 0),) * (view.ndim - 2), mode='edge')
+        result = func(block)
+        if result.dtype != out.dtype:
+            result = np.clip(np.rint(result, out=result), 0, limit, out=result)
+        out[ty - y0:ty1 - y0, tx - x0:tx1 - x0] = result
+
+    tiles = [(x, y, min(x0 + w, x + tile), min(y0 + h, y + tile))
+             for y in range(y0, y0 + h, tile) for x in range(x0, x0 + w, tile)]
+    futures = [thread_pool().submit(job, *t) for t in tiles]
+    try:
+        for i, future in enumerate(futures):
+            future.result()
+            if check is not None:
+                check((i + 1) / len(futures))
+    finally:
+        for future in futures:
+            future.cancel()
+    return out
+
+
+def gaussian_kernel(sigma):
+    """ Normalized 1-D Gaussian reaching out 3 sigma """
+    radius = max(1, int(math.ceil(3 * sigma)))
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def box_kernel(radius):
+    """ Normalized 1-D moving average over 2 * radius + 1 pixels """
+    return np.full(2 * radius + 1, 1.0 / (2 * radius + 1), np.float32)
+
+
+def _band_matrix(kernel, rows=_BAND_ROWS):
+    # rows x (rows + taps - 1) matrix holding `kernel` shifted one column per
+    # row: one matmul with it convolves `rows` outputs at once
+    taps = len(kernel)
+    band = np.zeros((rows, rows + taps - 1), np.float32)
+    for i in range(rows):
+        band[i, i:i + taps] = kernel
+    return band
+
+
+def _convolve_rows(x, band, taps):
+    # Valid-mode convolution of a float32 (n, ...) block along its first axis
+    flat = x.reshape(x.shape[0], -1)
+    n = x.shape[0] - taps + 1
+    out = np.empty((n, flat.shape[1]), np.float32)
+    rows = band.shape[0]
+    for y in range(0, n, rows):
+        m = min(rows, n - y)
+        np.matmul(band[:m, :m + taps - 1], flat[y:y + m + taps - 1], out=out[y:y + m])
+    return out.reshape((n,) + x.shape[1:])
+
+
+def _transposed(x):
+    # Contiguous (w, h, c) copy of a (h, w, c) array, moving whole pixels
+    # (viewed as one opaque item each) instead of channel by channel
+    x = np.ascontiguousarray(x)
+    pixel = x.view(np.dtype((np.void, x.shape[2] * x.itemsize)))[..., 0]
+    return np.ascontiguousarray(pixel.T).view(x.dtype).reshape(x.shape[1], x.shape[0], x.shape[2])
+
+
+def _convolve_block(block, band, taps):
+    # Separable valid-mode convolution of a (h, w, c) block into float32.
+    # The columns pass runs first on a transposed copy, so both passes are
+    # the same matmul and the result comes out in the block's layout
+    cols = _convolve_rows(_transposed(block).astype(np.float32), band, taps)
+    return _convolve_rows(_transposed(cols), band, taps)
+
+
+def _premultiply(block, alpha_channel, limit):
+    # (h, w, c) float32 copy with color premultiplied by alpha, so transparent
+    # pixels don't bleed their color into their neighbors; tiles that are
+    # opaque throughout (or have no alpha) are returned as they are
+    block = block.reshape(block.shape[:2] + (-1,))
+    if alpha_channel is None or block[..., alpha_channel].min() == limit:
+        return block, False
+    x = block.astype(np.float32)
+    alpha = x[..., alpha_channel:alpha_channel + 1].copy()
+    x *= alpha * (1.0 / limit)
+    x[..., alpha_channel:alpha_channel + 1] = alpha
+    return x, True
+
+
+def _unpremultiply(x, alpha_channel, limit):
+    alpha = x[..., alpha_channel:alpha_channel + 1].copy()
+    scale = np.zeros_like(alpha)
+    np.divide(limit, alpha, out=scale, where=alpha > 0.5)
+    x *= scale
+    x[..., alpha_channel:alpha_channel + 1] = alpha
+    return x
+
+
+def convolve(view, kernel, rect=None, alpha_channel=None, check=None):
+    """ Filter `rect` of a (h, w[, c]) buffer with the 1-D `kernel` along both axes.
+
+    Tiles run as banded matrix products (see filter_tiles); with
+    `alpha_channel` the color is filtered premultiplied by alpha.
+    Returns the filtered rect.
+    """
+    taps = len(kernel)
+    band = _band_matrix(kernel)
+    limit = float(np.iinfo(view.dtype).max)
+
+    def func(block):
+        x, premultiplied = _premultiply(block, alpha_channel, limit)
+        x = _convolve_block(x, band, taps)
+        if premultiplied:
+            _unpremultiply(x, alpha_channel, limit)
+        return x.reshape(x.shape[:2] + block.shape[2:])
+    return filter_tiles(view, func, taps // 2, rect, check)
+
+
+def gaussian_blur(view, sigma, rect=None, alpha_channel=None, check=None):
+    return convolve(view, gaussian_kernel(sigma), rect, alpha_channel, check)
+
+
+def box_blur(view, radius, rect=None, alpha_channel=None, check=None):
+    return convolve(view, box_kernel(radius), rect, alpha_channel, check)
+
+
+def unsharp_mask(view, sigma, amount, threshold=0, rect=None, alpha_channel=None, check=None):
+    """ Sharpen `rect` by adding back `amount` times the difference from a Gaussian blur.
+
+    Differences of at most `threshold` (in pixel values) are left alone so
+    flat, noisy areas don't get sharpened; alpha is kept as it is.
+    """
+    kernel = gaussian_kernel(sigma)
+    taps = len(kernel)
+    halo = taps // 2
+    band = _band_matrix(kernel)
+    limit = float(np.iinfo(view.dtype).max)
+
+    def func(block):
+        x, premultiplied = _premultiply(block, alpha_channel, limit)
+        center = x[halo:x.shape[0] - halo, halo:x.shape[1] - halo]
+        detail = _convolve_block(x, band, taps)
+        np.subtract(center, detail, out=detail)
+        if threshold:
+            detail[np.abs(detail) <= threshold] = 0
+        detail *= amount
+        result = np.add(center, detail, out=detail)
+        if alpha_channel is not None:
+            result[..., alpha_channel] = center[..., alpha_channel]
+        if premultiplied:
+            _unpremultiply(result, alpha_channel, limit)
+        return result.reshape(result.shape[:2] + block.shape[2:])
+    return filter_tiles(view, func, halo, rect, check)
+
+
+def _batcher_pairs(n):
+    # Comparators of Batcher's odd-even merge sort for n inputs; the network
+    # for the next power of two, minus comparators that touch the padding
+    size = 1
+    while size < n:
+        size *= 2
+    pairs = []
+
+    def merge(lo, length, r):
+        step = r * 2
+        if step < length:
+            merge(lo, length, step)
+            merge(lo + r, length, step)
+            pairs.extend((i, i + r) for i in range(lo + r, lo + length - r, step))
+        else:
+            pairs.append((lo, lo + r))
+
+    def sort(lo, length):
+        if length > 1:
+            half = length // 2
+            sort(lo, half)
+            sort(lo + half, half)
+            merge(lo, length, 1)
+    sort(0, size)
+    return [(i, j) for i, j in pairs if j < n]
+
+
+@functools.lru_cache(maxsize=None)
+def _median_network(n):
+    # The comparators of the sorting network that the middle output depends
+    # on, each with whether its min and its max are still needed
+    needed = {n // 2}
+    steps = []
+    for i, j in reversed(_batcher_pairs(n)):
+        keep_min, keep_max = i in needed, j in needed
+        if keep_min or keep_max:
+            steps.append((i, j, keep_min, keep_max))
+            needed |= {i, j}
+    return steps[::-1]
+
+
+def median_filter(view, radius, rect=None, check=None):
+    """ Replace each channel of `rect` by its median over a (2 * radius + 1)² window.
+
+    The median comes out of a sorting network of element-wise min/max over
+    shifted views of each tile, pruned to the comparators the middle value
+    needs: exact, and far faster than sorting every window.
+    """
+    size = 2 * radius + 1
+    steps = _median_network(size * size)
+
+    def func(block):
+        h, w = block.shape[0] - 2 * radius, block.shape[1] - 2 * radius
+        values = [block[i:i + h, j:j + w] for i in range(size) for j in range(size)]
+        for i, j, keep_min, keep_max in steps:
+            a, b = values[i], values[j]
+            if keep_min:
+                values[i] = np.minimum(a, b)
+            if keep_max:
+                values[j] = np.maximum(a, b)
+        return values[len(values) // 2]
+    return filter_tiles(view, func, radius, rect, check)
+
+
+def named_filter(view, kind, radius, amount=1.0, threshold=0, rect=None, alpha_channel=None, check=None):
+    """ Filtered pixels of `rect` by filter name: "gaussian", "box", "unsharp" or "median" """
+    if kind == "gaussian":
+        return gaussian_blur(view, radius, rect, alpha_channel, check)
+    if kind == "box":
+        return box_blur(view, int(radius), rect, alpha_channel, check)
+    if kind == "unsharp":
+        return unsharp_mask(view, radius, amount, threshold, rect, alpha_channel, check)
+    if kind == "median":
+        return median_filter(view, int(radius), rect, check)
+    raise ValueError(f"Unknown filter: {kind}")
+
+
+def foreground_mask(view, background, tolerance=0, check=None):
+    """ Boolean (h, w) mask of the pixels with a channel more than `tolerance` from `background` """
+    arr = view if view.ndim == 3 else view[..., None]
+    limit = int(np.iinfo(arr.dtype).max)
+    background = np.asarray(background, np.int64).reshape(-1)
+    low = np.clip(background - tolerance, 0, limit)
+    high = np.clip(background + tolerance, 0, limit)
+    mask = np.empty(arr.shape[:2], bool)
+    if arr.dtype == np.uint8 and arr.shape[2] == 4 and arr.strides[1] == 4:
+        # Two channels per lookup in 65536-entry tables (as in apply_lut)
+        v = np.arange(65536)
+        tables = []
+        for c in (0, 2):
+            first, second = v & 0xFF, v >> 8
+            tables.append((first < low[c]) | (first > high[c]) | (second < low[c + 1]) | (second > high[c + 1]))
+        pairs = arr.view(np.uint16)
+
+        def job(a, b):
+            out = mask[a:b]
+            np.take(tables[0], pairs[a:b, :, 0], out=out)
+            out |= np.take(tables[1], pairs[a:b, :, 1])
+    else:
+        # Inside [low, high] exactly when x - low, wrapping around, is at most
+        # high - low: one subtraction and one compare per channel
+        low, width = low.astype(arr.dtype), (high - low).astype(arr.dtype)
+
+        def job(a, b):
+            mask[a:b] = ((arr[a:b] - low) > width).any(axis=2)
+    _checked_stripes(job, arr.shape[0], check)
+    return mask
+
+
+def _mask_runs(mask):
+    # (rows, starts, stops) of the horizontal runs of True in a (h, w) mask,
+    # in row-major order; stops are exclusive
+    h, w = mask.shape
+    parts = {}
+
+    def job(a, b):
+        padded = np.zeros((b - a, w + 2), np.int8)
+        padded[:, 1:-1] = mask[a:b]
+        edges = np.diff(padded, axis=1)
+        rows, starts = np.nonzero(edges == 1)
+        stops = np.nonzero(edges == -1)[1]
+        parts[a] = (rows + a, starts, stops)
+    parallel_stripes(job, h)
+    runs = [parts[a] for a in sorted(parts)]
+    return tuple(np.concatenate([r[i] for r in runs]) if runs else np.zeros(0, np.intp) for i in range(3))
+
+
+def _union_roots(n, a, b):
+    # Root (smallest node) of the component of each of n nodes joined by the
+    # edges a[i]-b[i]. Vectorized union-find: every root hooks onto the
+    # smaller root across one of its edges, chains are then flattened by
+    # pointer jumping, and edges inside one component drop out, until none
+    # are left
+    parent = np.arange(n)
+    while a.size:
+        pa, pb = parent[a], parent[b]
+        spans = pa != pb
+        a, b, pa, pb = a[spans], b[spans], pa[spans], pb[spans]
+        if not a.size:
+            break
+        parent[np.maximum(pa, pb)] = np.minimum(pa, pb)
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+    return parent
+
+
+def label_components(mask, connectivity=8):
+    """ Connected components of the True pixels of a (h, w) mask, as horizontal runs.
+
+    Returns (rows, starts, stops, labels) with one entry per run; `labels`
+    numbers the components 0..n-1. Runs of adjacent rows that touch (with
+    `connectivity` 4 or 8) are found with binary searches, so the whole
+    labelling is a few vectorized passes however many components there are.
+    """
+    rows, starts, stops = _mask_runs(mask)
+    n = rows.size
+    if not n:
+        return rows, starts, stops, np.zeros(0, np.intp)
+    # Keys that order the runs row by row, with a gap between rows
+    pitch = mask.shape[1] + 2
+    start_keys = rows.astype(np.int64) * pitch + starts
+    stop_keys = rows.astype(np.int64) * pitch + stops
+    reach = 1 if connectivity == 8 else 0
+    # The runs of the row above that touch a run form one contiguous range
+    above = (rows.astype(np.int64) - 1) * pitch
+    first = np.searchsorted(stop_keys, above + starts - reach, side='right')
+    last = np.searchsorted(start_keys, above + stops + reach, side='left')
+    counts = np.maximum(last - first, 0)
+    total = int(counts.sum())
+    lower = np.repeat(np.arange(n), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    upper = np.repeat(first, counts) + offsets
+    roots = _union_roots(n, upper, lower)
+    _, labels = np.unique(roots, return_inverse=True)
+    return rows, starts, stops, labels
+
+
+def despeckle(view, background, max_size, tolerance=0, connectivity=8, check=None):
+    """ Fill every blob of non-background pixels smaller than `max_size` with `background`, in place.
+
+    Blobs are the connected components of the pixels with a channel more
+    than `tolerance` from `background` (buffer layout, see pixel_value()).
+    Returns (blobs removed, pixels changed).
+    """
+    mask = foreground_mask(view, background, tolerance,
+                           None if check is None else lambda f: check(0.4 * f))
+    rows, starts, stops, labels = label_components(mask, connectivity)
+    del mask
+    if check is not None:
+        check(0.8)
+    lengths = stops - starts
+    sizes = np.bincount(labels, weights=lengths)
+    small = sizes[labels] < max_size
+    rows, starts, lengths = rows[small], starts[small], lengths[small]
+    pixels = int(lengths.sum())
+    # One (row, column) pair per pixel of the small blobs
+    ys = np.repeat(rows, lengths)
+    xs = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(pixels)
+    view[ys, xs] = np.asarray(background, view.dtype).reshape(view.shape[2:])
+    return int(np.count_nonzero(sizes < max_size)), pixels
+
+
+DIFF_TILE = 256
+
+
+def tile_hashes(view, tile=DIFF_TILE, tiles=None, out=None, check=None):
+    """ CRC-32 of every tile x tile block of a (h, w[, c]) buffer, as a (rows, columns) uint32 array.
+
+    With `tiles` (an iterable of (tx, ty)) only those blocks are hashed
+    again, into `out`. The blocks are hashed on the thread pool.
+    """
+    h, w = view.shape[:2]
+    if out is None:
+        out = np.zeros((-(-h // tile), -(-w // tile)), np.uint32)
+        tiles = None
+    if tiles is None:
+        rows = {ty: range(out.shape[1]) for ty in range(out.shape[0])}
+    else:
+        rows = {}
+        for tx, ty in tiles:
+            rows.setdefault(ty, []).append(tx)
+
+    def job(ty):
+        band = view[ty * tile:(ty + 1) * tile]
+        for tx in rows[ty]:
+            out[ty, tx] = zlib.crc32(np.ascontiguousarray(band[:, tx * tile:(tx + 1) * tile]))
+    futures = [thread_pool().submit(job, ty) for ty in rows]
+    try:
+        for i, future in enumerate(futures):
+            future.result()
+            if check is not None:
+                check((i + 1) / len(futures))
+    finally:
+        for future in futures:
+            future.cancel()
+    return out
+
+
+def _component_boxes(mask):
+    # Bounding boxes (x, y, w, h) of the 8-connected components of a mask
+    rows, starts, stops, labels = label_components(mask)
+    if not labels.size:
+        return []
+    order = np.argsort(labels, kind='stable')
+    firsts = np.flatnonzero(np.diff(labels[order], prepend=-1))
+    x0 = np.minimum.reduceat(starts[order], firsts)
+    x1 = np.maximum.reduceat(stops[order], firsts)
+    y0 = np.minimum.reduceat(rows[order], firsts)
+    y1 = np.maximum.reduceat(rows[order], firsts) + 1
+    return [(int(a), int(b), int(c - a), int(d - b)) for a, b, c, d in zip(x0, y0, x1, y1)]
+
+
+class ImageDiff:
+    """ Where two buffers of the same shape differ, tile by tile.
+
+    `tiles` maps (tx, ty) to the (h, w) uint8 difference of each tile that
+    changed: the largest channel difference scaled to 0-255, and at least 1
+    wherever anything differs. `boxes` are the bounding boxes (x, y, w, h)
+    of the connected changed regions, largest first, and `pixels` counts
+    the changed pixels.
+    """
+
+    def __init__(self, width, height, tile, tiles, boxes, pixels):
+        self.width, self.height = width, height
+        self.tile = tile
+        self.tiles = tiles
+        self.boxes = boxes
+        self.pixels = pixels
+
+    @classmethod
+    def compare(cls, a, b, hashes_a=None, hashes_b=None, tile=DIFF_TILE, check=None):
+        """ Difference of buffers `a` and `b`, skipping the tiles whose hashes
+        (from tile_hashes(), computed here if not given) match """
+        if a.shape != b.shape or a.dtype != b.dtype:
+            raise ValueError("the images differ in size or format")
+        h, w = a.shape[:2]
+        steps = [f for f in (hashes_a, hashes_b) if f is None]
+        done = 0.0
+
+        def part(span):
+            # check() for the next `span` of the work
+            nonlocal done
+            start = done
+            done += span
+            return None if check is None else lambda f: check(start + span * f)
+        if hashes_a is None:
+            hashes_a = tile_hashes(a, tile, check=part(0.7 / len(steps)))
+        if hashes_b is None:
+            hashes_b = tile_hashes(b, tile, check=part(0.7 / len(steps)))
+        shift = 8 if a.dtype.itemsize == 2 else 0
+
+        def job(ty, tx):
+            y, x = ty * tile, tx * tile
+            ta, tb = a[y:y + tile, x:x + tile], b[y:y + tile, x:x + tile]
+            # Unsigned |a - b| without widening
+            d = np.maximum(ta, tb) - np.minimum(ta, tb)
+            if d.ndim == 3:
+                d = d.max(axis=2)
+            if not d.any():
+                return None  # only row padding differed
+            if shift:
+                return np.where(d > 0, np.maximum(d >> shift, 1), 0).astype(np.uint8)
+            return d
+        candidates = [tuple(t) for t in np.argwhere(hashes_a != hashes_b)]
+        futures = [thread_pool().submit(job, ty, tx) for ty, tx in candidates]
+        tiles = {}
+        check_diff = part(1.0 - done - 0.1)
+        try:
+            for i, ((ty, tx), future) in enumerate(zip(candidates, futures)):
+                d = future.result()
+                if d is not None:
+                    tiles[tx, ty] = d
+                if check_diff is not None:
+                    check_diff((i + 1) / len(futures))
+        finally:
+            for future in futures:
+                future.cancel()
+        # Regions can only join across neighboring changed tiles, so each
+        # cluster of them is labelled on its own
+        grid = np.zeros(hashes_a.shape, bool)
+        for tx, ty in tiles:
+            grid[ty, tx] = True
+        boxes = []
+        for gx, gy, gw, gh in _component_boxes(grid):
+            x0, y0 = gx * tile, gy * tile
+            mask = np.zeros((min(h, (gy + gh) * tile) - y0, min(w, (gx + gw) * tile) - x0), bool)
+            for ty in range(gy, gy + gh):
+                for tx in range(gx, gx + gw):
+                    d = tiles.get((tx, ty))
+                    if d is not None:
+                        mask[ty * tile - y0:ty * tile - y0 + d.shape[0],
+                             tx * tile - x0:tx * tile - x0 + d.shape[1]] = d > 0
+            boxes.extend((x + x0, y + y0, bw, bh) for x, y, bw, bh in _component_boxes(mask))
+        boxes.sort(key=lambda box: -box[2] * box[3])
+        pixels = sum(int(np.count_nonzero(d)) for d in tiles.values())
+        if check is not None:
+            check(1.0)
+        return cls(w, h, tile, tiles, boxes, pixels)
+
+
+def diff_heatmap(d):
+    """ (h, w, 4) uint8 B, G, R, A overlay of a difference tile: clear where
+    nothing changed, then yellow to red and more opaque as the difference grows """
+    return _HEAT_LUT[d]
+
+
+def _heat_lut():
+    v = np.arange(256) / 255.0
+    lut = np.zeros((256, 4), np.uint8)
+    lut[:, 1] = np.rint(220 * (1 - v))
+    lut[:, 2] = 255
+    lut[:, 3] = np.rint(150 + 105 * v)
+    lut[0] = 0
+    return lut
+
+
+_HEAT_LUT = _heat_lut()
+
+
+class PackedImage:
+    """ The pixels of a QImage kept zlib-compressed in row bands, for undo history.
+
+    pack_steps() compresses one band of about `band_bytes` per step, so the
+    work can be spread over idle time, and gives up (returning None) once
+    the bands so far haven't shrunk to `worth` of their size; unpack()
+    decompresses the bands in parallel into a new QImage.
+    """
+
+    def __init__(self, width, height, fmt, bands=None):
+        self.width, self.height = width, height
+        self.format = fmt
+        self.bands = bands if bands is not None else []  # (rows, compressed bytes)
+
+    @classmethod
+    def pack_steps(cls, image, band_bytes=1 << 20, worth=0.7):
+        packed = cls(image.width(), image.height(), image.format())
+        view = qimage_view(image, readonly=True)
+        rows = max(1, band_bytes // image.bytesPerLine())
+        raw = 0
+        for y in range(0, packed.height, rows):
+            band = np.ascontiguousarray(view[y:y + rows])
+            packed.bands.append((band.shape[0], zlib.compress(band, 1)))
+            raw += band.nbytes
+            if len(packed.bands) >= 4 and packed.nbytes > worth * raw:
+                return None
+            yield
+        return packed
+
+    @classmethod
+    def pack(cls, image, band_bytes=1 << 20):
+        """ Compress all the bands at once on the pool, however well they shrink """
+        view = qimage_view(image, readonly=True)
+        rows = max(1, band_bytes // image.bytesPerLine())
+
+        def job(y):
+            band = np.ascontiguousarray(view[y:y + rows])
+            return band.shape[0], zlib.compress(band, 1)
+        futures = [thread_pool().submit(job, y) for y in range(0, image.height(), rows)]
+        return cls(image.width(), image.height(), image.format(), [future.result() for future in futures])
+
+    @property
+    def nbytes(self):
+        return sum(len(data) for _, data in self.bands)
+
+    def sample(self, step):
+        """ Every `step`-th row and column as an array, decompressing one band at a time """
+        template = qimage_view(QImage(self.width, 1, self.format), readonly=True)
+        parts = []
+        y = 0
+        for rows, data in self.bands:
+            first = -y % step
+            if first < rows:
+                band = np.frombuffer(zlib.decompress(data), template.dtype).reshape((rows,) + template.shape[1:])
+                parts.append(band[first::step, ::step])
+            y += rows
+        return np.concatenate(parts)
+
+    def unpack(self):
+        image = QImage(self.width, self.height, self.format)
+        view = qimage_view(image)
+        starts = np.cumsum([0] + [rows for rows, _ in self.bands])
+
+        def job(i):
+            rows, data = self.bands[i]
+            y = starts[i]
+            view[y:y + rows] = np.frombuffer(zlib.decompress(data), view.dtype).reshape((rows,) + view.shape[1:])
+        for future in [thread_pool().submit(job, i) for i in range(len(self.bands))]:
+            future.result()
+        return image
@@ -0,0 +1,499 @@
+"""
+Input traces: record the mouse, wheel and key events of a Tabula Rasa
+session to a file, and replay them headlessly to measure responsiveness.
+
+    python input_trace.py session.trace [--speed max|original|FACTOR] [--json FILE]
+
+A trace is JSON lines: a header with the window, document and tool state
+at the start, one line per event, "state" lines when the tool or brush
+changes, "tab" lines when another document tab becomes current, and an
+"end" line with the checksum of the final document.
+Replay reports per-event handling latency, paint counts, frame times,
+background job times and whether the final document matches.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PyQt6.QtCore import QEvent, QObject, QPoint, QPointF, Qt
+from PyQt6.QtGui import QColor, QCursor, QKeyEvent, QMouseEvent, QWheelEvent
+from PyQt6.QtWidgets import QApplication
+
+from image_ops import qimage_view
+
+TRACE_VERSION = 1
+
+_MOUSE_TYPES = {
+    QEvent.Type.MouseButtonPress: "press",
+    QEvent.Type.MouseButtonDblClick: "dblclick",
+    QEvent.Type.MouseMove: "move",
+    QEvent.Type.MouseButtonRelease: "release",
+}
+_MOUSE_EVENTS = {name: kind for kind, name in _MOUSE_TYPES.items()}
+
+# Rows hashed at a time, so checksumming a large document stays in bounded memory
+_CHECKSUM_ROWS = 256
+
+
+def document_checksum(canvas):
+    """ SHA-256 of the document size and pixels, including unloaded tiles """
+    size = canvas.doc_size()
+    width, height = size.width(), size.height()
+    digest = hashlib.sha256(f"{width}x{height}".encode())
+    view = None if canvas.source is not None else qimage_view(canvas.image, readonly=True)
+    for y in range(0, height, _CHECKSUM_ROWS):
+        rows = min(_CHECKSUM_ROWS, height - y)
+        if view is None:
+            block = canvas.read_document_region(0, y, width, rows)
+        else:
+            block = view[y:y + rows]
+        digest.update(np.ascontiguousarray(block).data)
+    return digest.hexdigest()
+
+
+def _scroll_area(window):
+    return window.tabs.currentWidget().scroll
+
+
+def _document_state(window):
+    # What replay needs to put the current tab's document back as it was
+    canvas = window.canvas
+    scroll = _scroll_area(window)
+    size = canvas.doc_size()
+    return {
+        "index": window.tabs.currentIndex(),
+        "file": canvas.file_path,
+        "image": [size.width(), size.height()],
+        "zoom": canvas.zoom_factor,
+        "scroll": [scroll.horizontalScrollBar().value(), scroll.verticalScrollBar().value()],
+        "checksum": document_checksum(canvas),
+    }
+
+
+def _tool_state(canvas):
+    return {
+        "tool": canvas.current_tool,
+        "size": canvas.brush_size,
+        "color": canvas.brush_color.name(QColor.NameFormat.HexArgb),
+        "hardness": canvas.brush_hardness,
+        "opacity": canvas.brush_opacity,
+        "flow": canvas.brush_flow,
+    }
+
+
+class InputRecorder(QObject):
+    """ Record the input a PaintBrushApp window receives to a trace file.
+
+    Mouse and wheel events are taken from the current tab's canvas, with
+    positions relative to its scroll area viewport so replay moves the
+    pointer the same way even where the canvas scrolls under it. Keys are
+    taken as the application sees them, before shortcuts, so Ctrl+Z and
+    tool keys count. Switching tabs writes a "tab" record first.
+    """
+
+    def __init__(self, window, path):
+        super().__init__(window)
+        self.window = window
+        self.path = path
+        self.events = 0
+        self._file = None
+        self._start = 0.0
+        self._state = None
+        self._tab_canvas = None
+        self._last_key = None
+
+    @property
+    def active(self):
+        return self._file is not None
+
+    @property
+    def canvas(self):
+        return self.window.canvas
+
+    def start(self):
+        if self._file is not None:
+            return
+        viewport = _scroll_area(self.window).viewport()
+        self._file = open(self.path, "w")
+        self._start = time.perf_counter()
+        self._state = _tool_state(self.canvas)
+        self._tab_canvas = self.canvas
+        self.events = 0
+        self._write({
+            "type": "header",
+            "version": TRACE_VERSION,
+            "window": [self.window.width(), self.window.height()],
+            "viewport": [viewport.width(), viewport.height()],
+            **_document_state(self.window),
+            "state": self._state,
+        })
+        QApplication.instance().installEventFilter(self)
+
+    def stop(self):
+        """ Write the end record with the final checksum and close the trace """
+        if self._file is None:
+            return
+        QApplication.instance().removeEventFilter(self)
+        self._write({"type": "end", "t": self._now(), "events": self.events,
+                     "checksum": document_checksum(self.canvas)})
+        self._file.close()
+        self._file = None
+
+    def _now(self):
+        return round(time.perf_counter() - self._start, 6)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def _viewport_pos(self, global_pos):
+        pos = _scroll_area(self.window).viewport().mapFromGlobal(global_pos)
+        return [round(pos.x(), 2), round(pos.y(), 2)]
+
+    def _sync_tab(self):
+        # Tabs are switched from the tab bar, which is not recorded, so
+        # note which document input goes to whenever that changes
+        if self.canvas is not self._tab_canvas:
+            self._tab_canvas = self.canvas
+            self._write({"type": "tab", "t": self._now(), **_document_state(self.window)})
+
+    def _sync_state(self):
+        # Tool and brush changes come from toolbar widgets rather than canvas
+        # input, so record the state itself whenever it differs
+        state = _tool_state(self.canvas)
+        if state != self._state:
+            self._state = state
+            self._write({"type": "state", "t": self._now(), "state": state})
+
+    def eventFilter(self, obj, event):
+        kind = event.type()
+        if obj is self.canvas and kind in _MOUSE_TYPES:
+            self._sync_tab()
+            if kind != QEvent.Type.MouseMove:
+                self._sync_state()
+            self._write({"type": _MOUSE_TYPES[kind], "t": self._now(),
+                         "pos": self._viewport_pos(event.globalPosition()),
+                         "button": event.button().value, "buttons": event.buttons().value,
+                         "mod": event.modifiers().value})
+            self.events += 1
+        elif obj is self.canvas and kind == QEvent.Type.Wheel:
+            self._sync_tab()
+            self._sync_state()
+            self._write({"type": "wheel", "t": self._now(),
+                         "pos": self._viewport_pos(event.globalPosition()),
+                         "angle": [event.angleDelta().x(), event.angleDelta().y()],
+                         "pixel": [event.pixelDelta().x(), event.pixelDelta().y()],
+                         "buttons": event.buttons().value, "mod": event.modifiers().value})
+            self.events += 1
+        elif kind in (QEvent.Type.ShortcutOverride, QEvent.Type.KeyPress, QEvent.Type.KeyRelease):
+            self._record_key(obj, event)
+        return False
+
+    def _record_key(self, obj, event):
+        if not obj.isWidgetType() or obj.window() is not self.window:
+            return
+        press = event.type() != QEvent.Type.KeyRelease
+        # A key press arrives as ShortcutOverride and then, unless a shortcut
+        # took it, as KeyPress, possibly propagating to parents: keep one
+        key = (press, event.key(), event.timestamp(), event.isAutoRepeat())
+        if key == self._last_key:
+            return
+        self._last_key = key
+        self._sync_tab()
+        if press:
+            self._sync_state()
+        self._write({"type": "key" if press else "keyup", "t": self._now(),
+                     "key": event.key(), "mod": event.modifiers().value,
+                     "text": event.text(), "repeat": event.isAutoRepeat()})
+        self.events += 1
+
+
+def read_trace(path):
+    """ (header, [event records], end record or None) of a trace file """
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records or records[0].get("type") != "header":
+        raise ValueError(f"{path} is not an input trace")
+    header = records[0]
+    if header.get("version", 0) > TRACE_VERSION:
+        raise ValueError(f"{path} was written by a newer version (trace v{header['version']})")
+    end = records[-1] if records[-1].get("type") == "end" else None
+    events = records[1:-1] if end is not None else records[1:]
+    return header, events, end
+
+
+class _PaintMeter(QObject):
+    """ Count and time the canvas paints and whole-window frames during replay """
+
+    def __init__(self, window, region_rects):
+        super().__init__(window)
+        self.window = window
+        self._region_rects = region_rects
+        self.frames = []  # seconds per window repaint
+        self.paints = []  # seconds per canvas paint event
+        self.painted_pixels = 0
+
+    def eventFilter(self, obj, event):
+        # Run the handler here, from inside the filter, to time it
+        kind = event.type()
+        if obj is self.window and kind == QEvent.Type.UpdateRequest:
+            start = time.perf_counter()
+            obj.event(event)
+            self.frames.append(time.perf_counter() - start)
+            return True
+        if obj is self.window.canvas and kind == QEvent.Type.Paint:
+            self.painted_pixels += sum(r.width() * r.height() for r in self._region_rects(event.region()))
+            start = time.perf_counter()
+            obj.event(event)
+            self.paints.append(time.perf_counter() - start)
+            return True
+        return False
+
+
+def _summary(seconds):
+    if not seconds:
+        return {"count": 0}
+    ms = np.asarray(seconds) * 1000
+    return {"count": int(ms.size), "mean_ms": float(ms.mean()),
+            "p50_ms": float(np.percentile(ms, 50)), "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99)), "max_ms": float(ms.max()),
+            "total_ms": float(ms.sum())}
+
+
+def _apply_state(window, state):
+    canvas = window.canvas
+    canvas.set_brush_size(state["size"])
+    canvas.set_brush_color(QColor(state["color"]))
+    canvas.brush_hardness = state["hardness"]
+    canvas.brush_opacity = state["opacity"]
+    canvas.brush_flow = state["flow"]
+    window.set_tool(state["tool"])
+
+
+def _settle(app, canvas):
+    # Deliver posted events (paints included) and let a background job finish,
+    # so every event sees the document the recorded session saw
+    app.processEvents()
+    job_time = 0.0
+    while canvas.job is not None:
+        start = time.perf_counter()
+        canvas.job.wait(0.01)
+        app.processEvents()
+        job_time += time.perf_counter() - start
+    return job_time
+
+
+def _load_document(window, record, warnings, image=None):
+    # Open the document a header or tab record describes in the current tab
+    # and restore its view, noting where it differs from the recorded one
+    app = QApplication.instance()
+    canvas = window.canvas
+    file_name = image or record.get("file")
+    if file_name:
+        canvas.open_image(file_name, background=False)
+    app.processEvents()
+    size = canvas.doc_size()
+    if [size.width(), size.height()] != record["image"]:
+        warnings.append(f"document is {size.width()}x{size.height()}, "
+                        f"trace started on {record['image'][0]}x{record['image'][1]}")
+    elif not image and document_checksum(canvas) != record["checksum"]:
+        warnings.append("document differs from the one the trace started on")
+    canvas.zoom_factor = record["zoom"]
+    canvas.setFixedSize(canvas.sizeHint())
+    canvas.zoomChanged.emit(canvas.zoom_factor)
+    app.processEvents()
+    scroll = _scroll_area(window)
+    scroll.horizontalScrollBar().setValue(record["scroll"][0])
+    scroll.verticalScrollBar().setValue(record["scroll"][1])
+    return canvas
+
+
+def _switch_tab(window, record, warnings):
+    # Tabs that were open before recording started are opened on first use
+    tabs = window.tabs
+    if record["index"] < tabs.count():
+        tabs.setCurrentIndex(record["index"])
+        return window.canvas
+    window.new_document()
+    return _load_document(window, record, warnings)
+
+
+def replay(path, speed=None, image=None):
+    """ Replay a trace against a fresh PaintBrushApp and return the measurements.
+
+    `speed` None replays as fast as events are handled; otherwise it scales
+    the recorded timing (1.0 is the original pace). `image` overrides the
+    document the trace started from. Needs a QApplication.
+    """
+    from Tabula_rasa import PaintBrushApp, region_rects
+
+    header, events, end = read_trace(path)
+    app = QApplication.instance()
+    window = PaintBrushApp()
+    window.resize(*header["window"])
+    window.show()
+    warnings = []
+    # Whichever tab the recording started in, replay starts in the first one
+    tab_index = {header.get("index", 0): 0}
+    canvas = _load_document(window, header, warnings, image)
+    _apply_state(window, header["state"])
+    _settle(app, canvas)
+
+    meter = _PaintMeter(window, region_rects)
+    window.installEventFilter(meter)
+    canvas.installEventFilter(meter)
+    watched = [canvas]
+    latency = {}
+    job_times = []
+    start = time.perf_counter()
+    for record in events:
+        kind = record["type"]
+        if speed is not None:
+            due = start + record["t"] / speed
+            while time.perf_counter() < due:
+                app.processEvents()
+                time.sleep(min(0.001, max(0.0, due - time.perf_counter())))
+        if kind == "state":
+            _apply_state(window, record["state"])
+            continue
+        if kind == "tab":
+            index = tab_index.setdefault(record["index"], len(tab_index))
+            canvas = _switch_tab(window, dict(record, index=index), warnings)
+            if canvas not in watched:
+                canvas.installEventFilter(meter)
+                watched.append(canvas)
+            _settle(app, canvas)
+            continue
+        t0 = time.perf_counter()
+        if kind in ("key", "keyup"):
+            target = app.focusWidget() or window
+            event = QKeyEvent(QEvent.Type.KeyPress if kind == "key" else QEvent.Type.KeyRelease,
+                              record["key"], Qt.KeyboardModifier(record["mod"]), record["text"],
+                              record["repeat"])
+            # Offer it as a shortcut first, as the event loop does for real keys
+            if not _send_shortcut(app, target, event):
+                app.sendEvent(target, event)
+        else:
+            viewport = _scroll_area(window).viewport()
+            global_pos = QPointF(viewport.mapToGlobal(QPoint(0, 0))) + QPointF(*record["pos"])
+            QCursor.setPos(global_pos.toPoint())
+            local = QPointF(canvas.mapFromGlobal(global_pos))
+            modifiers = Qt.KeyboardModifier(record["mod"])
+            if kind == "wheel":
+                event = QWheelEvent(local, global_pos, QPoint(*record["pixel"]), QPoint(*record["angle"]),
+                                    Qt.MouseButton(record["buttons"]), modifiers,
+                                    Qt.ScrollPhase.NoScrollPhase, False)
+            else:
+                event = QMouseEvent(_MOUSE_EVENTS[kind], local, global_pos,
+                                    Qt.MouseButton(record["button"]), Qt.MouseButton(record["buttons"]),
+                                    modifiers)
+            app.sendEvent(canvas, event)
+        app.processEvents()
+        latency.setdefault(kind, []).append(time.perf_counter() - t0)
+        job_time = _settle(app, canvas)
+        if job_time:
+            job_times.append(job_time)
+    wall = time.perf_counter() - start
+    window.removeEventFilter(meter)
+    for watched_canvas in watched:
+        watched_canvas.removeEventFilter(meter)
+
+    checksum = document_checksum(canvas)
+    everything = [s for values in latency.values() for s in values]
+    result = {
+        "trace": os.path.basename(path),
+        "events": len(everything),
+        "wall_s": wall,
+        "speed": "max" if speed is None else speed,
+        "latency": {"all": _summary(everything),
+                    **{kind: _summary(values) for kind, values in sorted(latency.items())}},
+        "canvas_paints": _summary(meter.paints),
+        "painted_pixels": meter.painted_pixels,
+        "frames": _summary(meter.frames),
+        "jobs": _summary(job_times),
+        "checksum": checksum,
+        "expected_checksum": end["checksum"] if end else None,
+        "match": None if end is None or image else checksum == end["checksum"],
+        "warnings": warnings,
+    }
+    for document in window.canvases():
+        document.modified = False
+    window.close()
+    return result
+
+
+def _send_shortcut(app, target, event):
+    # QApplication.sendEvent skips shortcut matching, so try the
+    # window's actions for key presses the way the event loop would
+    if event.type() != QEvent.Type.KeyPress:
+        return False
+    sequence = event.keyCombination().toCombined()
+    for action in target.window().actions():
+        if action.isEnabled() and any(s[0].toCombined() == sequence for s in action.shortcuts()
+                                      if s.count()):
+            action.trigger()
+            return True
+    return False
+
+
+def format_report(result):
+    """ Plain-text version of a replay() result """
+    def row(name, stats):
+        if not stats["count"]:
+            return f"  {name:<14} -"
+        return (f"  {name:<14} {stats['count']:>6}  p50 {stats['p50_ms']:7.2f}  p95 {stats['p95_ms']:7.2f}"
+                f"  p99 {stats['p99_ms']:7.2f}  max {stats['max_ms']:8.2f} ms")
+
+    lines = [f"{result['trace']}: {result['events']} events in {result['wall_s']:.2f} s "
+             f"(speed {result['speed']})", "Handling latency:"]
+    lines += [row(kind, stats) for kind, stats in result["latency"].items()]
+    lines += ["Rendering:", row("canvas paint", result["canvas_paints"]), row("frame", result["frames"]),
+              f"  painted {result['painted_pixels']:,} pixels",
+              "Background jobs:", row("job", result["jobs"]),
+              f"Final checksum {result['checksum'][:16]}"]
+    if result["match"] is not None:
+        lines[-1] += " matches the recording" if result["match"] else " DIFFERS from the recording"
+    lines += [f"Warning: {text}" for text in result["warnings"]]
+    return "\n".join(lines)
+
+
+def _speed(text):
+    if text == "max":
+        return None
+    if text == "original":
+        return 1.0
+    value = float(text)
+    if value <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive")
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a Tabula Rasa input trace headlessly and time it")
+    parser.add_argument("trace", help="trace file written with Tabula_rasa.py --record-trace")
+    parser.add_argument("--speed", type=_speed, default=None, metavar="max|original|FACTOR",
+                        help="replay as fast as possible (default), at the recorded pace, "
+                             "or that many times faster")
+    parser.add_argument("--image", help="start from this image instead of the one in the trace")
+    parser.add_argument("--repeat", type=int, default=1, help="replay N times and report each run")
+    parser.add_argument("--json", metavar="FILE", help="also write the results as JSON")
+    args = parser.parse_args()
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QApplication(sys.argv[:1])
+    results = []
+    for _ in range(args.repeat):
+        result = replay(args.trace, args.speed, args.image)
+        results.append(result)
+        print(format_report(result))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results if args.repeat > 1 else results[0], f, indent=2)
+    app.quit()
+    return 0 if all(r["match"] is not False for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+Background jobs: run long document operations on a worker thread with
+progress reports and cooperative cancellation.
+"""
+import threading
+import time
+
+from PyQt6.QtCore import QObject, pyqtSignal
+
+
+class JobCancelled(Exception):
+    """ Raised from Job.check() once the job has been cancelled """
+
+
+class Job(QObject):
+    """ One operation running on its own worker thread.
+
+    `func(job)` does the work and calls job.check(fraction) now and then:
+    that reports progress and is where a cancelled job stops. The result
+    arrives on the GUI thread through the `done` signal; nothing is
+    delivered for a job that was cancelled. A `readonly` job (a save) does
+    not change the document, so it can be left to finish when the
+    document is closed.
+    """
+    progress = pyqtSignal(float)  # 0..1
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    # Minimum seconds between progress signals
+    REPORT_INTERVAL = 0.05
+
+    def __init__(self, label, func, readonly=False):
+        super().__init__()
+        self.label = label
+        self.readonly = readonly
+        self._func = func
+        self._cancel = threading.Event()
+        self._thread = None
+        self._last_report = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"job: {self.label}", daemon=True)
+        self._thread.start()
+
+    def run_here(self):
+        """ Run the job function on the calling thread and return its result """
+        return self._func(self)
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def wait(self, timeout=None):
+        """ Block until the worker thread has returned """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def check(self, fraction=None):
+        """ Cancellation point for the job function, optionally reporting progress (0..1) """
+        if self._cancel.is_set():
+            raise JobCancelled()
+        if fraction is not None:
+            now = time.monotonic()
+            if now - self._last_report >= self.REPORT_INTERVAL:
+                self._last_report = now
+                self.progress.emit(float(fraction))
+
+    def _run(self):
+        try:
+            result = self._func(self)
+        except JobCancelled:
+            return
+        except Exception as e:
+            if not self._cancel.is_set():
+                self.failed.emit(str(e) or type(e).__name__)
+            return
+        if not self._cancel.is_set():
+            self.done.emit(result)
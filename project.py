@@ -0,0 +1,463 @@
+"""
+Native project files (.tbr): the document as independently compressed tiles
+in one container, so saving a small edit rewrites only the tiles it touched
+and opening decodes only the tiles that are looked at.
+
+    header   b"TBRPROJ1", index offset, index length  (struct "<8sQQ")
+    chunks   compressed tiles of every pyramid level, and history blobs
+    index    zlib-compressed JSON: geometry, pixel layout, per-level tables
+             of chunk (offset, length, crc32) and the optional undo history
+
+Saving appends the changed chunks and a new index and only then points the
+header at it, so a save that fails or is cancelled leaves the previous state
+readable. The chunks it replaced become garbage; once there is more garbage
+than live data the next save rewrites the file compactly instead.
+"""
+import base64
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+from PyQt6.QtGui import QImage
+
+from image_io import DEFAULT_TILE_CACHE_BYTES, TileSource
+from image_ops import qimage_view, array_to_qimage, thread_pool, PackedImage
+
+PROJECT_EXTENSION = '.tbr'
+# Small tiles keep the work of a small edit small: a changed tile and its
+# parent in each pyramid level are all that is compressed again
+PROJECT_TILE = 256
+MAGIC = b"TBRPROJ1"
+_HEADER = struct.Struct("<8sQQ")
+
+
+def is_project(path):
+    return os.path.splitext(path)[1].lower() == PROJECT_EXTENSION
+
+
+def _compress(pixels):
+    # Each pixel minus its left neighbor (the PNG "sub" filter), then run-length
+    # deflate: faster than plain zlib and smaller on photographs
+    pixels = np.ascontiguousarray(pixels)
+    delta = pixels.copy()
+    delta[:, 1:] -= pixels[:, :-1]
+    packer = zlib.compressobj(1, zlib.DEFLATED, 15, 9, zlib.Z_RLE)
+    return packer.compress(delta) + packer.flush()
+
+
+def _decompress(data, dtype, shape):
+    delta = np.frombuffer(zlib.decompress(data), dtype).reshape(shape)
+    return np.cumsum(delta, axis=1, dtype=dtype)
+
+
+def _encode_table(table):
+    return base64.b64encode(table.astype('<u8').tobytes()).decode('ascii')
+
+
+def _decode_table(text):
+    return np.frombuffer(base64.b64decode(text), '<u8').reshape(-1, 3)
+
+
+class ProjectLevel:
+    """ One pyramid level: its size and the (offset, length, crc32) of each tile, row by row """
+
+    def __init__(self, width, height, tile, downsample, chunks=None):
+        self.width = width
+        self.height = height
+        self.tile_w = self.tile_h = tile
+        self.downsample = downsample
+        self.tiles_across = -(-width // tile)
+        self.tiles_down = -(-height // tile)
+        self.chunks = chunks
+
+    def tile_rect(self, tx, ty):
+        x, y = tx * self.tile_w, ty * self.tile_h
+        return x, y, min(self.tile_w, self.width - x), min(self.tile_h, self.height - y)
+
+
+def _pyramid(width, height, tile):
+    # Every level, halving until one tile is left
+    levels = [ProjectLevel(width, height, tile, 1)]
+    while levels[-1].width > tile or levels[-1].height > tile:
+        level = levels[-1]
+        levels.append(ProjectLevel(-(-level.width // 2), -(-level.height // 2), tile, level.downsample * 2))
+    return levels
+
+
+class ProjectFile(TileSource):
+    """ A project file opened through a memory map, decoding tiles on demand.
+
+    Serves as a lazily read image (read_region() and friends give B, G, R, A
+    pixels from the best pyramid level) and decodes the whole document in
+    its own pixel format with decode(). `state` identifies the saved state
+    the header pointed at when the file was opened.
+    """
+
+    def __init__(self, path, cache_bytes=DEFAULT_TILE_CACHE_BYTES):
+        super().__init__(cache_bytes)
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, offset, length = _HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC or offset + length > len(self._map):
+                raise ValueError
+            index = json.loads(zlib.decompress(self._map[offset:offset + length]))
+            self.width, self.height = index["width"], index["height"]
+            self.format = QImage.Format(index["format"])
+            self.dtype = np.dtype(index["dtype"])
+            self.pixel_shape = tuple(index["pixel"])
+            self.levels = [ProjectLevel(level["width"], level["height"], index["tile"],
+                                        level["downsample"], _decode_table(level["chunks"]))
+                           for level in index["levels"]]
+        except (ValueError, KeyError, TypeError, struct.error, zlib.error, OSError):
+            self.close()
+            raise ValueError(f"{os.path.basename(path)} is not a readable project")
+        self.index = index
+        self.state = (offset, length)
+        self.history = index.get("history") or []
+
+    def raw(self, offset, length):
+        """ The stored bytes of a chunk or history blob """
+        return self._map[int(offset):int(offset) + int(length)]
+
+    def chunk(self, level_index, tx, ty):
+        """ Tile (tx, ty) of a level in the document's own pixel layout, checked against its crc """
+        level = self.levels[level_index]
+        offset, length, crc = level.chunks[ty * level.tiles_across + tx]
+        _, _, w, h = level.tile_rect(tx, ty)
+        pixels = _decompress(self.raw(offset, length), self.dtype, (h, w) + self.pixel_shape)
+        if zlib.crc32(pixels) != crc:
+            raise ValueError(f"damaged tile {tx}, {ty} in {os.path.basename(self.path)}")
+        return pixels
+
+    def _load_tile(self, level_index, tx, ty):
+        pixels = self.chunk(level_index, tx, ty)
+        if self.format == QImage.Format.Format_ARGB32:
+            return pixels
+        # Other layouts go through Qt's conversion to ARGB32
+        image = array_to_qimage(pixels, self.format).convertToFormat(QImage.Format.Format_ARGB32)
+        return qimage_view(image, readonly=True).copy()
+
+    def decode(self, check=None):
+        """ The full-resolution document as a new QImage, tiles decoded in parallel """
+        image = QImage(self.width, self.height, self.format)
+        view = qimage_view(image)
+        level = self.levels[0]
+
+        def job(ty):
+            if check is not None:
+                check()
+            for tx in range(level.tiles_across):
+                x, y, w, h = level.tile_rect(tx, ty)
+                view[y:y + h, x:x + w] = self.chunk(0, tx, ty)
+        futures = [thread_pool().submit(job, ty) for ty in range(level.tiles_down)]
+        for i, future in enumerate(futures):
+            future.result()
+            if check is not None:
+                check(i / len(futures))
+        return image
+
+    def close(self):
+        super().close()
+        try:
+            self._map.close()
+        except (ValueError, AttributeError):
+            pass
+        self._file.close()
+
+
+def open_project(path, cache_bytes=DEFAULT_TILE_CACHE_BYTES):
+    """ Open a project file, or return None if `path` isn't one we can read """
+    try:
+        return ProjectFile(path, cache_bytes)
+    except (ValueError, OSError):
+        return None
+
+
+def project_tiles(x, y, w, h):
+    """ The (tx, ty) project tiles a rectangle of the document touches """
+    return [(tx, ty) for ty in range(y // PROJECT_TILE, (y + h - 1) // PROJECT_TILE + 1)
+            for tx in range(x // PROJECT_TILE, (x + w - 1) // PROJECT_TILE + 1)]
+
+
+def _half(pixels):
+    # Average 2 x 2 blocks; an odd last row or column is averaged with itself
+    h, w = pixels.shape[:2]
+    if h % 2 or w % 2:
+        pad = ((0, h % 2), (0, w % 2)) + ((0, 0),) * (pixels.ndim - 2)
+        pixels = np.pad(pixels, pad, mode='edge')
+    total = np.add(pixels[0::2], pixels[1::2], dtype=np.uint16 if pixels.itemsize == 1 else np.uint32)
+    total = total[:, 0::2] + total[:, 1::2]
+    total += 2
+    total >>= 2
+    return total.astype(pixels.dtype)
+
+
+def _blob_refs(records):
+    return {tuple(ref) for record in records for ref in record.get("blobs", ())}
+
+
+def save_project(path, width, height, fmt, read, dirty=None, since=None, history=None, check=None):
+    """ Write the document to the project file at `path`, incrementally if it already holds one.
+
+    `read(x, y, w, h)` returns full-resolution pixels in the document's own
+    layout (the qimage_view layout of `fmt`). `dirty` lists the (tx, ty)
+    tiles that may have changed since the file was in state `since` (the
+    `state` it was opened or last saved in); every tile is checked when
+    `dirty` is None or the file has moved on. Tiles whose pixels still
+    match the stored crc32 are kept either way, as are the pyramid tiles
+    above them.
+
+    `history` is a list of (meta, blobs) undo records: `meta` a JSON-able
+    dict and `blobs` the bytes to store with it, whose [offset, length]
+    references are put in meta["blobs"]. A meta that already has "blobs"
+    (read from this file) is carried over without rewriting them.
+
+    Returns (new state, index, chunks written, bytes written, compacted).
+    """
+    history = history or []
+    sample = np.asarray(read(0, 0, 1, 1))
+    layout = {"width": width, "height": height, "format": fmt.value, "dtype": sample.dtype.str,
+              "pixel": list(sample.shape[2:]), "tile": PROJECT_TILE}
+    old = open_project(path) if os.path.exists(path) else None
+    try:
+        if old is not None and any(old.index.get(key) != value for key, value in layout.items()):
+            old.close()
+            old = None
+        if old is None or old.state != since:
+            dirty = None
+        carried = _blob_refs(meta for meta, _ in history)
+        if carried and (old is None or not carried <= _blob_refs(old.history)):
+            raise ValueError("the undo history refers to another version of the file")
+        return _ProjectWriter(path, layout, read, old, dirty, history, check).write()
+    finally:
+        if old is not None:
+            old.close()
+
+
+class _ProjectWriter:
+    # One save: works out which tiles changed, compresses them on the pool and
+    # appends them (or writes a compact new file) followed by the index
+
+    def __init__(self, path, layout, read, old, dirty, history, check):
+        self.path = path
+        self.layout = layout
+        self.read = read
+        self.old = old
+        self.history = history
+        self.check = check or (lambda fraction=None: None)
+        self.levels = _pyramid(layout["width"], layout["height"], PROJECT_TILE)
+        level = self.levels[0]
+        if old is None or dirty is None:
+            dirty = [(tx, ty) for ty in range(level.tiles_down) for tx in range(level.tiles_across)]
+        self.dirty = sorted(set(dirty))
+        self.written = 0
+        self.state = None
+
+    def _encode(self, index, tile, pixels):
+        # (crc32, compressed bytes or None when the stored chunk still matches)
+        pixels = np.ascontiguousarray(pixels)
+        crc = zlib.crc32(pixels)
+        if self.old is not None:
+            level = self.levels[index]
+            if self.old.levels[index].chunks[tile[1] * level.tiles_across + tile[0]][2] == crc:
+                return crc, None
+        return crc, _compress(pixels)
+
+    def _parent(self, index, tile, halves):
+        # Tile of pyramid level `index` from the halved tiles of the level
+        # below that changed; the quarters of the others come from the file
+        level, below = self.levels[index], self.levels[index - 1]
+        px, py = tile
+        _, _, w, h = level.tile_rect(px, py)
+        children = [(cx, cy) for cy in (2 * py, 2 * py + 1) for cx in (2 * px, 2 * px + 1)
+                    if cx < below.tiles_across and cy < below.tiles_down]
+        if all(child in halves for child in children):
+            out = np.empty((h, w) + tuple(self.layout["pixel"]), self.layout["dtype"])
+        else:
+            out = self.old.chunk(index, px, py).copy()
+        quarter = level.tile_w // 2
+        for cx, cy in children:
+            small = halves.get((cx, cy))
+            if small is not None:
+                x, y = (cx % 2) * quarter, (cy % 2) * quarter
+                out[y:y + small.shape[0], x:x + small.shape[1]] = small
+        return out
+
+    def _encode_levels(self):
+        # [{tile: (crc, bytes or None)} per level] for every tile that may have
+        # changed: level 0 read from the document, and above it the parents
+        # of the tiles that did change
+        results = []
+        tiles = self.dirty
+        halves = {}
+        total = sum(len(tiles) >> (2 * i) for i in range(len(self.levels))) or 1
+        done = 0
+        for index, level in enumerate(self.levels):
+            last = index + 1 == len(self.levels)
+
+            def job(tile, index=index, level=level, halves=halves, last=last):
+                if index == 0:
+                    pixels = self.read(*level.tile_rect(*tile))
+                else:
+                    pixels = self._parent(index, tile, halves)
+                crc, data = self._encode(index, tile, pixels)
+                return crc, data, None if data is None or last else _half(pixels)
+            encoded = {}
+            halves = {}
+            futures = [(tile, thread_pool().submit(job, tile)) for tile in tiles]
+            for tile, future in futures:
+                crc, data, small = future.result()
+                encoded[tile] = (crc, data)
+                if small is not None:
+                    halves[tile] = small
+                done += 1
+                self.check(done / total)
+            results.append(encoded)
+            tiles = sorted({(tx // 2, ty // 2) for tx, ty in halves})
+            if not tiles:
+                results.extend({} for _ in self.levels[index + 1:])
+                break
+        return results
+
+    def write(self):
+        encoded = self._encode_levels()
+        changed = sum(data is not None for level in encoded for _, data in level.values())
+        if self.old is not None:
+            replaced = self.old.state[1]
+            for index, level in enumerate(encoded):
+                old = self.old.levels[index]
+                for (tx, ty), (crc, data) in level.items():
+                    if data is not None:
+                        replaced += int(old.chunks[ty * old.tiles_across + tx][1])
+            carried = _blob_refs(meta for meta, _ in self.history)
+            replaced += sum(ref[1] for ref in _blob_refs(self.old.history) - carried)
+            garbage = self.old.index.get("garbage", 0) + replaced
+            live = os.path.getsize(self.path) - _HEADER.size - garbage
+            if garbage <= live:
+                index = self._append(encoded, garbage)
+                return self.state, index, changed, self.written, False
+        index = self._rewrite(encoded)
+        return self.state, index, changed, self.written, self.old is not None
+
+    def _store(self, f, data):
+        offset = f.tell()
+        f.write(data)
+        self.written += len(data)
+        return offset
+
+    def _index(self, tables, history, garbage):
+        levels = [{"width": level.width, "height": level.height, "downsample": level.downsample,
+                   "chunks": _encode_table(table)} for level, table in zip(self.levels, tables)]
+        return dict(self.layout, levels=levels, history=history, garbage=garbage)
+
+    def _append(self, encoded, garbage):
+        with open(self.path, 'r+b') as f:
+            end = f.seek(0, os.SEEK_END)
+            try:
+                tables = []
+                for index, level in enumerate(self.levels):
+                    # Unchanged chunks keep their place in the file
+                    table = self.old.levels[index].chunks.copy()
+                    for (tx, ty), (crc, data) in encoded[index].items():
+                        if data is not None:
+                            table[ty * level.tiles_across + tx] = (self._store(f, data), len(data), crc)
+                    tables.append(table)
+                history = []
+                for meta, blobs in self.history:
+                    if "blobs" not in meta:
+                        meta = dict(meta, blobs=[[self._store(f, data), len(data)] for data in blobs])
+                    history.append(meta)
+                index = self._index(tables, history, garbage)
+                self._finish(f, index)
+            except BaseException:
+                # The header still points at the previous index
+                f.truncate(end)
+                raise
+        return index
+
+    def _rewrite(self, encoded):
+        # A compact new file, written next to the target and moved over it:
+        # unchanged chunks are copied as stored, without compressing them again
+        tmp_name = self.path + ".tmp"
+        try:
+            with open(tmp_name, 'wb') as f:
+                f.write(_HEADER.pack(MAGIC, 0, 0))
+                tables = []
+                for index, level in enumerate(self.levels):
+                    table = np.zeros((level.tiles_down * level.tiles_across, 3), np.uint64)
+                    for ty in range(level.tiles_down):
+                        for tx in range(level.tiles_across):
+                            i = ty * level.tiles_across + tx
+                            crc, data = encoded[index].get((tx, ty), (None, None))
+                            if data is None:
+                                offset, length, crc = self.old.levels[index].chunks[i]
+                                data = self.old.raw(offset, length)
+                            table[i] = (self._store(f, data), len(data), crc)
+                    tables.append(table)
+                history = []
+                for meta, blobs in self.history:
+                    if "blobs" in meta:
+                        blobs = [self.old.raw(*ref) for ref in meta["blobs"]]
+                    history.append(dict(meta, blobs=[[self._store(f, data), len(data)] for data in blobs]))
+                index = self._index(tables, history, 0)
+                self._finish(f, index)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        os.replace(tmp_name, self.path)
+        return index
+
+    def _finish(self, f, index):
+        # The index goes after the chunks; once they are on disk the header
+        # is pointed at it, which is what makes the save take effect
+        self.check()
+        data = zlib.compress(json.dumps(index, separators=(',', ':')).encode(), 1)
+        offset = self._store(f, data)
+        f.flush()
+        os.fsync(f.fileno())
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, offset, len(data)))
+        f.flush()
+        os.fsync(f.fileno())
+        self.state = (offset, len(data))
+
+
+def history_record(state):
+    """ (meta, blobs) storing one undo history entry, or None for entries a project can't hold """
+    if isinstance(state, QImage):
+        state = PackedImage.pack(state)
+    if isinstance(state, PackedImage):
+        return ({"kind": "image", "width": state.width, "height": state.height, "format": state.format.value,
+                 "rows": [rows for rows, _ in state.bands]}, [data for _, data in state.bands])
+    if isinstance(state, tuple):
+        kind, arg = state
+        if kind == "frames":
+            # Points at temporary files of a multi-frame document
+            return None
+        if kind == "patch":
+            x, y, before, after = arg
+            return ({"kind": kind, "x": x, "y": y, "shape": list(before.shape), "dtype": before.dtype.str},
+                    [zlib.compress(np.ascontiguousarray(before), 1), zlib.compress(np.ascontiguousarray(after), 1)])
+        return {"kind": kind, "arg": list(arg) if isinstance(arg, tuple) else arg}, []
+    return None
+
+
+def history_state(project, meta):
+    """ The undo history entry stored as `meta` in `project` """
+    kind = meta["kind"]
+    blobs = [project.raw(*ref) for ref in meta.get("blobs", ())]
+    if kind == "image":
+        return PackedImage(meta["width"], meta["height"], QImage.Format(meta["format"]),
+                           list(zip(meta["rows"], blobs)))
+    if kind == "patch":
+        shape, dtype = tuple(meta["shape"]), np.dtype(meta["dtype"])
+        before, after = (np.frombuffer(zlib.decompress(data), dtype).reshape(shape).copy() for data in blobs)
+        return kind, (meta["x"], meta["y"], before, after)
+    arg = meta["arg"]
+    return kind, tuple(arg) if isinstance(arg, list) else arg
@@ -0,0 +1,393 @@
+"""
+Headless service: the app's retouching operations for scripts, served by one
+long-running process so each image doesn't pay for starting Python and Qt.
+
+    python Tabula_rasa.py --serve --socket /tmp/tabula.sock   (or --port 8765)
+
+Requests are HTTP/1.1 with JSON bodies, over a Unix socket or localhost TCP:
+
+    curl --unix-socket /tmp/tabula.sock http://x/jobs -d '{"path": "scan.png",
+         "steps": [{"op": "trim", "tolerance": 10}, {"op": "resize", "width": 800}],
+         "out": "small.png"}'
+
+    POST /jobs    run the steps on the image at "path" and answer with the
+                  results and per-step timings once done
+    GET  /status  workers, queue and cache counters
+
+Steps are applied in order: removebg (color), fill (x, y, color), trim
+(background, tolerance), resize (width and/or height, method) and export
+(path, colors, dither); "out" is a final export. Jobs run on a pool of
+--jobs workers; up to --queue more wait, and past that requests are turned
+away with 503 so callers back off. Decoded files and the result of every
+step are kept in an LRU cache keyed by the file's path, mtime and size and
+the steps so far, so jobs that share a file or a prefix of steps skip them.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtGui import QColor, QImage
+
+from image_io import load_image, save_image, file_key, ensure_app
+from image_ops import (qimage_view, pixel_value, rgb_index, compact_image, corner_color, flood_fill, make_transparent,
+                       trim, resize_image, with_alpha, RESAMPLE_FILTERS)
+
+log = logging.getLogger("tabula_rasa.server")
+
+DEFAULT_CACHE_BYTES = 1024 * 1024 * 1024
+_MAX_BODY = 1024 * 1024
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+            422: "Unprocessable Entity", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class JobError(ValueError):
+    """ A request that can't be carried out as given (answered with 422) """
+
+
+class ResultCache:
+    """ LRU cache of (image, info) pairs bounded by the images' bytes.
+
+    get_or_make() computes a missing entry once: concurrent callers asking
+    for the same key wait for the first one instead of repeating its work.
+    """
+
+    def __init__(self, limit=DEFAULT_CACHE_BYTES):
+        self.limit = limit
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._making = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_make(self, key, make):
+        """ (value, whether it came from the cache) """
+        while True:
+            with self._lock:
+                value = self._items.get(key)
+                if value is not None:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value, True
+                event = self._making.get(key)
+                if event is None:
+                    event = self._making[key] = threading.Event()
+                    break
+            event.wait()
+        try:
+            value = make()
+        finally:
+            with self._lock:
+                del self._making[key]
+            event.set()
+        with self._lock:
+            self.misses += 1
+            size = value[0].sizeInBytes()
+            if size <= self.limit:
+                self._items[key] = value
+                self._bytes += size
+                while self._bytes > self.limit:
+                    _, (old, _) = self._items.popitem(last=False)
+                    self._bytes -= old.sizeInBytes()
+        return value, False
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._items), "bytes": self._bytes, "limit": self.limit,
+                    "hits": self.hits, "misses": self.misses}
+
+
+def _color(spec, image):
+    # "corner" (or nothing): the color of the corners; else any QColor name
+    if spec in (None, "corner"):
+        return corner_color(qimage_view(image, readonly=True))
+    color = QColor(spec)
+    if not color.isValid():
+        raise JobError(f"unknown color {spec}")
+    return pixel_value(color.getRgb(), image.format())
+
+
+def _editable(image):
+    # A copy to edit; palette images become ARGB32, as indices aren't colors
+    if image.format() == QImage.Format.Format_Indexed8:
+        return image.convertToFormat(QImage.Format.Format_ARGB32)
+    return image.copy()
+
+
+def op_trim(image, step):
+    tolerance = int(step.get("tolerance", 10))
+    background = step.get("background", "corner")
+    color = None if background == "corner" else QColor(background)
+    if color is not None and not color.isValid():
+        raise JobError(f"unknown color {background}")
+    trimmed, box = trim(image, color, tolerance)
+    return (trimmed or image), {"box": box}
+
+
+def op_removebg(image, step):
+    work = with_alpha(image)
+    value = _color(step.get("color"), work)
+    index = rgb_index(work.format())
+    count = make_transparent(qimage_view(work), tuple(value[i] for i in index), index)
+    return work, {"pixels": count}
+
+
+def op_fill(image, step):
+    work = _editable(image)
+    x, y = int(step["x"]), int(step["y"])
+    if not (0 <= x < work.width() and 0 <= y < work.height()):
+        raise JobError(f"({x}, {y}) is outside the {work.width()} x {work.height()} image")
+    color = QColor(step.get("color", "#000000"))
+    if not color.isValid():
+        raise JobError(f"unknown color {step.get('color')}")
+    count = flood_fill(qimage_view(work), x, y, pixel_value(color.getRgb(), work.format()))
+    return work, {"pixels": count}
+
+
+def op_resize(image, step):
+    width, height = step.get("width"), step.get("height")
+    if width is None and height is None:
+        raise JobError("resize needs a width or a height")
+    width = None if width is None else int(width)
+    height = None if height is None else int(height)
+    for name, value in (("width", width), ("height", height)):
+        if value is not None and value < 1:
+            raise JobError(f"resize {name} must be at least 1, not {value}")
+    method = step.get("method", "lanczos")
+    if method not in RESAMPLE_FILTERS:
+        raise JobError(f"unknown resize method {method}; use one of {', '.join(RESAMPLE_FILTERS)}")
+    # A missing side keeps the aspect ratio
+    if width is None:
+        width = max(1, round(image.width() * height / image.height()))
+    if height is None:
+        height = max(1, round(image.height() * width / image.width()))
+    return resize_image(image, width, height, method), {"width": width, "height": height}
+
+
+def op_export(image, step):
+    path = step.get("path")
+    if not path:
+        raise JobError("export needs a path")
+    colors = step.get("colors")
+    description = None
+    if colors:
+        argb = image if image.format() == QImage.Format.Format_ARGB32 else \
+            image.convertToFormat(QImage.Format.Format_ARGB32)
+        out, description = compact_image(argb, int(colors), bool(step.get("dither", False)))
+        tmp_name = path + ".tmp"
+        if not out.save(tmp_name, "PNG"):
+            raise JobError(f"can't write {path}")
+        os.replace(tmp_name, path)
+    else:
+        try:
+            save_image(image, path)
+        except OSError as e:
+            raise JobError(str(e))
+    return image, {"path": path, "bytes": os.path.getsize(path), "description": description}
+
+
+# Steps that change the image, and whose results are cached
+OPERATIONS = {"trim": op_trim, "removebg": op_removebg, "fill": op_fill, "resize": op_resize}
+
+
+class JobServer:
+    """ Runs job requests on a bounded worker pool, with the caches they share """
+
+    def __init__(self, workers=None, queue=16, cache_bytes=DEFAULT_CACHE_BYTES):
+        self.workers = workers or os.cpu_count() or 4
+        self.queue = queue
+        self.cache = ResultCache(cache_bytes)
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="job")
+        self._active = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def status(self):
+        return {"workers": self.workers, "queue": self.queue, "active": self._active,
+                "completed": self.completed, "failed": self.failed, "rejected": self.rejected,
+                "cache": self.cache.stats()}
+
+    async def submit(self, request):
+        """ (HTTP status, response) for one job request """
+        if self._active >= self.workers + self.queue:
+            self.rejected += 1
+            return 503, {"error": "busy", "active": self._active}
+        self._active += 1
+        received = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._pool, self.run, request, received)
+            self.completed += 1
+            return 200, result
+        except JobError as e:
+            self.failed += 1
+            return 422, {"error": str(e)}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.failed += 1
+            return 422, {"error": f"{type(e).__name__}: {e}"}
+        finally:
+            self._active -= 1
+
+    def run(self, request, received):
+        # On a worker: decode (or reuse) the file and apply the steps
+        start = time.perf_counter()
+        path = request.get("path")
+        if not isinstance(path, str):
+            raise JobError("a job needs the path of an image")
+        steps = list(request.get("steps") or [])
+        if "op" in request:
+            steps.insert(0, {key: value for key, value in request.items() if key not in ("path", "steps", "out")})
+        if request.get("out"):
+            steps.append({"op": "export", "path": request["out"]})
+        for step in steps:
+            if not isinstance(step, dict) or step.get("op") not in OPERATIONS and step.get("op") != "export":
+                raise JobError(f"unknown step {step!r}")
+        source = (file_key(path),)
+        key = source
+        timings = {"queued_ms": (start - received) * 1000}
+        results = []
+        image = None  # decoded only when a step isn't cached
+
+        def current():
+            nonlocal image
+            if image is None:
+                t0 = time.perf_counter()
+                (image, _), cached = self.cache.get_or_make(source, lambda: (load_image(path), None))
+                timings["decode_ms"] = (time.perf_counter() - t0) * 1000
+                timings["decode_cached"] = cached
+            return image
+        for step in steps:
+            t0 = time.perf_counter()
+            op = step["op"]
+            if op == "export":
+                # Writes a file, so it always runs; the image goes on unchanged
+                _, info = op_export(current(), step)
+                cached = False
+            else:
+                key = key + (json.dumps(step, sort_keys=True),)
+                (result, info), cached = self.cache.get_or_make(
+                    key, lambda op=op, step=step: OPERATIONS[op](current(), step))
+                image = result
+            results.append({"op": op, "ms": (time.perf_counter() - t0) * 1000, "cached": cached, **info})
+        if image is None:
+            current()
+        timings["total_ms"] = (time.perf_counter() - start) * 1000
+        return {"width": image.width(), "height": image.height(), "steps": results, "timings": timings}
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def _read_request(reader):
+    # (method, path, headers, body) of the next HTTP request, or None at EOF
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise JobError("malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > _MAX_BODY:
+        raise OverflowError
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target.split('?', 1)[0], headers, body
+
+
+def _response(status, payload, close):
+    body = json.dumps(payload).encode()
+    head = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}", "Content-Type: application/json",
+            f"Content-Length: {len(body)}", "Connection: close" if close else "Connection: keep-alive"]
+    if status == 503:
+        head.append("Retry-After: 1")
+    return ("\r\n".join(head) + "\r\n\r\n").encode() + body
+
+
+async def _handle(server, reader, writer):
+    # One connection: requests are answered in turn until the client closes
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+            except OverflowError:
+                writer.write(_response(413, {"error": "request too large"}, True))
+                break
+            except (JobError, ValueError):
+                writer.write(_response(400, {"error": "malformed request"}, True))
+                break
+            if request is None:
+                break
+            method, target, headers, body = request
+            close = headers.get("connection", "").lower() == "close"
+            if method == "GET" and target == "/status":
+                status, payload = 200, server.status()
+            elif method == "POST" and target == "/jobs":
+                try:
+                    job = json.loads(body or b'{}')
+                    if not isinstance(job, dict):
+                        raise ValueError
+                except ValueError:
+                    status, payload = 400, {"error": "the body must be a JSON object"}
+                else:
+                    try:
+                        status, payload = await server.submit(job)
+                    except Exception as e:
+                        log.exception("Job failed")
+                        status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+            else:
+                status, payload = 404, {"error": f"no {method} {target}"}
+            writer.write(_response(status, payload, close))
+            await writer.drain()
+            if close:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _serve(server, socket_path, port):
+    handler = lambda reader, writer: _handle(server, reader, writer)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        listener = await asyncio.start_unix_server(handler, socket_path)
+        os.chmod(socket_path, 0o600)
+        where = socket_path
+    else:
+        # Local callers only
+        listener = await asyncio.start_server(handler, "127.0.0.1", port)
+        where = f"http://127.0.0.1:{port}"
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    log.info("Serving on %s with %d workers", where, server.workers)
+    async with listener:
+        await stop.wait()
+    if socket_path and os.path.exists(socket_path):
+        os.remove(socket_path)
+
+
+def serve(socket_path=None, port=8765, workers=None, queue=16, cache_bytes=DEFAULT_CACHE_BYTES):
+    """ Run the service until SIGINT/SIGTERM; returns the exit status """
+    ensure_app()
+    server = JobServer(workers, queue, cache_bytes)
+    try:
+        asyncio.run(_serve(server, socket_path, port))
+    finally:
+        server.shutdown()
+    return 0
@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository, and the GUI tests run headless
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+
+@pytest.fixture(scope="session")
+def qapp():
+    from PyQt6.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([])
@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+from PyQt6.QtCore import QEvent, QPointF, QRect, Qt
+from PyQt6.QtGui import QColor, QImage, QMouseEvent
+
+from image_ops import qimage_view
+
+
+@pytest.fixture
+def canvas(qapp):
+    from Tabula_rasa import Canvas
+    canvas = Canvas()
+    canvas.image = QImage(64, 48, QImage.Format.Format_ARGB32)
+    canvas.image.fill(QColor("white"))
+    canvas.history.clear()
+    canvas.save_state()
+    canvas.zoom_factor = 1.0
+    canvas.current_tool = "brush"
+    canvas.set_brush_color(QColor("red"))
+    canvas.set_brush_size(3)
+    return canvas
+
+
+def stroke(canvas, *points):
+    kinds = [QEvent.Type.MouseButtonPress] + [QEvent.Type.MouseMove] * (len(points) - 1)
+    for kind, (x, y) in zip(kinds, points):
+        button = Qt.MouseButton.LeftButton if kind == QEvent.Type.MouseButtonPress else Qt.MouseButton.NoButton
+        canvas.event(QMouseEvent(kind, QPointF(x, y), QPointF(x, y), button, Qt.MouseButton.LeftButton,
+                                 Qt.KeyboardModifier.NoModifier))
+    x, y = points[-1]
+    canvas.event(QMouseEvent(QEvent.Type.MouseButtonRelease, QPointF(x, y), QPointF(x, y),
+                             Qt.MouseButton.LeftButton, Qt.MouseButton.NoButton, Qt.KeyboardModifier.NoModifier))
+
+
+def pixels(image):
+    return qimage_view(image, readonly=True).copy()
+
+
+GEOMETRY = {
+    "rotate": lambda canvas: canvas.rotate_image(1),
+    "flip": lambda canvas: canvas.flip_image(True),
+    "crop": lambda canvas: canvas.crop_image(QRect(4, 2, 40, 30)),
+}
+
+
+@pytest.mark.parametrize("edit", sorted(GEOMETRY))
+def test_undo_keeps_stroke_before_geometry_edit(canvas, edit):
+    stroke(canvas, (10, 10), (20, 10))
+    assert canvas.image.pixelColor(15, 10) == QColor("red")
+    assert GEOMETRY[edit](canvas)
+    after_edit = pixels(canvas.image)
+    stroke(canvas, (5, 20), (5, 25))
+    after_second = pixels(canvas.image)
+
+    canvas.undo()
+    assert np.array_equal(pixels(canvas.image), after_edit)
+    canvas.redo()
+    assert np.array_equal(pixels(canvas.image), after_second)
+
+
+@pytest.mark.parametrize("edit", sorted(GEOMETRY))
+def test_jump_to_rebuilds_stroke_under_geometry_edit(canvas, edit):
+    stroke(canvas, (10, 10), (20, 10))
+    GEOMETRY[edit](canvas)
+    after_edit = pixels(canvas.image)
+    stroke(canvas, (5, 20), (5, 25))
+    after_second = pixels(canvas.image)
+
+    assert canvas.jump_to(0)
+    assert canvas.image.pixelColor(15, 10) == QColor("white")
+    assert canvas.jump_to(2)
+    assert np.array_equal(pixels(canvas.image), after_edit)
+    assert canvas.jump_to(3)
+    assert np.array_equal(pixels(canvas.image), after_second)
+
+
+def test_stroke_is_one_undo_step(canvas):
+    before = pixels(canvas.image)
+    stroke(canvas, (10, 10), (30, 10), (30, 30))
+    after = pixels(canvas.image)
+    assert len(canvas.history) == 2
+    canvas.undo()
+    assert np.array_equal(pixels(canvas.image), before)
+    canvas.redo()
+    assert np.array_equal(pixels(canvas.image), after)
+
+
+@pytest.mark.parametrize("edit", ["rotate", "crop"])
+def test_reshaping_mapped_document_turns_it_into_a_copy(canvas, tmp_path, edit):
+    path = str(tmp_path / "pixels.npy")
+    original = np.full((48, 64, 4), 255, np.uint8)
+    np.save(path, original)
+    canvas.open_mapped(path)
+    messages = []
+    canvas.statusMessage.connect(messages.append)
+    stroke(canvas, (10, 10), (20, 10))
+    assert GEOMETRY[edit](canvas)
+    assert canvas.mapped is None
+    assert any("copy" in text for text in messages)
+
+    # Undoing the edit doesn't quietly return to a document that looks mapped
+    # but no longer writes back
+    canvas.undo()
+    assert canvas.mapped is None
+    assert not isinstance(getattr(canvas.image, "_array_ref", None), np.memmap)
+    assert canvas.image.pixelColor(15, 10) == QColor("red")
+    assert np.array_equal(np.load(path), original)
+
+    canvas.save_image(path, background=False)
+    saved = np.load(path)
+    assert saved.shape == (48, 64, 4)
+    assert tuple(saved[10, 15]) == (255, 0, 0, 255)
+
+
+def test_flip_keeps_mapped_document_in_place(canvas, tmp_path):
+    path = str(tmp_path / "pixels.npy")
+    np.save(path, np.full((48, 64, 4), 255, np.uint8))
+    canvas.open_mapped(path)
+    stroke(canvas, (10, 10), (20, 10))
+    assert canvas.flip_image(True)
+    assert canvas.mapped is not None
+    canvas.save_image(path, background=False)
+    assert tuple(np.load(path)[10, 63 - 15]) == (255, 0, 0, 255)
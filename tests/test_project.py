@@ -0,0 +1,179 @@
+import os
+
+import numpy as np
+import pytest
+from PyQt6.QtGui import QImage
+
+from image_ops import qimage_view
+from project import PROJECT_TILE, history_record, history_state, open_project, save_project
+
+FORMAT = QImage.Format.Format_ARGB32
+
+
+class Cancelled(Exception):
+    pass
+
+
+def document(seed=0, width=900, height=700):
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 4), dtype=np.uint8)
+    pixels[:300, :400] = (10, 20, 30, 255)
+    return pixels
+
+
+def save(path, pixels, **kwargs):
+    height, width = pixels.shape[:2]
+    return save_project(path, width, height, FORMAT, lambda x, y, w, h: pixels[y:y + h, x:x + w], **kwargs)
+
+
+def decoded(path):
+    project = open_project(path)
+    assert project is not None
+    try:
+        image = project.decode()
+        return qimage_view(image, readonly=True).copy(), project.state
+    finally:
+        project.close()
+
+
+@pytest.fixture
+def saved(tmp_path):
+    path = str(tmp_path / "doc.tbr")
+    pixels = document()
+    state, _, chunks, _, compacted = save(path, pixels)
+    # 4 x 3 tiles, then 2 x 2, then the single top tile
+    assert chunks == 12 + 4 + 1 and not compacted
+    return path, pixels, state
+
+
+def test_round_trip(saved):
+    path, pixels, state = saved
+    image, reopened = decoded(path)
+    assert np.array_equal(image, pixels)
+    assert reopened == state
+
+
+def test_saving_one_edited_tile_appends_only_its_chunks(saved):
+    path, pixels, state = saved
+    size = os.path.getsize(path)
+    pixels[300:310, 520:530] = (0, 0, 255, 255)
+    state, _, chunks, written, compacted = save(path, pixels, dirty=[(2, 1)], since=state)
+    # The tile, its parent and the top of the pyramid; then the new index
+    assert chunks == 3 and not compacted
+    assert os.path.getsize(path) == size + written
+    project = open_project(path)
+    try:
+        tables = np.concatenate([level.chunks for level in project.levels])
+    finally:
+        project.close()
+    appended = tables[tables[:, 0] >= size]
+    assert len(appended) == 3
+    assert written == int(appended[:, 1].sum()) + state[1]
+    image, reopened = decoded(path)
+    assert np.array_equal(image, pixels)
+    assert reopened == state
+
+
+def test_unreported_edits_are_found_by_crc(saved):
+    path, pixels, state = saved
+    pixels[650, 880] = (1, 2, 3, 4)
+    # The file moved on from `since`, so every tile is checked against its crc
+    _, _, chunks, _, _ = save(path, pixels, dirty=[(0, 0)], since=(0, 0))
+    assert chunks == 3
+    _, _, chunks, _, _ = save(path, pixels)
+    assert chunks == 0
+    assert np.array_equal(decoded(path)[0], pixels)
+
+
+def test_garbage_is_compacted(saved):
+    path, pixels, state = saved
+    compacted = False
+    for seed in range(1, 6):
+        pixels[:] = document(seed)
+        state, _, _, _, compacted = save(path, pixels, since=state)
+        if compacted:
+            break
+    assert compacted
+    assert not os.path.exists(path + ".tmp")
+    assert np.array_equal(decoded(path)[0], pixels)
+    # A compact file holds a single copy of each chunk plus the index
+    fresh = str(path) + ".fresh.tbr"
+    save(fresh, pixels)
+    assert os.path.getsize(path) == os.path.getsize(fresh)
+
+
+@pytest.mark.parametrize("changes", ["one tile", "everything"])
+def test_cancelled_save_leaves_previous_state_readable(saved, changes):
+    path, pixels, state = saved
+    before = pixels.copy()
+    size = os.path.getsize(path)
+    edited = document(7) if changes == "everything" else pixels.copy()
+    edited[0:5, 0:5] = 0
+    calls = []
+
+    def check(fraction=None):
+        calls.append(fraction)
+        if fraction is None:
+            # Cancelled after the chunks, just before the header moves
+            raise Cancelled()
+
+    with pytest.raises(Cancelled):
+        save(path, edited, since=state, check=check)
+    assert calls
+    assert os.path.getsize(path) == size
+    assert not os.path.exists(path + ".tmp")
+    image, reopened = decoded(path)
+    assert reopened == state
+    assert np.array_equal(image, before)
+
+
+def test_damaged_chunk_is_detected(saved):
+    path, pixels, state = saved
+    project = open_project(path)
+    offset, length, _ = (int(v) for v in project.levels[0].chunks[5])
+    project.close()
+    with open(path, "r+b") as f:
+        f.seek(offset + length // 2)
+        byte = f.read(1)
+        f.seek(offset + length // 2)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    project = open_project(path)
+    try:
+        with pytest.raises(Exception):
+            project.chunk(0, 1, 1)
+        assert np.array_equal(project.chunk(0, 0, 0), pixels[:PROJECT_TILE, :PROJECT_TILE])
+    finally:
+        project.close()
+
+
+def test_history_round_trip_and_carry_over(saved):
+    path, pixels, state = saved
+    before = pixels[10:20, 30:50].copy()
+    after = before ^ 0xFF
+    snapshot = QImage(64, 32, FORMAT)
+    snapshot.fill(0xFF336699)
+    states = [snapshot, ("rotate", 1), ("crop", (1, 2, 30, 40)), ("patch", (30, 10, before, after))]
+    state, index, _, _, _ = save(path, pixels, since=state, history=[history_record(s) for s in states])
+
+    project = open_project(path)
+    try:
+        restored = [history_state(project, meta) for meta in project.history]
+        carried = [(meta, []) for meta in project.history]
+    finally:
+        project.close()
+    unpacked = restored[0].unpack()
+    assert np.array_equal(qimage_view(unpacked, readonly=True), qimage_view(snapshot, readonly=True))
+    assert restored[1] == ("rotate", 1)
+    assert restored[2] == ("crop", (1, 2, 30, 40))
+    kind, (x, y, b, a) = restored[3]
+    assert (kind, x, y) == ("patch", 30, 10)
+    assert np.array_equal(b, before) and np.array_equal(a, after)
+
+    # Saving again refers to the stored blobs instead of writing them again
+    pixels[0, 0] = 0
+    _, _, _, written, _ = save(path, pixels, dirty=[(0, 0)], since=state, history=carried)
+    project = open_project(path)
+    try:
+        assert [meta["blobs"] for meta in project.history] == [meta["blobs"] for meta, _ in carried]
+        assert np.array_equal(restored[3][1][3], history_state(project, project.history[3])[1][3])
+    finally:
+        project.close()
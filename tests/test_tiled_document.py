@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from PyQt6.QtCore import QPoint
+from PyQt6.QtGui import QColor
+
+from image_io import write_tiled_tiff
+
+
+@pytest.fixture
+def tiled(qapp, tmp_path):
+    from Tabula_rasa import Canvas
+    pixels = np.random.default_rng(0).integers(0, 256, (700, 900, 4), dtype=np.uint8)
+    pixels[..., 3] = 255
+    path = str(tmp_path / "tiled.tif")
+    write_tiled_tiff(path, 900, 700, lambda x, y, w, h: pixels[y:y + h, x:x + w], tile_size=256)
+    canvas = Canvas()
+    canvas.open_image(path, background=False)
+    assert canvas.source is not None
+    return canvas, pixels
+
+
+def test_reading_a_region_leaves_shared_tiles_alone(tiled):
+    canvas, pixels = tiled
+    canvas.zoom_factor = 1.0
+    canvas._paint_image(lambda painter: painter.fillRect(10, 10, 20, 20, QColor("red")),
+                        canvas._stroke_rect(QPoint(10, 10), QPoint(30, 30)))
+    canvas.save_state()
+    tiles = dict(canvas._overlay)
+    keys = {key: tile.cacheKey() for key, tile in tiles.items()}
+
+    region = canvas.read_document_region(0, 0, 900, 700)
+    # The undo snapshot shares the tiles: a writable view would have detached them
+    assert {key: tile.cacheKey() for key, tile in canvas._overlay.items()} == keys
+    assert tuple(region[15, 15]) == (0, 0, 255, 255)
+    assert np.array_equal(region[200:, 200:], pixels[200:, 200:])